@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+api_handlers.py: Framework-neutral bodies of the /api/* views, shared by app.py (Flask/WSGI)
+and asgi_app.py (Starlette/ASGI) so both serve the same routes with the same responses.
+Handlers take plain inputs (parsed JSON body, query-args mapping) and return
+(payload, status) or (payload, status, headers); the caller encodes payload with
+api_schemas.dumps_bytes (Flask: jsonify through FastJSONProvider).
+"""
+import json
+import time
+import traceback
+from datetime import datetime, timezone
+
+import mymodel_utils
+import api_schemas
+import prediction_log
+import drift_monitor
+import insights_utils
+import stream_utils
+
+# Allow requests from your frontend domain in production
+# For development, allow from localhost:3000 (adjust port if needed)
+CORS_ORIGINS = ["http://localhost:3000", "http://localhost:5173"] # Replace with your frontend URL
+
+NOT_READY = ({"error": "Service not ready, initialization failed."}, 503)
+
+
+# --- Health / Probes ---
+def health():
+    """Basic health check."""
+    if mymodel_utils.get_status():
+        return {"status": "OK", "message": "Application initialized"}, 200
+    return {"status": "Error", "message": "Application failed to initialize"}, 500
+
+
+def liveness():
+    """Liveness probe: the process is up and serving requests (restart only if this fails)."""
+    return {"status": "OK"}, 200
+
+
+def readiness():
+    """Readiness probe: 200 only once models are loaded and warmed up, 503 until then."""
+    ready, warmup = mymodel_utils.get_readiness()
+    if ready:
+        return {"status": "Ready", "warmup": warmup}, 200
+    message = "Warming up models" if mymodel_utils.get_status() else "Application not initialized"
+    return {"status": "NotReady", "message": message, "warmup": warmup}, 503
+
+
+def health_v2():
+    """Health check including Gemini, executor, stream, log, bundle and drift status."""
+    soil_initialized = mymodel_utils.get_status()
+    gemini_configured = insights_utils.is_configured()
+    status_code = 200
+    response_data = {
+        "soil_service_status": "OK" if soil_initialized else "Error",
+        "gemini_service_status": "OK" if gemini_configured else "Error",
+        "gemini_backend": insights_utils.get_backend_name(),
+        "gemini_executor": insights_utils.get_stats(),
+        "prediction_streams": stream_utils.get_stats(),
+        "soil_service_ready": mymodel_utils.get_readiness()[0],
+        "prediction_log": prediction_log.get_stats(),
+        "artifact_bundle": mymodel_utils.get_artifact_bundle_info(),
+        "drift_monitor": drift_monitor.get_stats(),
+        "message": []
+    }
+    if soil_initialized:
+        response_data["message"].append("Soil analysis application initialized.")
+    else:
+        response_data["message"].append("Soil analysis application failed to initialize.")
+        status_code = 500
+    if gemini_configured:
+         response_data["message"].append("Gemini AI service configured.")
+    else:
+         response_data["message"].append("Gemini AI service NOT configured (check API key).")
+         # Don't necessarily make the whole health check fail if Gemini is down
+         # status_code = 500 # Uncomment if Gemini is critical
+    return response_data, status_code
+
+
+# --- Prediction ---
+def analyze(data):
+    """
+    Spectral data and water level in, predictions out (CPU-bound: run it off the event loop).
+    Expects JSON: { "waterLevel": int, "wavelengths": {"410": float, "535": float, ...} }
+    Optional "mode": "fast" serves all targets from the distilled student (high-volume screening).
+    """
+    if not mymodel_utils.get_status():
+        return NOT_READY
+
+    try:
+        # --- Input Validation (compiled schema, see api_schemas) ---
+        start_time = time.perf_counter()
+        try:
+            parsed = api_schemas.parse_analyze_request(data)
+        except api_schemas.RequestValidationError as e:
+            return {"error": str(e)}, 400
+
+        # --- Run Prediction ---
+        status_info, predictions = mymodel_utils.run_prediction_array(
+            parsed.values, parsed.present, parsed.provided, parsed.water_level, parsed.mode
+        )
+
+        # --- Format Response ---
+        formatted_response = api_schemas.format_analyze_response(
+            status_info, predictions, parsed.water_level, parsed.provided
+        )
+        prediction_log.record('analyze', parsed.water_level, parsed.values, parsed.present,
+                              status_info, predictions, (time.perf_counter() - start_time) * 1000)
+        drift_monitor.observe(parsed.water_level, parsed.values, parsed.present)
+        # Partial Success is returned as 200 (could be 207 Multi-Status)
+        return formatted_response, api_schemas.response_status_code(formatted_response)
+
+    except Exception as e:
+        print(f"ERROR in /api/analyze: {e}")
+        # Log the full traceback for debugging
+        traceback.print_exc()
+        return {"error": "An unexpected server error occurred."}, 500
+
+
+def sweep(data):
+    """
+    What-if sweep: how every target responds as one or two bands vary around a base sample
+    (CPU-bound: run it off the event loop). The whole grid is one batched predict per target.
+    Expects JSON: { "waterLevel": int, "wavelengths": {base sample}, "sweep": [{"wavelength": "410",
+    "min": float, "max": float, "steps": int}, ...] } (1-2 axes, grid size capped by api_schemas).
+    Synthetic grid points are not logged or counted as drift.
+    """
+    if not mymodel_utils.get_status():
+        return NOT_READY
+
+    try:
+        try:
+            parsed = api_schemas.parse_sweep_request(data)
+        except api_schemas.RequestValidationError as e:
+            return {"error": str(e)}, 400
+
+        status_info, surfaces, baseline = mymodel_utils.run_prediction_sweep(
+            parsed.values, parsed.present, parsed.provided, parsed.water_level, parsed.axes, parsed.mode
+        )
+        formatted_response = api_schemas.format_sweep_response(
+            status_info, surfaces, baseline, parsed.axes, parsed.water_level, parsed.provided
+        )
+        return formatted_response, api_schemas.response_status_code(formatted_response)
+
+    except Exception as e:
+        print(f"ERROR in /api/sweep: {e}")
+        traceback.print_exc()
+        return {"error": "An unexpected server error occurred."}, 500
+
+
+# --- Prediction Log / Drift ---
+def _parse_water_level_arg(args):
+    """Optional integer waterLevel query arg. Returns (water_level, error response or None)."""
+    water_level_str = args.get('waterLevel')
+    if water_level_str is None:
+        return None, None
+    try:
+        return int(water_level_str), None
+    except ValueError:
+        return None, ({"error": "'waterLevel' must be an integer."}, 400)
+
+
+def recent_predictions(args):
+    """
+    Most recent logged predictions, newest first (records are visible once the background
+    writer has flushed them). Query Params: optional limit (default 50), waterLevel,
+    status ('success', 'partial', 'failed', 'error'), since (ISO 8601). Blocking (SQLite).
+    """
+    if not prediction_log.is_enabled():
+        return {"error": "Prediction log is disabled (set PREDICTION_LOG_ENABLED=1)."}, 503
+
+    try:
+        limit = int(args.get('limit', 50))
+        if limit < 1: raise ValueError("Limit must be positive.")
+    except ValueError:
+        return {"error": "'limit' must be a positive integer."}, 400
+
+    water_level, error = _parse_water_level_arg(args)
+    if error:
+        return error
+
+    status = args.get('status')
+    if status is not None and status not in prediction_log.STATUS_VALUES:
+        return {"error": f"Invalid 'status': {status}. Valid values: {prediction_log.STATUS_VALUES}"}, 400
+
+    since = None
+    since_str = args.get('since')
+    if since_str:
+        try:
+            since = datetime.fromisoformat(since_str.replace('Z', '+00:00'))
+        except ValueError:
+            return {"error": "'since' must be an ISO 8601 timestamp."}, 400
+        if since.tzinfo is not None: # Stored as naive UTC
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+
+    try:
+        records = prediction_log.query_recent(limit, water_level, status, since)
+    except Exception as e:
+        print(f"ERROR in /api/predictions/recent: {e}")
+        return {"error": "Failed to query the prediction log."}, 500
+    return {"count": len(records), "predictions": records}, 200
+
+
+def drift(args):
+    """
+    Input-drift scores of recent requests versus the training data, per water level and band
+    (see drift_monitor). Query Params: optional waterLevel, window ('recent' or 'lifetime').
+    """
+    if not drift_monitor.is_enabled():
+        return {"error": "Drift monitor is disabled (DRIFT_MONITOR_ENABLED=0 or no reference)."}, 503
+
+    water_level, error = _parse_water_level_arg(args)
+    if error:
+        return error
+    if water_level is not None and not drift_monitor.is_monitored(water_level):
+        return {"error": f"No drift reference for water level {water_level}."}, 404
+
+    window = args.get('window', 'recent')
+    if window not in drift_monitor.WINDOWS:
+        return {"error": f"Invalid 'window': {window}. Valid values: {drift_monitor.WINDOWS}"}, 400
+
+    return {
+        "window": window,
+        "thresholds": {"psiWarn": drift_monitor.DRIFT_PSI_WARN, "psiAlert": drift_monitor.DRIFT_PSI_ALERT},
+        "waterLevels": drift_monitor.get_drift_scores(water_level, window),
+    }, 200
+
+
+# --- Metrics / Rankings ---
+def metrics(args):
+    """
+    Pre-calculated model performance metrics.
+    Bootstrap intervals are included under 'Confidence_Intervals' ({metric: {wl: {target: [lo, hi]}}});
+    pass intervals=false to omit them.
+    """
+    if not mymodel_utils.get_status():
+        return NOT_READY
+
+    metrics = mymodel_utils.get_performance_metrics()
+    if "error" in metrics:
+        return metrics, 500 # If metrics loading failed during init
+
+    if args.get('intervals', 'true').lower() in ('0', 'false', 'no'):
+        metrics = {key: value for key, value in metrics.items() if key != 'Confidence_Intervals'}
+
+    # No reformatting needed if mymodel_utils saves in the correct structure
+    return metrics, 200
+
+
+def top_wavelengths(args):
+    """
+    Top N ranked wavelengths for a given attribute.
+    Query Params: attribute (e.g., 'pH', 'nitro'), count (e.g., 5),
+                  optional waterLevel (e.g., 25) and importanceType ('split', 'gain', 'permutation')
+    """
+    if not mymodel_utils.get_status():
+        return NOT_READY
+
+    attribute_key_frontend = args.get('attribute') # e.g., 'pH', 'nitro'
+    count_str = args.get('count')
+
+    if not attribute_key_frontend:
+        return {"error": "Missing 'attribute' query parameter."}, 400
+    if not count_str:
+        return {"error": "Missing 'count' query parameter."}, 400
+
+    try:
+        count = int(count_str)
+        if count < 1: raise ValueError("Count must be positive.")
+    except ValueError:
+        return {"error": "'count' must be a positive integer."}, 400
+
+    # --- Map Frontend Attribute Key to Model Target Column Name ---
+    # Inverse of the map used in /analyze
+    model_target_map = api_schemas.MODEL_TARGET_MAP
+    model_target_col = model_target_map.get(attribute_key_frontend)
+
+    if not model_target_col:
+        valid_frontend_keys = list(model_target_map.keys())
+        return {"error": f"Invalid 'attribute' provided: {attribute_key_frontend}. Valid attributes: {valid_frontend_keys}"}, 400
+
+
+    water_level_str = args.get('waterLevel')
+    importance_type = args.get('importanceType')
+    if water_level_str is not None or importance_type is not None:
+        # Filtered rankings are served from the precomputed ranking index
+        water_level = None
+        if water_level_str is not None:
+            try:
+                water_level = int(water_level_str)
+                if water_level not in mymodel_utils.WATER_LEVELS_TO_PROCESS: raise ValueError("Unknown water level.")
+            except ValueError:
+                return {"error": f"'waterLevel' must be one of {mymodel_utils.WATER_LEVELS_TO_PROCESS}."}, 400
+        importance_type = importance_type or 'split'
+        if importance_type not in mymodel_utils.IMPORTANCE_TYPES:
+            return {"error": f"Invalid 'importanceType' provided: {importance_type}. Valid types: {mymodel_utils.IMPORTANCE_TYPES}"}, 400
+
+        top_rankings = mymodel_utils.get_ranking(model_target_col, water_level, importance_type, count)
+        if top_rankings is None:
+            return {"error": "Feature ranking index not available."}, 500
+        if not top_rankings:
+            return {"error": f"Ranking data not available for attribute '{attribute_key_frontend}' (target: {model_target_col}, waterLevel: {water_level_str}, importanceType: {importance_type})."}, 404
+        return top_rankings, 200
+
+    rankings = mymodel_utils.get_feature_rankings()
+    if "error" in rankings:
+        return rankings, 500 # If ranking loading failed
+
+    target_rankings = rankings.get(model_target_col)
+
+    if target_rankings is None:
+         # This might happen if ranking failed for this specific target during init
+         return {"error": f"Ranking data not available for attribute '{attribute_key_frontend}' (target: {model_target_col})."}, 404
+    elif not isinstance(target_rankings, list):
+         # Data integrity check
+         print(f"Warning: Unexpected format for rankings of {model_target_col}. Expected list, got {type(target_rankings)}")
+         return {"error": f"Internal server error retrieving rankings for '{attribute_key_frontend}'."}, 500
+
+    # Slice the rankings to get the top N
+    top_rankings = target_rankings[:count]
+
+    return top_rankings, 200
+
+
+# --- Insights ---
+INSIGHTS_REJECTED = ({"error": "Gemini AI service is busy. Please retry shortly."}, 429, {'Retry-After': '2'})
+INSIGHTS_TIMEOUT = ({"error": "Gemini AI request timed out."}, 504)
+INSIGHTS_FAILED = ({"error": "An error occurred while communicating with the Gemini AI service."}, 500)
+
+
+def check_insights_request(data):
+    """
+    Validates a /api/get-insights body: { "message": string, "stream": bool (optional) }.
+    Returns (message, None) or (None, error response).
+    """
+    if not mymodel_utils.get_status():
+        return None, ({"error": "Soil analysis service not ready."}, 503)
+    if not insights_utils.is_configured():
+        return None, ({"error": "Gemini AI service is not configured or available."}, 503)
+    if not isinstance(data, dict) or 'message' not in data:
+        return None, ({"error": "Invalid request: 'message' missing in JSON body."}, 400)
+    user_message = data['message']
+    if not isinstance(user_message, str) or not user_message.strip():
+        return None, ({"error": "Invalid request: 'message' must be a non-empty string."}, 400)
+    print(f"Sending to Gemini: {user_message[:100]}...") # Log truncated message
+    return user_message, None
+
+
+def insights_result(response_text):
+    """Response for a completed (non-streaming) insights call."""
+    if response_text:
+        print("Received response from Gemini.")
+        return {"response": response_text}, 200
+    print("Warning: Received unexpected or empty response from Gemini.")
+    return {"error": "Received no content from Gemini AI."}, 500
+
+
+def sse_event(chunk=None, error=None, done=False):
+    """One server-sent event of the /api/get-insights stream."""
+    if done:
+        return "event: done\ndata: {}\n\n"
+    if error is not None:
+        return f"event: error\ndata: {json.dumps({'error': error})}\n\n"
+    return f"data: {json.dumps({'text': chunk})}\n\n"
+
+
+def insights_stats():
+    """Insights cache hit rate, single-flight and upstream latency counters."""
+    return insights_utils.get_stats(), 200
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+api_schemas.py: Request parsing, response formatting and JSON encoding for the API.
+The /api/analyze body is validated in one pass against lookup tables built once at
+import and parsed straight into a fixed-order float array plus a presence mask.
+Error messages are identical to the original hand-written checks.
+Responses are encoded with orjson when it is installed.
+"""
+from collections import namedtuple
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+import mymodel_utils
+
+try:
+    import orjson
+except ImportError: # Optional speedup; falls back to Flask's encoder
+    orjson = None
+
+# --- Compiled Schema (built once) ---
+SPECTRAL_INDEX = {col: i for i, col in enumerate(mymodel_utils.SPECTRAL_COLS)} # Wavelength key -> array position
+WATER_LEVELS = frozenset(mymodel_utils.WATER_LEVELS_TO_PROCESS)
+MIN_INPUTS = 2 # Model requirement
+MAX_INPUTS = len(mymodel_utils.SPECTRAL_COLS)
+# What-if sweeps (/api/sweep): one predict per target over the whole grid, so latency grows with the
+# number of points (full models: ~0.27 ms per point on one core; the 'fast' student is ~50x cheaper)
+SWEEP_MAX_AXES = 2
+SWEEP_MAX_STEPS = 101 # Grid values per axis
+SWEEP_MAX_POINTS = 1024 # Grid points in total (e.g. 32 x 32)
+
+# Internal target names -> frontend keys (frontend `METRIC_PARAM_KEYS`)
+FRONTEND_KEY_MAP = {
+    'Ph': 'pH',
+    'Nitro': 'nitro',
+    'Posh Nitro': 'phosphorus', # Assuming 'Posh Nitro' means Phosphorus
+    'Pota Nitro': 'potassium', # Assuming 'Pota Nitro' means Potassium
+    'Capacitity Moist': 'capacityMoist',
+    'Temp': 'temperature',
+    'Moist': 'moisture',
+    'EC': 'electricalConductivity'
+}
+MODEL_TARGET_MAP = {frontend_key: model_key for model_key, frontend_key in FRONTEND_KEY_MAP.items()}
+
+AnalyzeRequest = namedtuple('AnalyzeRequest', ['water_level', 'values', 'present', 'provided', 'mode'])
+SweepRequest = namedtuple('SweepRequest', ['water_level', 'values', 'present', 'provided', 'mode', 'axes'])
+
+
+class RequestValidationError(ValueError):
+    """Invalid request body; str(error) is the client-facing message."""
+
+
+def parse_water_level(water_level):
+    """Validates a waterLevel value and returns it as an int."""
+    # bool is an int subclass; it is accepted here and rejected by the membership check, as before
+    if water_level is None or not isinstance(water_level, (int, float)):
+        raise RequestValidationError("Invalid request: 'waterLevel' missing or not a number.")
+    try:
+        water_level = int(water_level)
+    except (ValueError, OverflowError):
+        raise RequestValidationError("Invalid request: 'waterLevel' could not be converted to an integer.")
+    if water_level not in WATER_LEVELS:
+        raise RequestValidationError(f"Invalid request: 'waterLevel' must be one of {mymodel_utils.WATER_LEVELS_TO_PROCESS}.")
+    return water_level
+
+
+def parse_mode(mode):
+    """Validates the optional serving mode ('full' by default; 'fast' = distilled student)."""
+    if mode is None:
+        return 'full'
+    if mode not in mymodel_utils.SERVING_MODES:
+        raise RequestValidationError(f"Invalid request: 'mode' must be one of {mymodel_utils.SERVING_MODES}.")
+    return mode
+
+
+def parse_wavelengths(wavelength_data):
+    """
+    Validates a wavelengths dict and returns (values, present, provided): values is a float64 array
+    in SPECTRAL_COLS order (NaN where absent), present the matching bool mask, provided the keys as sent.
+    """
+    if not wavelength_data or not isinstance(wavelength_data, dict):
+        raise RequestValidationError("Invalid request: 'wavelengths' missing or not a dictionary.")
+
+    invalid_keys = [key for key in wavelength_data if key not in SPECTRAL_INDEX]
+    if invalid_keys:
+        raise RequestValidationError(f"Invalid spectral keys provided: {invalid_keys}. Valid keys are: {mymodel_utils.SPECTRAL_COLS}")
+
+    num_provided = len(wavelength_data)
+    if not (MIN_INPUTS <= num_provided <= MAX_INPUTS):
+        raise RequestValidationError(f"Must provide between {MIN_INPUTS} and {MAX_INPUTS} spectral values. Provided: {num_provided}")
+
+    values = np.full(MAX_INPUTS, np.nan)
+    present = np.zeros(MAX_INPUTS, dtype=bool)
+    for key, value in wavelength_data.items():
+        try:
+            values[SPECTRAL_INDEX[key]] = float(value)
+        except (ValueError, TypeError):
+            raise RequestValidationError(f"Invalid numeric value for wavelength '{key}': {value}")
+        present[SPECTRAL_INDEX[key]] = True
+    return values, present, list(wavelength_data)
+
+
+def parse_analyze_request(data):
+    """Parses an /api/analyze JSON body into an AnalyzeRequest. Raises RequestValidationError."""
+    if not data or not isinstance(data, dict):
+        raise RequestValidationError("Invalid request: No JSON body found.")
+    water_level = parse_water_level(data.get('waterLevel'))
+    values, present, provided = parse_wavelengths(data.get('wavelengths'))
+    return AnalyzeRequest(water_level, values, present, provided, parse_mode(data.get('mode')))
+
+
+def _parse_sweep_axis(axis):
+    """Validates one {"wavelength", "min", "max", "steps"} sweep axis; returns (key, band index, grid values)."""
+    if not isinstance(axis, dict):
+        raise RequestValidationError("Invalid request: each 'sweep' entry must be an object with 'wavelength', 'min', 'max' and 'steps'.")
+    key = axis.get('wavelength')
+    if key not in SPECTRAL_INDEX:
+        raise RequestValidationError(f"Invalid sweep wavelength: {key}. Valid keys are: {mymodel_utils.SPECTRAL_COLS}")
+    try:
+        low, high = float(axis.get('min')), float(axis.get('max'))
+    except (ValueError, TypeError):
+        raise RequestValidationError(f"Invalid sweep range for wavelength '{key}': 'min' and 'max' must be numbers.")
+    if not (np.isfinite(low) and np.isfinite(high) and low < high):
+        raise RequestValidationError(f"Invalid sweep range for wavelength '{key}': 'min' must be less than 'max'.")
+    steps = axis.get('steps')
+    if not isinstance(steps, int) or isinstance(steps, bool) or not (2 <= steps <= SWEEP_MAX_STEPS):
+        raise RequestValidationError(f"Invalid sweep steps for wavelength '{key}': must be an integer between 2 and {SWEEP_MAX_STEPS}.")
+    return key, SPECTRAL_INDEX[key], np.linspace(low, high, steps)
+
+
+def parse_sweep_request(data):
+    """
+    Parses an /api/sweep JSON body into a SweepRequest. Raises RequestValidationError.
+    The base sample ('wavelengths') may omit the swept bands; together they must name MIN_INPUTS..MAX_INPUTS bands.
+    """
+    if not data or not isinstance(data, dict):
+        raise RequestValidationError("Invalid request: No JSON body found.")
+    water_level = parse_water_level(data.get('waterLevel'))
+    sweep = data.get('sweep')
+    if not sweep or not isinstance(sweep, list) or len(sweep) > SWEEP_MAX_AXES:
+        raise RequestValidationError(f"Invalid request: 'sweep' must be a list of 1 to {SWEEP_MAX_AXES} axes.")
+    axes = [_parse_sweep_axis(axis) for axis in sweep]
+    keys = [key for key, _, _ in axes]
+    if len(set(keys)) != len(keys):
+        raise RequestValidationError("Invalid request: sweep wavelengths must be distinct.")
+    n_points = int(np.prod([len(grid) for _, _, grid in axes]))
+    if n_points > SWEEP_MAX_POINTS:
+        raise RequestValidationError(f"Sweep grid too large: {n_points} points (at most {SWEEP_MAX_POINTS}).")
+
+    base = data.get('wavelengths') or {}
+    if not isinstance(base, dict):
+        raise RequestValidationError("Invalid request: 'wavelengths' missing or not a dictionary.")
+    # Swept bands count as provided; their placeholder values never reach the model
+    values, present, provided = parse_wavelengths({**base, **{key: 0.0 for key in keys if key not in base}})
+    for key in keys:
+        if key not in base:
+            values[SPECTRAL_INDEX[key]] = np.nan
+            present[SPECTRAL_INDEX[key]] = False
+    return SweepRequest(water_level, values, present, provided, parse_mode(data.get('mode')),
+                        [(band, grid) for _, band, grid in axes])
+
+
+def format_analyze_response(status_info, predictions, water_level, provided):
+    """Builds the /api/analyze response body with frontend keys (null for missing/NaN predictions)."""
+    formatted_response = {
+        'Prediction_Status': status_info.get('Prediction_Status', 'Unknown Error'),
+        'Input_Water_Level': status_info.get('Input_Water_Level', water_level),
+        'Provided_Features': status_info.get('Provided_Features', provided),
+        'Imputed_Features': status_info.get('Imputed_Features', []),
+        'Model_Variants': status_info.get('Model_Variants', {})
+    }
+    for model_key, frontend_key in FRONTEND_KEY_MAP.items():
+        pred_value = predictions.get(model_key)
+        # NaN != NaN; return null for NaN or None (JSON standard)
+        formatted_response[frontend_key] = None if (pred_value is None or pred_value != pred_value) else float(pred_value)
+    return formatted_response
+
+
+def format_sweep_response(status_info, surfaces, baseline, axes, water_level, provided):
+    """
+    Builds the /api/sweep response body: the axes' grid values, then one nested list per frontend
+    key (surface[i] for one axis, surface[i][j] for two; null where a model is missing) and the
+    predictions at the unmodified base sample under 'baseline'.
+    """
+    formatted_response = {
+        'Prediction_Status': status_info.get('Prediction_Status', 'Unknown Error'),
+        'Input_Water_Level': status_info.get('Input_Water_Level', water_level),
+        'Provided_Features': status_info.get('Provided_Features', provided),
+        'Imputed_Features': status_info.get('Imputed_Features', []),
+        'Model_Variants': status_info.get('Model_Variants', {}),
+        'axes': [{'wavelength': mymodel_utils.SPECTRAL_COLS[band], 'values': grid.tolist()} for band, grid in axes],
+        'baseline': {},
+        'surfaces': {}
+    }
+    for model_key, frontend_key in FRONTEND_KEY_MAP.items():
+        surface = surfaces.get(model_key)
+        formatted_response['surfaces'][frontend_key] = None if surface is None else surface.tolist()
+        base_value = baseline.get(model_key)
+        formatted_response['baseline'][frontend_key] = None if (base_value is None or base_value != base_value) else float(base_value)
+    return formatted_response
+
+
+def response_status_code(formatted_response):
+    """HTTP status for a formatted prediction response."""
+    status = formatted_response['Prediction_Status']
+    return 500 if ("Error" in status or "Failed" in status) else 200
+
+
+# --- Fast JSON ---
+_ORJSON_OPTIONS = (orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+
+def dumps_bytes(obj):
+    """Encodes obj as UTF-8 JSON bytes (sorted keys, like Flask's default provider)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=_ORJSON_OPTIONS)
+    import json
+    return json.dumps(obj, default=DefaultJSONProvider.default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (falls back to the default provider if it is missing)."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps_bytes(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+artifact_bundle.py: Single-file, memory-mapped serving bundle for the tuned LightGBM models,
+scalers and imputation means.
+
+Layout (little-endian):
+  [0:8]   magic b"SOILBNDL"
+  [8:12]  uint32 format version
+  [12:16] uint32 reserved
+  [16:24] uint64 header length
+  [24:..] JSON header (index of every array: offset/dtype/shape, per-forest metadata,
+          artifact version = content hash of the source artifacts), padded to ALIGNMENT
+  [....]  arrays, each ALIGNMENT-aligned
+
+Each water level is stored as one forest: the trees of all its targets concatenated into
+contiguous node arrays (split feature, threshold index, child pairs). Leaves are self-loops,
+so every tree is walked with the same fixed number of vectorized steps. Thresholds are int16
+indexes into per-feature sorted threshold tables of the water level: inputs are binned once
+per call (searchsorted) and compared as integers, which is exact (x <= t  <=>  bin(x) <= index(t)).
+Leaf values are float64 by default (predictions are identical to booster.predict), or int16 /
+float16 with a per-tree scale/offset; a quantized target is only kept if its worst-case
+prediction error (sum over trees of the largest leaf rounding error) is within max_leaf_error.
+
+load_bundle() memory-maps the file read-only, so arrays are paged in on first use and the
+pages are shared by every worker process serving the same file.
+"""
+
+import os
+import json
+import time
+import struct
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import joblib
+
+MAGIC = b"SOILBNDL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+LEAF_DTYPES = ['float64', 'float32', 'float16', 'int16']
+_PREFIX = struct.Struct("<8sIIQ")
+_LEAF_SENTINEL = np.iinfo(np.int16).max # Threshold index of leaf nodes: no bin compares greater
+
+
+class BundleError(Exception):
+    """Raised when a bundle cannot be exported or is missing, corrupt or stale."""
+
+
+# --- Export ---
+def _parse_model_text(model_text):
+    """Per-tree {key: value-string} dicts from LightGBM's text model format."""
+    if 'end of trees' not in model_text:
+        raise BundleError("Unrecognized LightGBM model text.")
+    trees = []
+    for block in model_text.split('end of trees')[0].split('\nTree=')[1:]:
+        trees.append(dict(line.split('=', 1) for line in block.split('\n')[1:] if '=' in line))
+    return trees
+
+def _tree_arrays(tree):
+    """(feature, threshold, left, right, leaf_value, depth) of one tree; children < 0 are ~leaf."""
+    num_leaves = int(tree['num_leaves'])
+    leaf_value = np.array(tree['leaf_value'].split(), dtype=np.float64)
+    if num_leaves == 1:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, np.empty(0), empty, empty, leaf_value, 0
+    if int(tree.get('num_cat', 0)) or int(tree.get('is_linear', 0)):
+        raise BundleError("Categorical splits and linear trees are not supported.")
+    decision_type = np.array(tree['decision_type'].split(), dtype=np.int64)
+    # bit 0: categorical; bits 2-3: missing type (0 = None, i.e. NaN is treated as 0.0)
+    if (decision_type & 1).any() or ((decision_type >> 2) & 3).any():
+        raise BundleError("Only numerical splits without missing-value handling are supported.")
+    feature = np.array(tree['split_feature'].split(), dtype=np.int64)
+    threshold = np.array(tree['threshold'].split(), dtype=np.float64)
+    left = np.array(tree['left_child'].split(), dtype=np.int64)
+    right = np.array(tree['right_child'].split(), dtype=np.int64)
+    node_depth = np.zeros(num_leaves - 1, dtype=np.int64) # Parents always precede their children
+    depth = 1
+    for i in range(num_leaves - 1):
+        for child in (left[i], right[i]):
+            if child >= 0:
+                node_depth[child] = node_depth[i] + 1
+            else:
+                depth = max(depth, node_depth[i] + 1)
+    return feature, threshold, left, right, leaf_value, depth
+
+def _encode_leaves(leaf_values, is_leaf, tree_ranges, dtype):
+    """
+    Encodes one target's per-node leaf values. float64/float32 are stored as is; int16/float16
+    as q * leaf_scale[tree] + leaf_offset[tree], fitted to the leaves of each tree.
+    Returns (arrays, error_bound): the bound is the worst-case prediction error, i.e. the sum
+    over trees of the largest leaf encoding error.
+    """
+    if dtype in ('float64', 'float32'):
+        q = leaf_values.astype(dtype)
+        error = np.abs(q.astype(np.float64) - leaf_values)
+        return {'leaf_value': q}, float(sum(error[start:end].max() for start, end in tree_ranges))
+    q_max = np.iinfo(np.int16).max if dtype == 'int16' else 1.0
+    q = np.zeros(len(leaf_values), dtype=dtype)
+    scale, offset = np.ones(len(tree_ranges)), np.zeros(len(tree_ranges))
+    error_bound = 0.0
+    for t, (start, end) in enumerate(tree_ranges):
+        leaves = slice(start, end)
+        values = leaf_values[leaves][is_leaf[leaves]]
+        center, half_range = (values.max() + values.min()) / 2, (values.max() - values.min()) / 2
+        step = half_range / q_max if half_range > 0 else 1.0
+        scaled = (leaf_values[leaves] - center) / step
+        q[leaves] = np.where(is_leaf[leaves], np.rint(scaled) if dtype == 'int16' else scaled, 0)
+        scale[t], offset[t] = step, center
+        decoded = q[leaves].astype(np.float64) * step + center
+        error_bound += float(np.abs(decoded - leaf_values[leaves])[is_leaf[leaves]].max())
+    return {'leaf_value': q, 'leaf_scale': scale, 'leaf_offset': offset}, error_bound
+
+def _build_forest(wl, models, n_features, leaf_dtype, max_leaf_error):
+    """Flattens {target: booster} of one water level into forest arrays and per-target metadata."""
+    feature, threshold, child, roots = [], [], [], []
+    targets = {}
+    leaf_arrays = {}
+    n_nodes = n_trees = 0
+    for target, booster in models.items():
+        node_start, tree_start, target_depth = n_nodes, n_trees, 0
+        leaf_values, is_leaf = [], [] # Per node of this target (0.0 for internal nodes)
+        tree_ranges = [] # Node range of each tree, relative to node_start
+        for tree in _parse_model_text(booster.model_to_string()):
+            t_feature, t_threshold, left, right, t_leaves, depth = _tree_arrays(tree)
+            n_internal, n_leaves = len(t_feature), len(t_leaves)
+            base = n_nodes
+            encode = lambda c: np.where(c >= 0, base + c, base + n_internal + ~c)
+            pairs = np.empty((n_internal + n_leaves, 2), dtype=np.int64)
+            pairs[:n_internal, 0], pairs[:n_internal, 1] = encode(left), encode(right)
+            pairs[n_internal:] = (base + n_internal + np.arange(n_leaves))[:, None] # Leaves loop to themselves
+            feature.append(np.concatenate([t_feature, np.zeros(n_leaves, dtype=np.int64)]))
+            threshold.append(np.concatenate([t_threshold, np.full(n_leaves, np.inf)]))
+            child.append(pairs.ravel())
+            roots.append(base)
+            leaf_values.append(np.concatenate([np.zeros(n_internal), t_leaves]))
+            is_leaf.append(np.arange(n_internal + n_leaves) >= n_internal)
+            tree_ranges.append((base - node_start, base - node_start + n_internal + n_leaves))
+            target_depth = max(target_depth, depth)
+            n_nodes += n_internal + n_leaves
+            n_trees += 1
+        leaf_values, is_leaf = np.concatenate(leaf_values), np.concatenate(is_leaf)
+        meta = {'trees': [tree_start, n_trees], 'nodes': [node_start, n_nodes], 'depth': int(target_depth)}
+        leaf_arrays[target], bound = _encode_leaves(leaf_values, is_leaf, tree_ranges, leaf_dtype)
+        meta.update({'leafDtype': leaf_dtype, 'maxLeafError': bound})
+        if bound > max_leaf_error and leaf_dtype != 'float64':
+            print(f"  WL {wl} {target}: {leaf_dtype} leaf error bound {bound:.4g} > {max_leaf_error}; kept float64.")
+            leaf_arrays[target], _ = _encode_leaves(leaf_values, is_leaf, tree_ranges, 'float64')
+            meta.update({'leafDtype': 'float64', 'maxLeafError': 0.0, 'rejectedLeafError': bound})
+        targets[target] = meta
+
+    feature = np.concatenate(feature)
+    threshold = np.concatenate(threshold)
+    # Per-feature sorted threshold tables; nodes store their index into the table
+    tables = [np.unique(threshold[(feature == f) & np.isfinite(threshold)]) for f in range(n_features)]
+    max_table = max((len(table) for table in tables), default=0)
+    index_dtype = np.int16 if max_table < _LEAF_SENTINEL else np.int32
+    threshold_index = np.full(len(threshold), np.iinfo(index_dtype).max, dtype=index_dtype)
+    for f, table in enumerate(tables):
+        mask = (feature == f) & np.isfinite(threshold)
+        threshold_index[mask] = np.searchsorted(table, threshold[mask])
+    arrays = {
+        'feature': feature.astype(np.uint8 if n_features <= 256 else np.int32),
+        'threshold_index': threshold_index,
+        'child': np.concatenate(child).astype(np.int32),
+        'root': np.array(roots, dtype=np.int32),
+        'thresholds': np.concatenate(tables) if tables else np.empty(0),
+        'threshold_offsets': np.cumsum([0] + [len(table) for table in tables]).astype(np.int64),
+    }
+    meta = {'targets': targets, 'nodes': int(n_nodes), 'trees': int(n_trees),
+            'depth': max((m['depth'] for m in targets.values()), default=0)}
+    return arrays, leaf_arrays, meta
+
+def export_bundle(path, models, scalers, imputation_values, feature_names, model_files,
+                  artifact_version=None, leaf_dtype='float64', max_leaf_error=0.0, check_rows=None):
+    """
+    Writes the bundle atomically (temp file + rename).
+      models: {wl: {target: LGBMRegressor}}, scalers: {wl: StandardScaler},
+      imputation_values: {wl: {feature: mean}}, model_files: {wl: {target: path relative to the bundle}},
+      artifact_version: content hash of the source artifacts (load_bundle's stale check),
+      check_rows: optional {wl: scaled rows} on which the bundle predictions are compared with the boosters.
+    Returns the parsed header.
+    """
+    if leaf_dtype not in LEAF_DTYPES:
+        raise BundleError(f"leaf_dtype must be one of {LEAF_DTYPES}.")
+    start = time.perf_counter()
+    header = {
+        'formatVersion': FORMAT_VERSION,
+        'createdAt': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'artifactVersion': artifact_version,
+        'features': list(feature_names),
+        'leafDtype': leaf_dtype,
+        'maxLeafError': max_leaf_error,
+        'arrays': {},
+        'scalers': {},
+        'imputation': {},
+        'forests': {},
+    }
+    arrays = {}
+
+    def add(name, array):
+        arrays[name] = np.ascontiguousarray(array)
+        return name
+
+    for wl, scaler in scalers.items():
+        if scaler is None:
+            continue
+        header['scalers'][str(wl)] = {'mean': add(f"scaler/{wl}/mean", np.asarray(scaler.mean_, dtype=np.float64)),
+                                      'scale': add(f"scaler/{wl}/scale", np.asarray(scaler.scale_, dtype=np.float64))}
+    for wl, means in imputation_values.items():
+        values = np.array([means.get(feature, np.nan) for feature in feature_names], dtype=np.float64)
+        if not np.isnan(values).any():
+            header['imputation'][str(wl)] = add(f"imputation/{wl}", values)
+    for wl, wl_models in models.items():
+        boosters = {target: model.booster_ for target, model in wl_models.items() if model is not None}
+        if not boosters:
+            continue
+        forest_arrays, leaf_arrays, meta = _build_forest(wl, boosters, len(feature_names), leaf_dtype, max_leaf_error)
+        meta['arrays'] = {name: add(f"forest/{wl}/{name}", array) for name, array in forest_arrays.items()}
+        for target, target_arrays in leaf_arrays.items():
+            meta['targets'][target]['arrays'] = {name: add(f"forest/{wl}/{target}/{name}", array) for name, array in target_arrays.items()}
+            meta['targets'][target]['modelFile'] = model_files[wl][target]
+        header['forests'][str(wl)] = meta
+
+    # Offsets are relative to the data section, which starts ALIGNMENT-aligned after the header
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(_PREFIX.size + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    try:
+        bundle = load_bundle(tmp_path, bundle_dir=os.path.dirname(os.path.abspath(path)), native_min_rows=0)
+        if check_rows is not None:
+            _check_bundle(bundle, models, check_rows)
+        bundle.close()
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    print(f"Exported artifact bundle to {path} ({os.path.getsize(path) / 1e6:.1f} MB, "
+          f"leaf dtype {leaf_dtype}) in {time.perf_counter() - start:.2f} seconds.")
+    return header
+
+def _check_bundle(bundle, models, check_rows):
+    """Compares bundle predictions with the boosters: exact for float64 leaves, within the bound otherwise."""
+    for wl, forest in bundle.forests.items():
+        X = np.asarray(check_rows.get(wl), dtype=np.float64)
+        if X.ndim != 2 or not len(X):
+            continue
+        preds = forest.predict(X)
+        for j, target in enumerate(forest.targets):
+            error = float(np.abs(preds[:, j] - models[wl][target].booster_.predict(X)).max())
+            bound = forest.meta['targets'][target]['maxLeafError']
+            if error > bound + 1e-9 * max(1.0, float(np.abs(preds[:, j]).max())):
+                raise BundleError(f"Bundle check failed for WL {wl} {target}: error {error:.3g} > bound {bound:.3g}.")
+
+
+# --- Serving ---
+class Forest:
+    """All trees of one water level, evaluated with a fixed number of vectorized steps."""
+
+    def __init__(self, water_level, meta, array, n_features):
+        self.water_level = water_level
+        self.meta = meta
+        self.targets = list(meta['targets'])
+        self.depth = meta['depth']
+        arrays = {key: array(name) for key, name in meta['arrays'].items()}
+        self.feature = arrays['feature']
+        self.threshold_index = arrays['threshold_index']
+        self.child = arrays['child']
+        self.root = arrays['root']
+        offsets = arrays['threshold_offsets']
+        self.tables = [arrays['thresholds'][offsets[f]:offsets[f + 1]] for f in range(n_features)]
+        self.leaves = {target: {key: array(name) for key, name in target_meta['arrays'].items()}
+                       for target, target_meta in meta['targets'].items()}
+
+    def _bin(self, X):
+        bins = np.empty(X.shape, dtype=self.threshold_index.dtype)
+        for f, table in enumerate(self.tables):
+            bins[:, f] = np.searchsorted(table, X[:, f], side='left') # Number of thresholds < x
+        return bins
+
+    def _traverse(self, bins, roots, depth):
+        """Leaf node ids, shape (n_rows, n_trees)."""
+        feature, threshold_index, child = self.feature, self.threshold_index, self.child
+        if len(bins) == 1:
+            row = bins[0]
+            node = roots
+            for _ in range(depth):
+                node = child[2 * node + (row[feature[node]] > threshold_index[node])]
+            return node[None, :]
+        rows = np.arange(len(bins))[:, None]
+        node = np.broadcast_to(roots, (len(bins), len(roots)))
+        for _ in range(depth):
+            node = child[2 * node + (bins[rows, feature[node]] > threshold_index[node])]
+        return node
+
+    def _target_output(self, target, nodes):
+        """Sums the leaf values of one target's trees in tree order (same summation order as LightGBM)."""
+        node_start = self.meta['targets'][target]['nodes'][0]
+        leaves = self.leaves[target]
+        local = nodes - node_start
+        values = leaves['leaf_value'][local]
+        if 'leaf_scale' in leaves: # Column j of nodes is tree j of this target
+            values = values * leaves['leaf_scale'] + leaves['leaf_offset']
+        return np.cumsum(values, axis=1, dtype=np.float64)[:, -1]
+
+    def predict(self, X, targets=None):
+        """Predictions (n_rows, len(targets)) for scaled rows X; targets defaults to every target."""
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if np.isnan(X).any():
+            X = np.where(np.isnan(X), 0.0, X) # LightGBM treats NaN as 0.0 for splits without missing handling
+        targets = self.targets if targets is None else targets
+        spans = [self.meta['targets'][target]['trees'] for target in targets]
+        if targets is self.targets:
+            roots, depth = self.root, self.depth
+        else:
+            roots = np.concatenate([self.root[start:end] for start, end in spans])
+            depth = max(self.meta['targets'][target]['depth'] for target in targets)
+        nodes = self._traverse(self._bin(X), roots, depth)
+        out = np.empty((len(X), len(targets)))
+        position = 0
+        for j, (target, (start, end)) in enumerate(zip(targets, spans)):
+            out[:, j] = self._target_output(target, nodes[:, position:position + end - start])
+            position += end - start
+        return out
+
+
+class BundleBooster:
+    """booster.predict() stand-in for one target. Batches of native_min_rows or more rows use the
+    LightGBM booster (loaded lazily from the model pickle) when the target's leaves are exact."""
+
+    def __init__(self, forest, target, model_path, native_min_rows):
+        self.forest = forest
+        self.target = target
+        self.model_path = model_path
+        exact = forest.meta['targets'][target]['leafDtype'] == 'float64'
+        self.native_min_rows = native_min_rows if exact and native_min_rows and os.path.exists(model_path) else 0
+        self._native = None
+        self._native_lock = threading.Lock()
+
+    def uses_native(self, n_rows):
+        return bool(self.native_min_rows) and n_rows >= self.native_min_rows
+
+    def native(self):
+        if self._native is None:
+            with self._native_lock:
+                if self._native is None:
+                    self._native = joblib.load(self.model_path).booster_
+        return self._native
+
+    def num_trees(self):
+        start, end = self.forest.meta['targets'][self.target]['trees']
+        return end - start
+
+    def predict(self, X, num_threads=None):
+        if self.uses_native(len(X)):
+            return self.native().predict(X, num_threads=num_threads or 0)
+        return self.forest.predict(X, [self.target])[:, 0]
+
+
+class BundleModel:
+    """Minimal LGBMRegressor stand-in (model.booster_.predict) backed by a bundle forest."""
+
+    def __init__(self, booster):
+        self.booster_ = booster
+
+    def predict(self, X):
+        return self.booster_.predict(np.asarray(X, dtype=np.float64))
+
+
+class BundleScaler:
+    """StandardScaler stand-in over memory-mapped mean_/scale_ arrays."""
+
+    def __init__(self, mean, scale):
+        self.mean_ = mean
+        self.scale_ = scale
+        self.n_features_in_ = len(mean)
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean_) / self.scale_
+
+
+class ArtifactBundle:
+    """A loaded (memory-mapped) bundle: models, scalers, imputation_values and forests keyed by water level."""
+
+    def __init__(self, path, header, mmap, bundle_dir, native_min_rows):
+        self.path = path
+        self.header = header
+        self._mmap = mmap
+        self._data_start = -(-(_PREFIX.size + _PREFIX.unpack_from(mmap, 0)[3]) // ALIGNMENT) * ALIGNMENT
+        self.artifact_version = header.get('artifactVersion')
+        features = header['features']
+        array = self.array
+        self.scalers = {int(wl): BundleScaler(array(names['mean']), array(names['scale']))
+                        for wl, names in header['scalers'].items()}
+        self.imputation_values = {int(wl): dict(zip(features, array(name).tolist()))
+                                  for wl, name in header['imputation'].items()}
+        self.forests = {}
+        self.models = {}
+        for wl, meta in header['forests'].items():
+            forest = Forest(int(wl), meta, array, len(features))
+            self.forests[int(wl)] = forest
+            self.models[int(wl)] = {
+                target: BundleModel(BundleBooster(forest, target, os.path.join(bundle_dir, target_meta['modelFile']), native_min_rows))
+                for target, target_meta in meta['targets'].items()
+            }
+
+    def array(self, name):
+        info = self.header['arrays'][name]
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'])) if info['shape'] else 1
+        return np.frombuffer(self._mmap, dtype=dtype, count=count, offset=self._data_start + info['offset']).reshape(info['shape'])
+
+    def info(self):
+        """Summary for health/status endpoints."""
+        return {
+            'path': self.path,
+            'sizeMB': round(os.path.getsize(self.path) / 1e6, 2),
+            'artifactVersion': self.artifact_version,
+            'createdAt': self.header.get('createdAt'),
+            'leafDtype': self.header.get('leafDtype'),
+            'forests': {str(wl): {'trees': forest.meta['trees'], 'nodes': forest.meta['nodes'], 'depth': forest.depth}
+                        for wl, forest in self.forests.items()},
+        }
+
+    def close(self):
+        self.forests, self.models, self.scalers = {}, {}, {}
+        self._mmap = None
+
+
+def load_bundle(path, bundle_dir=None, expected_version=None, native_min_rows=0):
+    """
+    Memory-maps a bundle. Raises BundleError if the file is missing, malformed, of another
+    format version, or (when expected_version is given) built from source artifacts with different content.
+    """
+    if not os.path.exists(path):
+        raise BundleError(f"Bundle not found: {path}")
+    try:
+        mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, _, header_length = _PREFIX.unpack_from(mmap, 0)
+    except (OSError, ValueError, struct.error) as e:
+        raise BundleError(f"Unreadable bundle {path}: {e}")
+    if magic != MAGIC:
+        raise BundleError(f"Not an artifact bundle: {path}")
+    if version != FORMAT_VERSION:
+        raise BundleError(f"Bundle format version {version} is not supported (expected {FORMAT_VERSION}).")
+    try:
+        header = json.loads(bytes(mmap[_PREFIX.size:_PREFIX.size + header_length]).decode('utf-8'))
+    except ValueError as e:
+        raise BundleError(f"Corrupt bundle header: {e}")
+    if expected_version is not None and header.get('artifactVersion') != expected_version:
+        raise BundleError("Bundle is stale (artifact files changed since it was exported).")
+    return ArtifactBundle(path, header, mmap, bundle_dir or os.path.dirname(os.path.abspath(path)), native_min_rows)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+asgi_app.py: ASGI (Starlette) entry point serving the same /api/* routes and responses as app.py.
+The event loop only parses requests and awaits work:
+  - CPU-bound work (prediction, drift queries) runs on a bounded thread pool of ASGI_PREDICT_WORKERS
+    threads (default: the inference CPU quota); once ASGI_PREDICT_MAX_PENDING calls are running or
+    queued, further ones get 503 + Retry-After instead of queueing without bound;
+  - blocking I/O (prediction log queries) and /api/health/v2 run on Starlette's default thread pool
+    (health probes must not get 503 busy);
+  - insight calls are awaited on the loop (insights_utils.generate_async/stream_async), so a slow
+    upstream holds no thread while it waits.
+Models load through mymodel_utils.initialize_application() in the lifespan startup, exactly as app.py.
+
+Run (from backend/):
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+Compare with the WSGI deployment using benchmarks/asgi_vs_wsgi.py.
+"""
+import os
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+load_dotenv() # Before the helper modules read their INSIGHTS_*/PREDICTION_LOG_* options
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+
+import mymodel_utils
+import api_schemas
+import api_handlers
+import prediction_log
+import drift_monitor
+import insights_utils
+import stream_utils
+
+# --- Configuration (environment overridable) ---
+ASGI_PREDICT_WORKERS = int(os.environ.get("ASGI_PREDICT_WORKERS", 0)) or None # CPU-bound threads (None = inference CPU quota)
+ASGI_PREDICT_MAX_PENDING = int(os.environ.get("ASGI_PREDICT_MAX_PENDING", 64)) # Running + queued CPU calls before 503
+
+BUSY = ({"error": "Service busy. Please retry shortly."}, 503, {'Retry-After': '1'})
+
+
+class _CPUExecutor:
+    """Bounded thread pool for CPU-bound handlers; admission is counted on the event loop."""
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi-cpu")
+
+    def try_run(self, fn, *args):
+        """Awaitable result of fn(*args) on the pool, or None when the pool is saturated."""
+        if self.pending >= self.max_pending:
+            return None
+        return self.run(fn, *args)
+
+    async def run(self, fn, *args):
+        """fn(*args) on the pool without admission control (startup, open streams)."""
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_cpu = None # _CPUExecutor, created in the lifespan (needs the CPU quota)
+
+
+def _respond(result):
+    """(payload, status[, headers]) from api_handlers -> JSON response (same bytes as Flask's jsonify)."""
+    payload, status, *rest = result
+    return Response(api_schemas.dumps_bytes(payload), status_code=status,
+                    headers=rest[0] if rest else None, media_type="application/json")
+
+
+async def _on_cpu(fn, *args):
+    work = _cpu.try_run(fn, *args)
+    if work is None:
+        return _respond(BUSY)
+    return _respond(await work)
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+# --- API Routes ---
+async def health_check(request):
+    return _respond(api_handlers.health())
+
+
+async def liveness_check(request):
+    return _respond(api_handlers.liveness())
+
+
+async def readiness_check(request):
+    return _respond(api_handlers.readiness())
+
+
+async def analyze_soil(request):
+    return await _on_cpu(api_handlers.analyze, await _json_body(request))
+
+
+async def sweep_soil(request):
+    return await _on_cpu(api_handlers.sweep, await _json_body(request))
+
+
+async def get_recent_predictions(request):
+    return _respond(await run_in_threadpool(api_handlers.recent_predictions, request.query_params))
+
+
+async def get_drift(request):
+    return await _on_cpu(api_handlers.drift, request.query_params)
+
+
+async def get_metrics(request):
+    return _respond(api_handlers.metrics(request.query_params))
+
+
+async def get_top_wavelengths(request):
+    return _respond(api_handlers.top_wavelengths(request.query_params))
+
+
+async def get_insights_stats(request):
+    return _respond(api_handlers.insights_stats())
+
+
+async def health_check_v2(request):
+    # Drift scoring is brief CPU work; no admission control, so probes never see 503 busy (as in app.py)
+    return _respond(await run_in_threadpool(api_handlers.health_v2))
+
+
+async def get_gemini_insights(request):
+    """Same contract as app.py's /api/get-insights; waiting happens on the event loop."""
+    try:
+        data = await _json_body(request)
+        user_message, error = api_handlers.check_insights_request(data)
+        if error:
+            return _respond(error)
+
+        # --- Streaming (server-sent events) ---
+        if data.get('stream'):
+            chunks = insights_utils.stream_async(user_message)
+
+            async def event_stream():
+                try:
+                    async for chunk in chunks:
+                        yield api_handlers.sse_event(chunk)
+                    yield api_handlers.sse_event(done=True)
+                except insights_utils.InsightsTimeout:
+                    yield api_handlers.sse_event(error='Gemini AI request timed out.')
+                except Exception as e:
+                    print(f"ERROR in /api/get-insights stream: {e}")
+                    yield api_handlers.sse_event(error='An error occurred while communicating with the Gemini AI service.')
+
+            return StreamingResponse(event_stream(), media_type='text/event-stream',
+                                     headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        return _respond(api_handlers.insights_result(await insights_utils.generate_async(user_message)))
+
+    except insights_utils.InsightsRejected:
+        return _respond(api_handlers.INSIGHTS_REJECTED)
+    except insights_utils.InsightsTimeout:
+        return _respond(api_handlers.INSIGHTS_TIMEOUT)
+    except Exception as e:
+        print(f"ERROR in /api/get-insights: {e}")
+        traceback.print_exc()
+        return _respond(api_handlers.INSIGHTS_FAILED)
+
+
+async def prediction_stream(websocket):
+    """Persistent prediction channel (protocol in stream_utils); micro-batches run on the CPU pool."""
+    await websocket.accept()
+    if not mymodel_utils.get_status():
+        await websocket.close(code=1011, reason="Service not ready, initialization failed.")
+        return
+    try:
+        await stream_utils.serve_async(websocket, _cpu.run)
+    except stream_utils.StreamRejected as e:
+        await websocket.close(code=1013, reason=str(e)) # 1013: Try Again Later
+        return
+    except WebSocketDisconnect:
+        return
+    if websocket.client_state == WebSocketState.CONNECTED: # Idle timeout (not a client disconnect)
+        await websocket.close()
+
+
+# --- Lifespan ---
+def _warm_up_http():
+    """One synthetic /api/analyze through the handler before any client request arrives."""
+    water_level = mymodel_utils.WATER_LEVELS_TO_PROCESS[0]
+    body = {"waterLevel": water_level, "wavelengths": mymodel_utils.get_imputation_means(water_level)}
+    _, status = api_handlers.analyze(body)
+    print(f"HTTP warm-up request finished with status {status}.")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _cpu
+    initialization_successful = await run_in_threadpool(mymodel_utils.initialize_application)
+    if not initialization_successful:
+        print("WARNING: Application failed to initialize properly. Endpoints might not work.")
+    insights_utils.configure(os.environ.get("GEMINI_API_KEY"))
+    _cpu = _CPUExecutor(ASGI_PREDICT_WORKERS or mymodel_utils.get_inference_policy()['cpuQuota'], ASGI_PREDICT_MAX_PENDING)
+    print(f"ASGI CPU pool: {_cpu.workers} threads, at most {_cpu.max_pending} pending calls.")
+    if initialization_successful and mymodel_utils.WARMUP_ON_INIT:
+        await _cpu.run(_warm_up_http)
+    # Started after the warm-up so synthetic requests are not audited (or counted as drift)
+    if prediction_log.PREDICTION_LOG_ENABLED:
+        prediction_log.start()
+    if initialization_successful:
+        drift_monitor.start(mymodel_utils.get_drift_reference(), mymodel_utils.SPECTRAL_COLS)
+    yield
+    prediction_log.stop()
+    _cpu.shutdown()
+
+
+routes = [
+    Route('/api/health', health_check, methods=['GET']),
+    Route('/api/live', liveness_check, methods=['GET']),
+    Route('/api/ready', readiness_check, methods=['GET']),
+    Route('/api/analyze', analyze_soil, methods=['POST']),
+    Route('/api/sweep', sweep_soil, methods=['POST']),
+    Route('/api/predictions/recent', get_recent_predictions, methods=['GET']),
+    Route('/api/drift', get_drift, methods=['GET']),
+    WebSocketRoute('/api/stream', prediction_stream),
+    Route('/api/metrics', get_metrics, methods=['GET']),
+    Route('/api/top-wavelengths', get_top_wavelengths, methods=['GET']),
+    Route('/api/get-insights', get_gemini_insights, methods=['POST']),
+    Route('/api/insights/stats', get_insights_stats, methods=['GET']),
+    Route('/api/health/v2', health_check_v2, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=api_handlers.CORS_ORIGINS, allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
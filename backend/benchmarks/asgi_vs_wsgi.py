@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+asgi_vs_wsgi.py: Mixed-load comparison of the two deployments of the same /api/* routes:
+  wsgi  gunicorn + gthread workers serving app:app (Flask)
+  asgi  uvicorn serving asgi_app:app (Starlette; prediction on a bounded CPU pool)
+Each server runs as a subprocess with the stub insights backend (fixed upstream latency,
+response cache off so every insight call goes upstream). Closed-loop client threads then
+send a weighted mix of /api/analyze, /api/metrics and slow /api/get-insights calls for a
+fixed duration; the report shows status codes, latency percentiles per route and
+/api/analyze throughput. Raise --insights-concurrency to let more slow calls in flight at
+once (they hold gunicorn threads while waiting, but no ASGI thread).
+
+Usage (from backend/):
+    python benchmarks/asgi_vs_wsgi.py --clients 32 --duration 20
+    python benchmarks/asgi_vs_wsgi.py --insights-concurrency 16 --insights-queue 16
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(BACKEND_DIR) # Artifact paths are relative to backend/
+
+ANALYZE_BODY = {"waterLevel": 25, "wavelengths": {"410": 700.0, "435": 140.0, "460": 360.0, "485": 100.0}}
+
+
+def server_command(kind, port, args):
+    if kind == 'wsgi':
+        return [sys.executable, '-m', 'gunicorn', 'app:app', '--worker-class', 'gthread',
+                '--workers', str(args.workers), '--threads', str(args.threads),
+                '--bind', f'127.0.0.1:{port}', '--timeout', '120']
+    return [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--workers', str(args.workers),
+            '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log']
+
+
+def start_server(kind, port, args):
+    import requests
+    env = dict(os.environ,
+               INSIGHTS_BACKEND='stub',
+               INSIGHTS_STUB_LATENCY_SECONDS=str(args.insights_latency),
+               INSIGHTS_CACHE_SIZE='0',
+               INSIGHTS_MAX_CONCURRENCY=str(args.insights_concurrency),
+               INSIGHTS_MAX_QUEUE=str(args.insights_queue),
+               PREDICTION_LOG_ENABLED='false')
+    process = subprocess.Popen(server_command(kind, port, args), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 180
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with code {process.returncode}")
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/api/ready', timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not become ready")
+
+
+def run_load(base, args):
+    """Closed-loop clients; returns {route: [(status, latency_s), ...]} and the wall time."""
+    import requests
+    routes = [('/api/analyze', args.analyze_weight), ('/api/metrics', args.metrics_weight),
+              ('/api/get-insights', args.insights_weight)]
+    paths = [path for path, _ in routes]
+    weights = np.array([weight for _, weight in routes], dtype=float)
+    weights /= weights.sum()
+    results = defaultdict(list)
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + args.duration
+
+    def client(seed):
+        rng = np.random.default_rng(seed)
+        local = defaultdict(list)
+        with requests.Session() as session:
+            i = 0
+            while time.perf_counter() < stop_at:
+                path = paths[rng.choice(len(paths), p=weights)]
+                start = time.perf_counter()
+                try:
+                    if path == '/api/analyze':
+                        status = session.post(base + path, json=ANALYZE_BODY, timeout=60).status_code
+                    elif path == '/api/metrics':
+                        status = session.get(base + path, timeout=60).status_code
+                    else: # Unique prompts so every call goes upstream
+                        status = session.post(base + path, json={"message": f"Soil advice {seed}-{i}"}, timeout=60).status_code
+                except requests.RequestException:
+                    status = 'conn-error'
+                local[path].append((status, time.perf_counter() - start))
+                i += 1
+        with lock:
+            for path, items in local.items():
+                results[path].extend(items)
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def report(kind, results, wall):
+    print(f"\n[{kind}] wall {wall:.1f}s")
+    print(f"  {'route':<20} {'n':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  status codes")
+    for path in ('/api/analyze', '/api/metrics', '/api/get-insights'):
+        items = results.get(path, [])
+        if not items:
+            continue
+        latencies = np.array([latency for _, latency in items]) * 1000
+        codes = Counter(status for status, _ in items)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"  {path:<20} {len(items):>6} {len(items) / wall:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}  {dict(codes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'])
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for both servers.")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn --threads per worker (wsgi only).")
+    parser.add_argument('--clients', type=int, default=32, help="Concurrent closed-loop clients.")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds of load per server.")
+    parser.add_argument('--analyze-weight', type=float, default=0.85)
+    parser.add_argument('--metrics-weight', type=float, default=0.05)
+    parser.add_argument('--insights-weight', type=float, default=0.10)
+    parser.add_argument('--insights-latency', type=float, default=2.0, help="Stub upstream latency (s).")
+    parser.add_argument('--insights-concurrency', type=int, default=4, help="INSIGHTS_MAX_CONCURRENCY for both servers.")
+    parser.add_argument('--insights-queue', type=int, default=2, help="INSIGHTS_MAX_QUEUE for both servers.")
+    parser.add_argument('--port', type=int, default=5088)
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients for {args.duration:.0f}s; mix analyze/metrics/insights = "
+          f"{args.analyze_weight}/{args.metrics_weight}/{args.insights_weight}; stub insight latency "
+          f"{args.insights_latency}s, insights concurrency {args.insights_concurrency} + queue {args.insights_queue}; "
+          f"{args.workers} worker(s), gunicorn threads {args.threads}; {os.cpu_count()} CPUs")
+    for i, kind in enumerate(args.servers):
+        port = args.port + i
+        process = start_server(kind, port, args)
+        try:
+            results, wall = run_load(f'http://127.0.0.1:{port}', args)
+        finally:
+            process.terminate()
+            process.wait(30)
+        report(kind, results, wall)
+
+
+if __name__ == '__main__':
+    main()
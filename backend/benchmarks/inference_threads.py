@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+inference_threads.py: Latency/throughput of the inference threading policy in mymodel_utils.
+Measures run_prediction_batch (all 8 targets) for:
+  1. single-row latency per num_threads setting, with 1 and N concurrent request threads
+     (N request threads x OpenMP threads is the oversubscription seen in gthread workers);
+  2. batch throughput per num_threads setting and batch size;
+  3. batch throughput with the 8 targets dispatched on the shared pool.
+num_threads=0 is LightGBM's default (one OpenMP thread per core).
+
+Usage (from backend/):
+    python benchmarks/inference_threads.py --request-threads 8
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(BACKEND_DIR) # Artifact paths are relative to backend/
+
+import mymodel_utils
+
+WATER_LEVEL = 25
+
+
+def make_rows(n_rows, rng):
+    """Full-band rows around the imputation means (no reduced variants involved)."""
+    means = np.array([mymodel_utils._imputation_values[WATER_LEVEL][col] for col in mymodel_utils.SPECTRAL_COLS])
+    return means * rng.uniform(0.8, 1.2, size=(n_rows, len(means)))
+
+
+def say(text=""):
+    print(text, file=sys.__stdout__, flush=True)
+
+
+def predict(rows, present):
+    return mymodel_utils.run_prediction_batch(rows, present, mymodel_utils.SPECTRAL_COLS, WATER_LEVEL)
+
+
+def set_policy(threads_single, threads_batch, pool_min_rows=0):
+    mymodel_utils.INFERENCE_THREADS_SINGLE = threads_single
+    mymodel_utils.INFERENCE_THREADS_BATCH = threads_batch
+    mymodel_utils.INFERENCE_TARGET_POOL_MIN_ROWS = pool_min_rows
+
+
+def single_row_latency(rows, present, request_threads):
+    """Per-request latencies (ms) for single-row predictions from request_threads concurrent callers."""
+    def one(i):
+        start = time.perf_counter()
+        predict(rows[i:i + 1], present)
+        return (time.perf_counter() - start) * 1000
+    with ThreadPoolExecutor(max_workers=request_threads) as pool:
+        latencies = np.array(list(pool.map(one, range(len(rows)))))
+    return np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def batch_throughput(rows, present, repeats):
+    predict(rows, present) # Warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict(rows, present)
+    return len(rows) * repeats / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--request-threads', type=int, default=8, help="Concurrent request threads (gunicorn --threads).")
+    parser.add_argument('--requests', type=int, default=400, help="Single-row predictions per setting.")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 256, 4096, 32768])
+    args = parser.parse_args()
+
+    # Per-request logging is not what is being measured (redirect_stdout is process-wide, so set it once)
+    sys.stdout = open(os.devnull, 'w')
+    mymodel_utils.initialize_application()
+    quota = mymodel_utils._cpu_quota()
+    thread_settings = sorted({0, 1, 2, quota})
+    rng = np.random.default_rng(0)
+    present = np.ones(len(mymodel_utils.SPECTRAL_COLS), dtype=bool)
+    rows = make_rows(args.requests, rng)
+    say(f"CPU quota: {quota} cores. Policy defaults: {mymodel_utils.get_inference_policy()}")
+
+    say("\n1. Single-row latency (ms, p50 / p95)")
+    say(f"  {'num_threads':>11}  {'1 request thread':>18}  {args.request_threads:>2} request threads")
+    for threads in thread_settings:
+        set_policy(threads, threads)
+        predict(rows[:1], present) # Warm-up
+        p50_1, p95_1 = single_row_latency(rows, present, 1)
+        p50_n, p95_n = single_row_latency(rows, present, args.request_threads)
+        say(f"  {threads:>11}  {p50_1:7.2f} / {p95_1:7.2f}  {p50_n:7.2f} / {p95_n:7.2f}")
+
+    say("\n2. Batch throughput (rows/s), one request thread")
+    say(f"  {'num_threads':>11}" + "".join(f"{size:>12}" for size in args.batch_sizes))
+    batches = {size: make_rows(size, rng) for size in args.batch_sizes}
+    for threads in thread_settings:
+        set_policy(threads, threads)
+        rates = [batch_throughput(batches[size], present, max(1, 20000 // size)) for size in args.batch_sizes]
+        say(f"  {threads:>11}" + "".join(f"{rate:>12.0f}" for rate in rates))
+
+    say("\n3. Batch throughput (rows/s) with per-target dispatch on the shared pool (num_threads=1 per booster)")
+    say(f"  {'pool':>11}" + "".join(f"{size:>12}" for size in args.batch_sizes))
+    set_policy(1, quota, pool_min_rows=1)
+    rates = [batch_throughput(batches[size], present, max(1, 20000 // size)) for size in args.batch_sizes]
+    say(f"  {'on':>11}" + "".join(f"{rate:>12.0f}" for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
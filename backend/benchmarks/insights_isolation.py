@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+insights_isolation.py: Offline load test for latency isolation between
+/api/get-insights and /api/analyze.
+Runs the Flask app in-process with the stub insights backend and a fixed pool of
+request threads (like one gunicorn gthread worker), sends a mix of slow insight
+calls and prediction calls, and reports /api/analyze latency and insight status codes.
+
+Usage (from backend/):
+    python benchmarks/insights_isolation.py --threads 8 --insights 40 --analyze 200
+"""
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(BACKEND_DIR) # Artifact paths are relative to backend/
+os.environ.setdefault("INSIGHTS_BACKEND", "stub")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help="Request threads (gunicorn --threads).")
+    parser.add_argument('--insights', type=int, default=40, help="Number of /api/get-insights calls.")
+    parser.add_argument('--analyze', type=int, default=200, help="Number of /api/analyze calls.")
+    parser.add_argument('--stream', action='store_true', help="Use server-sent-event streaming for insights.")
+    args = parser.parse_args()
+
+    import app as flask_app # Initializes models and the insights backend
+    client_app = flask_app.app
+    analyze_body = {"waterLevel": 25, "wavelengths": {"410": 700.0, "435": 140.0, "460": 360.0, "485": 100.0}}
+    insights_body = {"message": "Soil readings: pH 7.1, nitrogen 0.02. Give agronomic advice.", "stream": args.stream}
+
+    def call(path, body):
+        with client_app.test_client() as client:
+            start = time.perf_counter()
+            response = client.post(path, json=body)
+            if args.stream and path == '/api/get-insights':
+                response.get_data() # Drain the stream
+            return path, response.status_code, time.perf_counter() - start
+
+    # Interleave requests so insight calls arrive throughout the prediction traffic
+    jobs = [('/api/get-insights', insights_body)] * args.insights + [('/api/analyze', analyze_body)] * args.analyze
+    order = np.random.default_rng(0).permutation(len(jobs))
+
+    print(f"Running {len(jobs)} requests on {args.threads} threads "
+          f"(stub latency {flask_app.insights_utils.STUB_LATENCY_SECONDS}s, "
+          f"insights concurrency {flask_app.insights_utils.INSIGHTS_MAX_CONCURRENCY}, "
+          f"queue {flask_app.insights_utils.INSIGHTS_MAX_QUEUE})...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(lambda i: call(*jobs[i]), order))
+    wall = time.perf_counter() - start
+
+    analyze_latencies = np.array([t for path, _, t in results if path == '/api/analyze']) * 1000
+    insight_codes = Counter(code for path, code, _ in results if path == '/api/get-insights')
+    analyze_codes = Counter(code for path, code, _ in results if path == '/api/analyze')
+    print(f"Wall time: {wall:.2f}s")
+    print(f"/api/analyze status codes: {dict(analyze_codes)}")
+    print(f"/api/analyze latency ms: p50={np.percentile(analyze_latencies, 50):.1f} "
+          f"p95={np.percentile(analyze_latencies, 95):.1f} max={analyze_latencies.max():.1f}")
+    print(f"/api/get-insights status codes: {dict(insight_codes)}")
+    print(f"Insights executor stats: {flask_app.insights_utils.get_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+stream_throughput.py: Compares per-sample HTTP calls to /api/analyze with one
+persistent /api/stream WebSocket for a continuous sensor feed.
+Serves the Flask app on a local threaded Werkzeug server and sends the same readings
+(a) as one HTTP request each on a new connection, (b) over a keep-alive HTTP session,
+and (c) over a WebSocket, both one-at-a-time and pipelined (so micro-batching kicks in).
+
+Usage (from backend/):
+    python benchmarks/stream_throughput.py --readings 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(BACKEND_DIR) # Artifact paths are relative to backend/
+
+BANDS = ["410", "435", "460", "485"]
+WATER_LEVEL = 25
+
+
+def report(label, n, elapsed):
+    print(f"  {label:<38} {elapsed:7.2f}s  {n / elapsed:8.1f} readings/s  {1000 * elapsed / n:6.2f} ms/reading")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readings', type=int, default=500, help="Readings sent per mode.")
+    parser.add_argument('--port', type=int, default=5077)
+    args = parser.parse_args()
+
+    import requests
+    import simple_websocket
+    from werkzeug.serving import make_server
+    import app as flask_app # Initializes models
+
+    server = make_server('127.0.0.1', args.port, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{args.port}"
+
+    readings = np.random.default_rng(0).uniform([600, 100, 300, 80], [800, 200, 400, 150], size=(args.readings, len(BANDS)))
+    n = len(readings)
+    print(f"Sending {n} readings per mode ({len(BANDS)} bands, WL {WATER_LEVEL})...")
+
+    def body(row):
+        return {"waterLevel": WATER_LEVEL, "wavelengths": dict(zip(BANDS, row.tolist()))}
+
+    start = time.perf_counter()
+    for row in readings:
+        requests.post(f"{base}/api/analyze", json=body(row)).raise_for_status()
+    report("HTTP, new connection per reading", n, time.perf_counter() - start)
+
+    with requests.Session() as session:
+        start = time.perf_counter()
+        for row in readings:
+            session.post(f"{base}/api/analyze", json=body(row)).raise_for_status()
+        report("HTTP keep-alive session", n, time.perf_counter() - start)
+
+    def open_stream():
+        ws = simple_websocket.Client.connect(f"ws://127.0.0.1:{args.port}/api/stream")
+        ws.send(json.dumps({"type": "config", "waterLevel": WATER_LEVEL, "bands": BANDS}))
+        assert json.loads(ws.receive())["type"] == "ready"
+        return ws
+
+    def reading(i, row):
+        return json.dumps({"type": "reading", "id": i, "values": row.tolist()})
+
+    ws = open_stream()
+    start = time.perf_counter()
+    for i, row in enumerate(readings):
+        ws.send(reading(i, row))
+        assert json.loads(ws.receive())["id"] == i
+    report("WebSocket, one reading in flight", n, time.perf_counter() - start)
+    ws.close()
+
+    ws = open_stream()
+    start = time.perf_counter()
+    for i, row in enumerate(readings):
+        ws.send(reading(i, row))
+    replies = [json.loads(ws.receive()) for _ in range(n)]
+    report("WebSocket, pipelined (micro-batched)", n, time.perf_counter() - start)
+    ws.close()
+    assert [reply["id"] for reply in replies] == list(range(n))
+
+    print(f"Stream stats: {flask_app.stream_utils.get_stats()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,4 @@
 pip install -r requirements.txt
-apt-get install build-essentials
\ No newline at end of file
+apt-get install build-essentials
+# Serving bundle: memory-mapped models/scalers/imputation, so workers boot without loading the pickles
+python mymodel_utils.py --export-bundle
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+drift_monitor.py: Streaming input-drift monitor for the prediction path.
+Every prediction updates fixed-size histograms (one per band and water level) whose bin edges
+are the reference quantiles of that band in the training data (modified_dataset.csv), plus one
+underflow and one overflow bin for readings outside the reference range. Memory is constant
+and an update is one comparison against each band's edges, so the monitor stays on in production.
+
+Readings go into a 'current' window; once it holds DRIFT_WINDOW readings it becomes the
+'previous' window and a new one starts. Recent scores cover both windows (the last
+DRIFT_WINDOW..2*DRIFT_WINDOW readings); lifetime scores cover everything since start().
+
+Scores per band (see get_drift_scores):
+  psi          population stability index of the window versus the reference histogram
+  outOfRange   fraction of readings outside the reference [min, max]
+  medianShift  (window median - reference median) / reference IQR, medians interpolated from the bins
+  missingRate  fraction of predictions in which the band was not provided (imputed)
+"""
+
+import os
+import time
+import threading
+
+import numpy as np
+
+# --- Configuration (environment overridable) ---
+DRIFT_MONITOR_ENABLED = os.environ.get("DRIFT_MONITOR_ENABLED", "true").lower() in ("1", "true", "yes")
+DRIFT_WINDOW = int(os.environ.get("DRIFT_WINDOW", 5000)) # Readings per rotating window
+DRIFT_MIN_SAMPLES = int(os.environ.get("DRIFT_MIN_SAMPLES", 300)) # Fewer readings in a band -> no score
+DRIFT_PSI_WARN = float(os.environ.get("DRIFT_PSI_WARN", 0.1)) # Common PSI rule of thumb: < 0.1 stable
+DRIFT_PSI_ALERT = float(os.environ.get("DRIFT_PSI_ALERT", 0.25)) # >= 0.25 significant shift
+# Quantile bins per band in the reference sketch. Under no drift PSI is roughly
+# (bins - 1) * (1/window readings + 1/reference rows); with ~520 rows per water level,
+# 10 bins keep that noise floor well below DRIFT_PSI_WARN.
+REFERENCE_BINS = 10
+_PSI_EPSILON = 1e-4 # Floor for empty-bin proportions (PSI is undefined at 0)
+WINDOWS = ["recent", "lifetime"]
+
+
+# --- Reference sketches (built at training time, persisted by mymodel_utils) ---
+# Sketch layout per band: [below range, bins..., above range, missing], i.e. bins + 3 counters.
+def build_reference(values, bins=REFERENCE_BINS):
+    """
+    Reference sketch for one water level from raw training inputs (n_rows, n_bands).
+    Returns {'edges': (n_bands, bins + 1), 'counts': (n_bands, bins + 3), 'median', 'iqr'}.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.nanquantile(values, np.linspace(0, 1, bins + 1), axis=0).T
+    # Readings equal to the reference maximum belong to the last in-range bin
+    edges[:, -1] = np.nextafter(edges[:, -1], np.inf)
+    width = bins + 3
+    counts = np.bincount(_slots(edges, values, ~np.isnan(values)), minlength=values.shape[1] * width)
+    q25, median, q75 = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0)
+    return {'edges': edges, 'counts': counts.reshape(-1, width), 'median': median, 'iqr': q75 - q25}
+
+
+def _slots(edges, values, present):
+    """Flat counter index (band * width + slot) for every (row, band) of values (n_rows, n_bands)."""
+    n_bands, n_edges = edges.shape
+    width = n_edges + 2
+    # Number of edges <= value: 0 = below range, n_edges = above range; absent bands count as missing
+    slots = (np.nan_to_num(values)[:, :, None] >= edges[None, :, :]).sum(axis=2)
+    slots[~present] = width - 1
+    return (slots + np.arange(n_bands) * width).ravel()
+
+
+# --- Streaming state ---
+class _WaterLevelSketch:
+    """Current/previous/lifetime counters for one water level (flat views of the sketch layout)."""
+
+    def __init__(self, reference):
+        self.reference = reference
+        self.lock = threading.Lock()
+        self.shape = reference['counts'].shape
+        self.current = np.zeros(reference['counts'].size, dtype=np.int64)
+        self.previous = np.zeros_like(self.current)
+        self.lifetime = np.zeros_like(self.current)
+        self.readings = [0, 0, 0] # current, previous, lifetime
+
+    def observe(self, values, present):
+        slots = _slots(self.reference['edges'], values, present)
+        n_rows = len(values)
+        if n_rows > 1: # Rows repeat slots, so fancy-index += would drop counts
+            update = np.bincount(slots, minlength=self.current.size)
+        with self.lock:
+            if self.readings[0] >= DRIFT_WINDOW:
+                self.previous, self.current = self.current, self.previous
+                self.current[:] = 0
+                self.readings[1], self.readings[0] = self.readings[0], 0
+            if n_rows > 1:
+                self.current += update
+                self.lifetime += update
+            else:
+                self.current[slots] += 1
+                self.lifetime[slots] += 1
+            self.readings[0] += n_rows
+            self.readings[2] += n_rows
+
+    def snapshot(self, window):
+        """(counts in the sketch layout, readings) for 'recent' or 'lifetime'."""
+        with self.lock:
+            if window == 'lifetime':
+                return self.lifetime.reshape(self.shape).copy(), self.readings[2]
+            return (self.current + self.previous).reshape(self.shape), self.readings[0] + self.readings[1]
+
+
+_sketches = {} # water level -> _WaterLevelSketch
+_features = []
+_started = False
+_stats_lock = threading.Lock()
+_stats = {"observed": 0, "unmonitored": 0, "errors": 0}
+_last_error_warning = 0.0
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def is_enabled():
+    return _started
+
+
+def start(reference, features):
+    """Starts monitoring with reference sketches {water level: build_reference(...)}. Returns True if started."""
+    global _sketches, _features, _started
+    if not DRIFT_MONITOR_ENABLED:
+        return False
+    if not reference:
+        print("Warning: Drift monitor disabled, no reference sketches available.")
+        return False
+    _sketches = {wl: _WaterLevelSketch(ref) for wl, ref in reference.items()}
+    _features = list(features)
+    _started = True
+    print(f"Drift monitor started for water levels {sorted(_sketches)} (window {DRIFT_WINDOW} readings).")
+    return True
+
+
+def observe(water_level, values, present):
+    """
+    Adds one reading (values/present 1-D, as parsed by api_schemas) or a batch (values 2-D, present
+    1-D shared by all rows or 2-D) to the sketches. Never raises.
+    """
+    global _last_error_warning
+    if not _started:
+        return
+    sketch = _sketches.get(water_level)
+    if sketch is None:
+        _count("unmonitored")
+        return
+    try:
+        values = np.atleast_2d(values)
+        present = present & ~np.isnan(values) # present broadcasts over rows
+        sketch.observe(values, present)
+        _count("observed", len(values))
+    except Exception as e:
+        _count("errors")
+        now = time.monotonic()
+        if now - _last_error_warning > 10: # Rate-limited so a bad input shape does not flood the log
+            _last_error_warning = now
+            print(f"Warning: Drift monitor update failed: {e}")
+
+
+def _band_scores(reference, counts, readings):
+    missing, counts = counts[:, -1], counts[:, :-1]
+    ref_counts = reference['counts'][:, :-1]
+    band_totals = counts.sum(axis=1)
+    ref_props = np.maximum(ref_counts / ref_counts.sum(axis=1, keepdims=True), _PSI_EPSILON)
+    props = np.maximum(counts / np.maximum(band_totals, 1)[:, None], _PSI_EPSILON)
+    psi = ((props - ref_props) * np.log(props / ref_props)).sum(axis=1)
+    out_of_range = (counts[:, 0] + counts[:, -1]) / np.maximum(band_totals, 1)
+
+    # Window median from the histogram: interpolate the CDF at the reference bin edges
+    edges = reference['edges']
+    cdf = np.cumsum(counts[:, :-1], axis=1) / np.maximum(band_totals, 1)[:, None]
+    medians = np.array([np.interp(0.5, cdf[b], edges[b]) for b in range(len(edges))])
+    iqr = np.where(reference['iqr'] > 0, reference['iqr'], 1.0)
+    median_shift = (medians - reference['median']) / iqr
+
+    scores = {}
+    for b, feature in enumerate(_features):
+        enough = band_totals[b] >= DRIFT_MIN_SAMPLES
+        scores[feature] = {
+            "samples": int(band_totals[b]),
+            "psi": round(float(psi[b]), 4) if enough else None,
+            "outOfRange": round(float(out_of_range[b]), 4) if enough else None,
+            "medianShift": round(float(median_shift[b]), 4) if enough else None,
+            "missingRate": round(float(missing[b] / readings), 4) if readings else None,
+        }
+    return scores
+
+
+def _status(max_psi):
+    if max_psi is None:
+        return "insufficient_data"
+    if max_psi >= DRIFT_PSI_ALERT:
+        return "drift"
+    if max_psi >= DRIFT_PSI_WARN:
+        return "warn"
+    return "ok"
+
+
+def get_drift_scores(water_level=None, window='recent'):
+    """Drift scores per water level (all monitored levels if water_level is None)."""
+    water_levels = sorted(_sketches) if water_level is None else [water_level]
+    result = {}
+    for wl in water_levels:
+        sketch = _sketches[wl]
+        counts, readings = sketch.snapshot(window)
+        bands = _band_scores(sketch.reference, counts, readings)
+        scored = {feature: band["psi"] for feature, band in bands.items() if band["psi"] is not None}
+        max_psi = max(scored.values()) if scored else None
+        result[str(wl)] = {
+            "status": _status(max_psi),
+            "readings": readings,
+            "maxPsi": max_psi,
+            "meanPsi": round(float(np.mean(list(scored.values()))), 4) if scored else None,
+            "mostDriftedBands": sorted(scored, key=scored.get, reverse=True)[:5],
+            "bands": bands,
+        }
+    return result
+
+
+def is_monitored(water_level):
+    return water_level in _sketches
+
+
+def get_stats():
+    """Snapshot of monitor counters (for /api/health/v2)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["enabled"] = is_enabled()
+    stats["window"] = DRIFT_WINDOW
+    stats["status"] = {wl: scores["status"] for wl, scores in get_drift_scores().items()} if _started else {}
+    return stats
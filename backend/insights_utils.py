@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+insights_utils.py: LLM insight generation for the Flask and ASGI apps.
+Runs upstream calls on a bounded thread pool with per-call timeouts and fast
+rejection when the queue is full, so slow insight calls cannot pin the workers
+that serve prediction traffic. A local stub backend stands in for Gemini
+for offline load testing (INSIGHTS_BACKEND=stub).
+Responses are cached by normalized prompt (LRU + TTL, optionally on disk) and
+concurrent identical prompts share one upstream call. generate_async/stream_async
+let asgi_app.py await the same calls on its event loop instead of blocking a thread.
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import tempfile
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# --- Configuration (environment overridable) ---
+INSIGHTS_BACKEND = os.environ.get("INSIGHTS_BACKEND", "gemini") # 'gemini' or 'stub'
+GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest")
+INSIGHTS_MAX_CONCURRENCY = int(os.environ.get("INSIGHTS_MAX_CONCURRENCY", 4)) # Upstream calls in flight
+INSIGHTS_MAX_QUEUE = int(os.environ.get("INSIGHTS_MAX_QUEUE", 2)) # Calls allowed to wait for a free slot
+# Keep INSIGHTS_MAX_CONCURRENCY + INSIGHTS_MAX_QUEUE below the request threads per worker so
+# waiting insight calls can never occupy every thread that serves /api/analyze.
+INSIGHTS_TIMEOUT_SECONDS = float(os.environ.get("INSIGHTS_TIMEOUT_SECONDS", 30))
+STUB_LATENCY_SECONDS = float(os.environ.get("INSIGHTS_STUB_LATENCY_SECONDS", 2.0))
+STUB_STREAM_CHUNKS = 5
+INSIGHTS_CACHE_SIZE = int(os.environ.get("INSIGHTS_CACHE_SIZE", 256)) # LRU bound (0 disables caching)
+INSIGHTS_CACHE_TTL_SECONDS = float(os.environ.get("INSIGHTS_CACHE_TTL_SECONDS", 6 * 3600))
+INSIGHTS_CACHE_FILE = os.environ.get("INSIGHTS_CACHE_FILE") # Optional JSON file to persist the cache across restarts
+INSIGHTS_CACHE_SAVE_DELAY_SECONDS = float(os.environ.get("INSIGHTS_CACHE_SAVE_DELAY_SECONDS", 5.0)) # Puts within this window share one file write
+LATENCY_WINDOW = 256 # Recent upstream latencies kept for percentiles
+
+
+class InsightsRejected(Exception):
+    """Raised when the insights queue is full (caller should answer 429)."""
+
+
+class InsightsTimeout(Exception):
+    """Raised when an upstream call exceeds its timeout (caller should answer 504)."""
+
+
+# --- Backends ---
+class GeminiBackend:
+    """Google Gemini backend."""
+    name = "gemini"
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL_NAME):
+        import google.generativeai as genai # Imported lazily so the stub backend works without it
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt, timeout):
+        response = self._model.generate_content(prompt, request_options={"timeout": timeout})
+        return response.text if response and hasattr(response, 'text') else None
+
+    def stream(self, prompt, timeout):
+        response = self._model.generate_content(prompt, stream=True, request_options={"timeout": timeout})
+        for chunk in response:
+            if getattr(chunk, 'text', None):
+                yield chunk.text
+
+
+class StubBackend:
+    """Offline stand-in for Gemini: sleeps for a fixed latency and returns canned text."""
+    name = "stub"
+
+    def __init__(self, latency_seconds=STUB_LATENCY_SECONDS):
+        self.latency_seconds = latency_seconds
+
+    def _text(self, prompt):
+        return f"[stub insight] Soil summary for prompt of {len(prompt)} characters: values look within typical ranges."
+
+    def generate(self, prompt, timeout):
+        time.sleep(self.latency_seconds)
+        return self._text(prompt)
+
+    def stream(self, prompt, timeout):
+        words = self._text(prompt).split(' ')
+        step = max(1, len(words) // STUB_STREAM_CHUNKS)
+        for i in range(0, len(words), step):
+            time.sleep(self.latency_seconds / STUB_STREAM_CHUNKS)
+            yield ' '.join(words[i:i + step]) + ' '
+
+
+# --- Response Cache ---
+class ResponseCache:
+    """
+    Thread-safe LRU cache with per-entry TTL and optional JSON persistence. Saves are debounced
+    (one write per INSIGHTS_CACHE_SAVE_DELAY_SECONDS, from a timer thread) and serialized, and each
+    write goes through a uniquely named temp file, so processes sharing the file never truncate each
+    other's writes (the last complete snapshot wins).
+    """
+
+    def __init__(self, max_size=INSIGHTS_CACHE_SIZE, ttl_seconds=INSIGHTS_CACHE_TTL_SECONDS, path=INSIGHTS_CACHE_FILE,
+                 save_delay_seconds=INSIGHTS_CACHE_SAVE_DELAY_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.save_delay_seconds = save_delay_seconds
+        self._entries = OrderedDict() # key -> (text, expires_at)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock() # One writer at a time; the snapshot is taken while holding it
+        self._save_timer = None # Pending debounced save
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, text):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (text, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self.path and self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay_seconds, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def flush(self):
+        """Writes pending changes now (called by the debounce timer and at exit)."""
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is None:
+                    return
+                self._save_timer.cancel() # No-op when called from the timer itself
+                self._save_timer = None
+                snapshot = list(self._entries.items())
+            self._save(snapshot)
+
+    def _save(self, snapshot):
+        tmp_path = None
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix=os.path.basename(self.path) + '.', suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                json.dump([[key, text, expires_at] for key, (text, expires_at) in snapshot], f)
+            os.replace(tmp_path, self.path) # Atomic swap so readers never see a partial file
+        except Exception as e:
+            print(f"Warning: Failed to persist insights cache: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            now = time.time()
+            with self._lock:
+                for key, text, expires_at in entries[-self.max_size:]:
+                    if expires_at > now:
+                        self._entries[key] = (text, expires_at)
+            print(f"Loaded {len(self._entries)} cached insights from {self.path}.")
+        except Exception as e:
+            print(f"Warning: Failed to load insights cache: {e}")
+
+
+def _prompt_key(prompt):
+    """
+    Hash of the normalized prompt plus the backend identity. Only whitespace is collapsed: case is
+    kept, since prompts differing only in case (pH/PH, mS/ms in the readings) can need different answers.
+    """
+    normalized = re.sub(r'\s+', ' ', prompt).strip()
+    backend_id = f"{_backend.name}:{GEMINI_MODEL_NAME}" if _backend is not None else ""
+    return hashlib.sha256(f"{backend_id}\n{normalized}".encode('utf-8')).hexdigest()
+
+
+# --- Global State ---
+_backend = None
+_executor = ThreadPoolExecutor(max_workers=INSIGHTS_MAX_CONCURRENCY, thread_name_prefix="insights")
+_slots = threading.BoundedSemaphore(INSIGHTS_MAX_CONCURRENCY + INSIGHTS_MAX_QUEUE) # Running + queued calls
+_stats_lock = threading.Lock()
+_stats = {"accepted": 0, "rejected": 0, "timeouts": 0, "errors": 0, "inFlight": 0,
+          "cacheHits": 0, "cacheMisses": 0, "coalesced": 0, "upstreamCalls": 0}
+_upstream_latencies = deque(maxlen=LATENCY_WINDOW)
+_cache = ResponseCache()
+atexit.register(_cache.flush) # Persist puts still inside the debounce window
+_inflight = {} # prompt key -> Future shared by concurrent identical requests (single-flight)
+_inflight_streams = {} # prompt key -> _StreamFlight shared by concurrent identical streaming requests
+_inflight_lock = threading.RLock() # Re-entrant: a done callback may run inline if the call already finished
+_STREAM_DONE = object()
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def configure(api_key=None):
+    """Selects and initializes the insights backend. Returns True if a backend is available."""
+    global _backend
+    try:
+        if INSIGHTS_BACKEND == "stub":
+            _backend = StubBackend()
+        elif api_key:
+            _backend = GeminiBackend(api_key)
+        else:
+            print("WARNING: GEMINI_API_KEY not found in environment variables. /api/get-insights endpoint will not work.")
+            _backend = None
+            return False
+        print(f"Insights backend configured: {_backend.name} "
+              f"(concurrency {INSIGHTS_MAX_CONCURRENCY}, queue {INSIGHTS_MAX_QUEUE}, timeout {INSIGHTS_TIMEOUT_SECONDS}s).")
+        _cache.load()
+        return True
+    except Exception as e:
+        print(f"ERROR: Failed to configure insights backend '{INSIGHTS_BACKEND}': {e}")
+        _backend = None
+        return False
+
+
+def is_configured():
+    return _backend is not None
+
+
+def get_backend_name():
+    return _backend.name if _backend is not None else None
+
+
+def get_stats():
+    """Returns a snapshot of the executor, cache and upstream latency counters."""
+    with _stats_lock:
+        stats = dict(_stats)
+        latencies = sorted(_upstream_latencies)
+    lookups = stats["cacheHits"] + stats["cacheMisses"] + stats["coalesced"]
+    stats["cacheSize"] = len(_cache)
+    stats["cacheHitRate"] = (stats["cacheHits"] + stats["coalesced"]) / lookups if lookups else None
+    if latencies:
+        stats["upstreamLatencyMs"] = {
+            "p50": round(latencies[len(latencies) // 2] * 1000, 1),
+            "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+            "max": round(latencies[-1] * 1000, 1),
+            "window": len(latencies),
+        }
+    return stats
+
+
+def _timed_upstream(fn, *args):
+    """Runs an upstream call on the executor, recording its latency."""
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        with _stats_lock:
+            _stats["upstreamCalls"] += 1
+            _upstream_latencies.append(time.perf_counter() - start)
+
+
+def _submit(fn, *args):
+    """Submits an upstream call, rejecting immediately if all running and queued slots are taken."""
+    if not _slots.acquire(blocking=False):
+        _count("rejected")
+        raise InsightsRejected("Insights service is at capacity.")
+    _count("accepted")
+    _count("inFlight")
+
+    def release(_future):
+        # Slots are freed when the upstream call really finishes, even after a caller timed out
+        _count("inFlight", -1)
+        _slots.release()
+
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        release(None)
+        raise
+    future.add_done_callback(release)
+    return future
+
+
+def _finish_flight(key, future):
+    """Caches a successful response, then retires the in-flight entry (in that order, so no request misses both)."""
+    if not future.cancelled() and future.exception() is None and future.result():
+        _cache.put(key, future.result())
+    with _inflight_lock:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+def _join_flight(prompt, timeout):
+    """Cached text for prompt, or the Future of the upstream call it shares (started if needed)."""
+    key = _prompt_key(prompt)
+    cached = _cache.get(key)
+    if cached is not None:
+        _count("cacheHits")
+        return cached
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is None:
+            future = _submit(_timed_upstream, _backend.generate, prompt, timeout)
+            _inflight[key] = future
+            future.add_done_callback(lambda f: _finish_flight(key, f))
+            _count("cacheMisses")
+        else:
+            _count("coalesced")
+    return future
+
+
+def generate(prompt, timeout=INSIGHTS_TIMEOUT_SECONDS):
+    """
+    Generates a full response. Served from the cache when possible; concurrent identical prompts
+    wait on the same upstream call. Raises InsightsRejected or InsightsTimeout.
+    """
+    future = _join_flight(prompt, timeout)
+    if not isinstance(future, Future):
+        return future
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # The shared call keeps running for other waiters and still fills the cache
+        _count("timeouts")
+        raise InsightsTimeout(f"Insights call exceeded {timeout} seconds.")
+    except Exception:
+        _count("errors")
+        raise
+
+
+async def generate_async(prompt, timeout=INSIGHTS_TIMEOUT_SECONDS):
+    """
+    asyncio counterpart of generate() for the ASGI app: the upstream call still runs on the
+    bounded pool, but the caller awaits it on the event loop instead of blocking a thread.
+    """
+    future = _join_flight(prompt, timeout)
+    if not isinstance(future, Future):
+        return future
+    try:
+        # shield: a timed-out waiter must not cancel the call other waiters share
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+    except asyncio.TimeoutError:
+        _count("timeouts")
+        raise InsightsTimeout(f"Insights call exceeded {timeout} seconds.")
+    except Exception:
+        _count("errors")
+        raise
+
+
+class _StreamFlight:
+    """
+    One streaming upstream call shared by concurrent identical prompts. Each chunk, then
+    _STREAM_DONE (or the exception), goes to every subscriber; late joiners first get the
+    chunks buffered so far.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+        self.end = None # _STREAM_DONE or the exception, once the stream is over
+        self.subscribers = []
+
+    def subscribe(self, put):
+        with self.lock:
+            for chunk in self.parts:
+                put(chunk)
+            if self.end is not None:
+                put(self.end)
+            else:
+                self.subscribers.append(put)
+
+    def unsubscribe(self, put):
+        """Drops a subscriber that gave up (timeout); the shared call keeps running for the others."""
+        with self.lock:
+            if put in self.subscribers:
+                self.subscribers.remove(put)
+
+    def publish(self, item):
+        # put() never blocks (queue.put / call_soon_threadsafe), so fan-out under the lock keeps chunk order
+        with self.lock:
+            if item is _STREAM_DONE or isinstance(item, Exception):
+                self.end = item
+            else:
+                self.parts.append(item)
+            for put in self.subscribers:
+                put(item)
+
+
+def _start_stream(prompt, timeout, put):
+    """
+    Cached text for prompt, or the _StreamFlight (started if needed) that hands each chunk, then
+    _STREAM_DONE (or the exception), to put(). Completed streams fill the cache.
+    """
+    key = _prompt_key(prompt)
+    cached = _cache.get(key)
+    if cached is not None:
+        _count("cacheHits")
+        return cached
+
+    with _inflight_lock:
+        flight = _inflight_streams.get(key)
+        if flight is not None:
+            _count("coalesced")
+            flight.subscribe(put)
+            return flight
+        flight = _StreamFlight()
+
+        def produce():
+            try:
+                for chunk in _backend.stream(prompt, timeout):
+                    flight.publish(chunk)
+                if flight.parts:
+                    _cache.put(key, ''.join(flight.parts))
+                end = _STREAM_DONE
+            except Exception as e:
+                end = e
+            # Cache first, then retire the flight (so no request misses both), then release the subscribers
+            with _inflight_lock:
+                if _inflight_streams.get(key) is flight:
+                    del _inflight_streams[key]
+            flight.publish(end)
+
+        flight.subscribe(put)
+        _submit(_timed_upstream, produce) # Raises InsightsRejected before the flight is registered
+        _inflight_streams[key] = flight
+        _count("cacheMisses")
+    return flight
+
+
+def stream(prompt, timeout=INSIGHTS_TIMEOUT_SECONDS):
+    """
+    Starts (or joins) a streaming call and returns an iterator of text chunks (a cache hit is a
+    single chunk). Admission is decided before returning (InsightsRejected); the iterator raises
+    InsightsTimeout if the whole stream exceeds the timeout. Completed streams fill the cache.
+    """
+    chunks = queue.Queue()
+    flight = _start_stream(prompt, timeout, chunks.put)
+    if not isinstance(flight, _StreamFlight):
+        return iter([flight])
+
+    def iterate():
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise queue.Empty
+                item = chunks.get(timeout=remaining)
+            except queue.Empty:
+                _count("timeouts")
+                flight.unsubscribe(chunks.put)
+                raise InsightsTimeout(f"Insights stream exceeded {timeout} seconds.")
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, Exception):
+                _count("errors")
+                raise item
+            yield item
+
+    return iterate()
+
+
+def stream_async(prompt, timeout=INSIGHTS_TIMEOUT_SECONDS):
+    """
+    asyncio counterpart of stream() (call it on the event loop): returns an async iterator of
+    text chunks fed from the upstream thread, so no thread waits on the stream.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def put(item):
+        loop.call_soon_threadsafe(chunks.put_nowait, item)
+
+    flight = _start_stream(prompt, timeout, put)
+    if not isinstance(flight, _StreamFlight):
+        cached = flight
+
+        async def single():
+            yield cached
+        return single()
+
+    async def iterate():
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                item = await asyncio.wait_for(chunks.get(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                _count("timeouts")
+                flight.unsubscribe(put)
+                raise InsightsTimeout(f"Insights stream exceeded {timeout} seconds.")
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, Exception):
+                _count("errors")
+                raise item
+            yield item
+
+    return iterate()
@@ -13,8 +13,11 @@ import joblib
 import warnings
 import time
 import json
+import hashlib
 from collections import defaultdict
 import threading # For locking during initialization
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 # Scikit-learn
 from sklearn.model_selection import train_test_split, KFold
@@ -25,6 +28,9 @@ from sklearn.preprocessing import StandardScaler
 import lightgbm as lgb
 import optuna
 
+import artifact_bundle
+import drift_monitor
+
 # Reduce verbosity
 warnings.filterwarnings("ignore", category=UserWarning, module='lightgbm')
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -38,8 +44,19 @@ MODEL_SAVE_DIR = os.path.join(BASE_ARTIFACTS_DIR, "models")
 SCALER_SAVE_DIR = os.path.join(BASE_ARTIFACTS_DIR, "scalers")
 IMPUTE_SAVE_DIR = os.path.join(BASE_ARTIFACTS_DIR, "imputation")
 PARAMS_CACHE_FILE = os.path.join(BASE_ARTIFACTS_DIR, "best_params.json") # For Optuna cache
+TUNING_SCHEDULE_FILE = os.path.join(BASE_ARTIFACTS_DIR, "tuning_schedule.json") # Scheduler allocation decisions
 PERFORMANCE_METRICS_FILE = os.path.join(BASE_ARTIFACTS_DIR, "performance_metrics.json") # To store metrics
 FEATURE_RANKING_FILE = os.path.join(BASE_ARTIFACTS_DIR, "feature_rankings.json") # To store rankings
+FEATURE_RANKING_INDEX_FILE = os.path.join(BASE_ARTIFACTS_DIR, "feature_ranking_index.npz") # Per-WL / per-type rankings
+REDUCED_MODEL_SAVE_DIR = os.path.join(MODEL_SAVE_DIR, "reduced") # Top-K band model variants
+REDUCED_VARIANTS_FILE = os.path.join(BASE_ARTIFACTS_DIR, "reduced_variants.json") # Band sets + metrics per variant
+DISTILLED_MODEL_SAVE_DIR = os.path.join(MODEL_SAVE_DIR, "distilled") # Multi-output student per water level
+DISTILLED_STUDENTS_FILE = os.path.join(BASE_ARTIFACTS_DIR, "distilled_students.json") # Student manifest + accuracy gap
+ARTIFACT_BUNDLE_FILE = os.path.join(BASE_ARTIFACTS_DIR, "serving.bundle") # Memory-mapped models/scalers/imputation (artifact_bundle.py)
+DRIFT_REFERENCE_FILE = os.path.join(BASE_ARTIFACTS_DIR, "drift_reference.npz") # Per-band input sketches (drift_monitor.py)
+TEACHER_VERSION_FILE = os.path.join(BASE_ARTIFACTS_DIR, "teacher_version.json") # Cached teacher content hash + size/mtime of the hashed files
+TEACHER_VERSION_DIRS = [MODEL_SAVE_DIR, SCALER_SAVE_DIR, IMPUTE_SAVE_DIR] # Artifacts the bundle holds and reduced variants/students are derived from
+DERIVED_VERSION_DIRS = [REDUCED_MODEL_SAVE_DIR, DISTILLED_MODEL_SAVE_DIR] # Hashed with the teacher version into the artifact version
 
 SPECTRAL_COLS = ['410', '435', '460', '485', '510', '535', '560', '585',
                  '610', '645', '680', '705', '730', '760', '810', '860',
@@ -59,6 +76,76 @@ N_OPTUNA_TRIALS = 50 # Can reduce for faster local testing if needed, e.g., 10
 OPTUNA_CV_FOLDS = 3
 OPTUNA_METRIC_LGBM = 'mae' # Evaluate with MAE during training
 OPTUNA_OPTIMIZE_METRIC = 'rmse' # Optimize for RMSE in objective
+OPTUNA_MULTI_OBJECTIVE = False # Also minimize inference cost and pick a Pareto-optimal trial under OPTUNA_COST_BUDGET
+OPTUNA_COST_METRIC = 'tree_leaves' # Inference cost: 'tree_leaves' (trees x max leaves) or 'latency' (timed single-row predict, us)
+OPTUNA_COST_BUDGET = None # Max inference cost of the selected trial (None = lowest-error Pareto trial)
+FORCE_RETRAIN = False # Train even if artifacts exist on disk
+RETUNE_WITH_CACHE = False # Re-run tuning even if best_params.json exists (e.g. after a data refresh)
+OPTUNA_WARM_START = True # Enqueue cached / neighbouring-WL / global-best params as initial trials
+N_OPTUNA_TRIALS_WARM_START = 15 # Reduced trial budget for warm-started studies
+TUNING_SCHEDULER = False # Tune the whole grid under one global budget instead of N_OPTUNA_TRIALS per study
+TUNING_BUDGET_TRIALS = 400 # Global trial budget for the scheduler (None = unlimited)
+TUNING_BUDGET_SECONDS = None # Global wall-clock budget for the scheduler (None = unlimited)
+SCHEDULER_INITIAL_TRIALS = 5 # Trials every study gets before adaptive allocation
+SCHEDULER_BATCH_TRIALS = 5 # Trials per adaptive allocation
+SCHEDULER_MIN_IMPROVEMENT = 0.002 # Relative CV improvement per batch that counts as "still improving"
+SCHEDULER_PATIENCE = 2 # Consecutive non-improving batches before a study is retired
+OPTUNA_TUNED_PARAMS = ['n_estimators', 'learning_rate', 'num_leaves', 'max_depth', 'lambda_l1', 'lambda_l2',
+                       'feature_fraction', 'bagging_fraction', 'bagging_freq', 'min_child_samples'] # Must match _objective
+
+# Feature importance / ranking index
+IMPORTANCE_TYPES = ['split', 'gain', 'permutation'] # Axis 0 of the ranking index
+COMPUTE_PERMUTATION_IMPORTANCE = True # Permutation importance on the test split (NaN if disabled)
+PERMUTATION_REPEATS = 5
+
+# Bootstrap confidence intervals for the test-split metrics (stored as 'Confidence_Intervals')
+BOOTSTRAP_RESAMPLES = 2000
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_N_JOBS = -1 # joblib threads across (wl, target) combinations (-1 = all cores)
+
+# Final-fit stage: independent (wl, target) fits can run on a process pool while tuning/saving continue.
+# Spawned workers re-import the parent's main script, and app.py initializes at import, so a pool started
+# from the web app would retrain everything in every worker. Fits therefore run inline unless training
+# from the CLI (`python mymodel_utils.py` uses the CPU quota, or --fit-jobs N).
+FINAL_FIT_N_JOBS = 1 # Worker processes (None = CPU quota; 1 = fit inline in this process)
+
+# Reduced-band model variants (top-K bands from feature_rankings.json per target)
+TRAIN_REDUCED_VARIANTS = False # Train variants during initialization if none are found (slow); or run `python mymodel_utils.py --reduced-variants`
+REDUCED_BAND_KS = [4, 6, 8, 12]
+LATENCY_BENCH_REPEATS = 200 # Single-row predict calls timed per model when recording latency
+
+# Distilled multi-output students ('fast' serving mode): a NumPy-evaluated MLP per water level
+# trained on teacher (tuned model) predictions over the training spectra plus synthetic spectra
+TRAIN_DISTILLED_STUDENTS = False # Train students during initialization if none are found; or run `python mymodel_utils.py --distill`
+DISTILL_SYNTHETIC_PER_ROW = 20 # Synthetic spectra sampled around each training row
+DISTILL_NOISE_SCALE = 0.05 # Gaussian noise added to synthetic spectra (in standardized units)
+DISTILL_IMPUTE_PROB = 0.1 # Per-band probability a synthetic band is replaced by its imputation mean (as when served)
+DISTILL_HIDDEN_LAYERS = (128, 128)
+DISTILL_MAX_ITER = 500
+SERVING_MODES = ['full', 'fast'] # 'fast' uses the distilled student when one exists for the water level
+
+# Single-file serving bundle: tuned models (as contiguous tree arrays), scalers and imputation means in one
+# memory-mapped file, so startup skips the pickles and worker processes share the pages
+SERVE_FROM_BUNDLE = True # Serve from ARTIFACT_BUNDLE_FILE when it exists and matches the content of the artifact files on disk
+# Export at build time (build.sh runs `python mymodel_utils.py --export-bundle`). Auto-export writes a missing/stale
+# bundle in the background after loading the pickles, in every worker process, so it is off by default.
+BUNDLE_AUTO_EXPORT = False
+BUNDLE_LEAF_DTYPE = 'float64' # 'int16' / 'float16' quantize leaf values ('float64' keeps predictions identical to LightGBM)
+BUNDLE_MAX_LEAF_ERROR = 0.0005 # Worst-case prediction error allowed per quantized target (half the finest output rounding)
+BUNDLE_NATIVE_MIN_ROWS = 4 # Batches this large use the LightGBM booster (its pickle loaded on first use) for exact targets
+
+# Inference threading policy (LightGBM otherwise uses one OpenMP thread per core on every predict,
+# which oversubscribes multi-threaded gunicorn workers). See benchmarks/inference_threads.py.
+INFERENCE_CPU_QUOTA = int(os.environ.get("INFERENCE_CPU_QUOTA", 0)) or None # Cores per worker (None = detect affinity/cgroup quota)
+INFERENCE_THREADS_SINGLE = int(os.environ.get("INFERENCE_THREADS_SINGLE", 1)) # num_threads for small inputs (thread startup dominates)
+INFERENCE_THREADS_BATCH = int(os.environ.get("INFERENCE_THREADS_BATCH", 0)) or None # num_threads for batches (None = CPU quota)
+INFERENCE_BATCH_MIN_ROWS = int(os.environ.get("INFERENCE_BATCH_MIN_ROWS", 256)) # Rows at which INFERENCE_THREADS_BATCH applies
+INFERENCE_TARGET_POOL_MIN_ROWS = int(os.environ.get("INFERENCE_TARGET_POOL_MIN_ROWS", 0)) # Rows at which the 8 targets run on the shared pool (0 = never)
+
+# Startup warm-up (readiness is reported only after it finishes)
+WARMUP_ON_INIT = True # Run representative predictions through every loaded model after initialization
+WARMUP_IN_BACKGROUND = True # Warm up on a background thread so liveness checks answer meanwhile
+WARMUP_ROUNDS = 3 # Warm single-row predictions timed per model after the first (cold) call
 
 # --- Global State (managed by Flask app, passed into functions) ---
 # These will hold the loaded artifacts after initialization
@@ -67,9 +154,20 @@ _imputation_values = {}
 _tuned_models = defaultdict(dict)
 _performance_metrics = {}
 _feature_rankings = {} # Structure: {target: [{'rank': 1, 'wavelength': 'X', 'importanceScore': Y}, ...]}
+_ranking_index = {} # Structure: see _build_ranking_index
+_reduced_variants = defaultdict(dict) # Structure: {wl: {target: [(k, bands, col_idx, model), ...]}} sorted by k
+_distilled_students = {} # Structure: {wl: {'weights': [...], 'biases': [...], 'y_mean', 'y_scale', 'targets': [...]}}
+_drift_reference = {} # Structure: {wl: drift_monitor.build_reference(...)}
 
 _is_initialized = False
 _init_lock = threading.Lock()
+_artifact_version = None # Short content hash of the serving artifacts (teacher version + reduced variants, students)
+_teacher_version = None # Short content hash of the tuned models, scalers and imputation (recorded in derived manifests)
+_is_ready = False # Initialized and warmed up (readiness probe)
+_warmup_report = {'status': 'pending'}
+_artifact_bundle = None # artifact_bundle.ArtifactBundle when serving from ARTIFACT_BUNDLE_FILE
+_target_pool = None # Shared ThreadPoolExecutor for per-target batch prediction (created on first use)
+_target_pool_lock = threading.Lock()
 
 # --- Helper Functions ---
 def _create_dirs():
@@ -192,37 +290,537 @@ def _objective(trial, X_train_fold, y_train_fold, X_val_fold, y_val_fold):
         score = mean_absolute_error(y_val_fold, preds)
     else: # Default to RMSE
         score = np.sqrt(mean_squared_error(y_val_fold, preds))
-    return score
-
-def _run_optuna_tuning(X_train_wl_scaled_df, y_train_target):
-    print(f"    Running Optuna ({N_OPTUNA_TRIALS} trials, {OPTUNA_CV_FOLDS}-fold CV)...")
-    study = optuna.create_study(direction='minimize') # Minimize RMSE or MAE
+    return score, model
+
+def _inference_cost(model, params, n_trees, X_sample):
+    """Inference cost of a trial's model for the multi-objective search (see OPTUNA_COST_METRIC)."""
+    if OPTUNA_COST_METRIC == 'latency':
+        return _time_single_row_predict(model, np.asarray(X_sample)[:1], repeats=50)
+    # Upper bound on leaves visited per prediction: trees x leaves per tree
+    return float(n_trees * min(params['num_leaves'], 2 ** params['max_depth']))
+
+def _select_pareto_trial(study):
+    """Lowest-error Pareto-optimal trial within OPTUNA_COST_BUDGET, or the cheapest Pareto trial if none fits."""
+    pareto_trials = sorted(study.best_trials, key=lambda t: t.values[0])
+    within_budget = [t for t in pareto_trials if OPTUNA_COST_BUDGET is None or t.values[1] <= OPTUNA_COST_BUDGET]
+    if within_budget:
+        return within_budget[0]
+    print(f"    Warning: No Pareto trial within cost budget {OPTUNA_COST_BUDGET}. Using the cheapest one.")
+    return min(pareto_trials, key=lambda t: t.values[1])
+
+def _snap_to_search_space(params):
+    """Keeps only tuned params and moves n_estimators onto the search grid (CV early stopping makes it off-grid)."""
+    snapped = {key: params[key] for key in OPTUNA_TUNED_PARAMS if key in params}
+    if 'n_estimators' in snapped:
+        snapped['n_estimators'] = int(min(1000, max(100, round(snapped['n_estimators'] / 50) * 50)))
+    return snapped
+
+def _warm_start_candidates(wl, target, cached_params_dict, tuned_results):
+    """
+    Initial trials for a study, in priority order: cached params for (wl, target), the same target
+    at other water levels (this run's results first, then cached), and the best study of this run so far
+    (lowest CV score normalized by target std). tuned_results: {(wl, target): (params, normalized_score)}.
+    Returns (candidates, informed): informed is True when a candidate comes from cached or same-target
+    params; only such studies use the reduced trial budget (the run's best study is just an extra trial).
+    """
+    candidates = [cached_params_dict.get(wl, {}).get(target)]
+    for other_wl in WATER_LEVELS_TO_PROCESS:
+        if other_wl != wl:
+            candidates.append(tuned_results.get((other_wl, target), (None, None))[0])
+            candidates.append(cached_params_dict.get(other_wl, {}).get(target))
+    informed = any(candidates)
+    if tuned_results:
+        candidates.append(min(tuned_results.values(), key=lambda result: result[1])[0])
+
+    unique_candidates = []
+    for params in candidates:
+        snapped = _snap_to_search_space(params) if params else None
+        if snapped and snapped not in unique_candidates:
+            unique_candidates.append(snapped)
+    return unique_candidates, informed and bool(unique_candidates)
+
+def _create_tuning_study(X_train_wl_scaled_df, y_train_target, warm_start_params=None):
+    """Creates a (possibly warm-started) study and its CV objective. Returns (study, objective)."""
+    if OPTUNA_MULTI_OBJECTIVE:
+        study = optuna.create_study(directions=['minimize', 'minimize']) # Minimize error and inference cost
+    else:
+        study = optuna.create_study(direction='minimize') # Minimize RMSE or MAE
+    for params in warm_start_params or []:
+        study.enqueue_trial(params, skip_if_exists=True)
     kf = KFold(n_splits=OPTUNA_CV_FOLDS, shuffle=True, random_state=RANDOM_STATE)
 
     def objective_cv_wrapper(trial):
         cv_scores = []
+        best_iterations = []
         for fold, (train_idx, val_idx) in enumerate(kf.split(X_train_wl_scaled_df, y_train_target)):
             X_train_fold = X_train_wl_scaled_df.iloc[train_idx]
             y_train_fold = y_train_target.iloc[train_idx]
             X_val_fold = X_train_wl_scaled_df.iloc[val_idx]
             y_val_fold = y_train_target.iloc[val_idx]
-            score = _objective(trial, X_train_fold, y_train_fold, X_val_fold, y_val_fold)
+            score, model = _objective(trial, X_train_fold, y_train_fold, X_val_fold, y_val_fold)
             cv_scores.append(score)
+            best_iterations.append(model.best_iteration_ or trial.params['n_estimators'])
+        # Tree count the final fit should use (mean early-stopping iteration across folds)
+        n_trees = max(1, int(round(np.mean(best_iterations))))
+        trial.set_user_attr('n_trees', n_trees)
+        if OPTUNA_MULTI_OBJECTIVE:
+            return np.mean(cv_scores), _inference_cost(model, trial.params, n_trees, X_val_fold)
         return np.mean(cv_scores)
 
-    study.optimize(objective_cv_wrapper, n_trials=N_OPTUNA_TRIALS, timeout=300) # Shorter timeout
-    best_params = study.best_params
-    best_score = study.best_value
-    print(f"    Optuna finished. Best CV {OPTUNA_OPTIMIZE_METRIC}: {best_score:.4f}")
-    # print(f"    Best Params: {best_params}") # Keep this less verbose for server logs
+    return study, objective_cv_wrapper
+
+def _study_best_trial(study, verbose=False):
+    """Best trial of a study (Pareto selection in multi-objective mode), or None if no trial completed."""
+    if not any(t.state == optuna.trial.TrialState.COMPLETE for t in study.trials):
+        return None
+    if OPTUNA_MULTI_OBJECTIVE:
+        best_trial = _select_pareto_trial(study)
+        if verbose:
+            print(f"    Optuna finished. Pareto front: {len(study.best_trials)} trials. "
+                  f"Selected CV {OPTUNA_OPTIMIZE_METRIC}: {best_trial.values[0]:.4f}, {OPTUNA_COST_METRIC}: {best_trial.values[1]:.1f}")
+    else:
+        best_trial = study.best_trial
+        if verbose:
+            print(f"    Optuna finished. Best CV {OPTUNA_OPTIMIZE_METRIC}: {best_trial.value:.4f}")
+    return best_trial
+
+def _params_from_trial(best_trial):
+    best_params = dict(best_trial.params)
+    best_params['n_estimators'] = best_trial.user_attrs['n_trees'] # Final fit stops where CV early stopping did
     return best_params
 
+def _run_optuna_tuning(X_train_wl_scaled_df, y_train_target, warm_start_params=None, reduced_budget=False):
+    """
+    Runs one study; returns (best_params, best CV score). Studies warm-started from cached or
+    same-target params (reduced_budget) use the reduced trial budget.
+    """
+    n_trials = N_OPTUNA_TRIALS_WARM_START if reduced_budget else N_OPTUNA_TRIALS
+    mode = f"multi-objective {OPTUNA_OPTIMIZE_METRIC}/{OPTUNA_COST_METRIC}" if OPTUNA_MULTI_OBJECTIVE else OPTUNA_OPTIMIZE_METRIC
+    warm = f", {len(warm_start_params)} warm-start trials" if warm_start_params else ""
+    print(f"    Running Optuna ({n_trials} trials, {OPTUNA_CV_FOLDS}-fold CV, {mode}{warm})...")
+    study, objective_cv_wrapper = _create_tuning_study(X_train_wl_scaled_df, y_train_target, warm_start_params)
+    study.optimize(objective_cv_wrapper, n_trials=n_trials, timeout=300) # Shorter timeout
+    best_trial = _study_best_trial(study, verbose=True)
+    # print(f"    Best Params: {_params_from_trial(best_trial)}") # Keep this less verbose for server logs
+    return _params_from_trial(best_trial), best_trial.values[0]
+
+# --- Global Tuning Budget Scheduler ---
+def _run_tuning_scheduler(X_train, y_train, local_scalers, cached_params_dict):
+    """
+    Tunes the whole (water level x target) grid under one global budget (TUNING_BUDGET_TRIALS and/or
+    TUNING_BUDGET_SECONDS). Every study gets SCHEDULER_INITIAL_TRIALS, then batches of SCHEDULER_BATCH_TRIALS
+    go to the study whose best CV score improved most (relatively) in its last batch. Studies improving
+    less than SCHEDULER_MIN_IMPROVEMENT for SCHEDULER_PATIENCE batches are retired.
+    Returns ({wl: {target: params}}, schedule log).
+    """
+    print(f"Running tuning scheduler (budget: {TUNING_BUDGET_TRIALS} trials, {TUNING_BUDGET_SECONDS} seconds)...")
+    start_time = time.time()
+    studies = {} # {(wl, target): {'study', 'objective', 'trials', 'best', 'improvement', 'active'}}
+    decisions = []
+    trials_used = 0
+
+    def remaining_seconds():
+        return None if TUNING_BUDGET_SECONDS is None else TUNING_BUDGET_SECONDS - (time.time() - start_time)
+
+    def budget_left():
+        seconds_left = remaining_seconds()
+        return ((TUNING_BUDGET_TRIALS is None or trials_used < TUNING_BUDGET_TRIALS)
+                and (seconds_left is None or seconds_left > 0))
+
+    def run_batch(key, n_trials, reason):
+        nonlocal trials_used
+        entry = studies[key]
+        if TUNING_BUDGET_TRIALS is not None:
+            n_trials = min(n_trials, TUNING_BUDGET_TRIALS - trials_used)
+        best_before = entry['best']
+        n_before = len(entry['study'].trials)
+        try:
+            entry['study'].optimize(entry['objective'], n_trials=n_trials, timeout=remaining_seconds())
+        except Exception as e:
+            print(f"    Error during Optuna for {key[1]} WL {key[0]}: {e}")
+            entry['active'] = False
+            return
+        n_trials = len(entry['study'].trials) - n_before # Fewer than requested if the time budget ran out
+        best_trial = _study_best_trial(entry['study'])
+        entry['best'] = best_trial.values[0] if best_trial is not None else None
+        entry['trials'] += n_trials
+        trials_used += n_trials
+        if best_before is None or entry['best'] is None:
+            entry['improvement'] = np.inf if entry['best'] is not None else 0.0
+        else:
+            entry['improvement'] = (best_before - entry['best']) / max(abs(best_before), 1e-12)
+        if reason == 'improving':
+            entry['stalled'] = entry['stalled'] + 1 if entry['improvement'] < SCHEDULER_MIN_IMPROVEMENT else 0
+            entry['active'] = entry['stalled'] < SCHEDULER_PATIENCE
+        decisions.append({
+            'step': len(decisions) + 1, 'waterLevel': key[0], 'target': key[1], 'reason': reason,
+            'trialsAdded': n_trials, 'bestBefore': best_before, 'bestAfter': entry['best'],
+            'relativeImprovement': None if not np.isfinite(entry['improvement']) else float(entry['improvement']),
+            'elapsedSeconds': round(time.time() - start_time, 2),
+        })
+        print(f"    [{len(decisions)}] WL {key[0]} {key[1]}: +{n_trials} trials ({reason}), best {best_before} -> {entry['best']}")
+
+    # Create one study per trainable (wl, target)
+    for wl in WATER_LEVELS_TO_PROCESS:
+        train_indices = X_train[CONTEXT_COL] == wl
+        scaler = local_scalers.get(wl)
+        if scaler is None or train_indices.sum() < MIN_TRAIN_SAMPLES:
+            continue
+        X_train_wl_orig = X_train.loc[train_indices, SPECTRAL_COLS]
+        X_train_wl_scaled_df = pd.DataFrame(scaler.transform(X_train_wl_orig), index=X_train_wl_orig.index, columns=SPECTRAL_COLS)
+        for target in TARGET_COLS:
+            y_train_target = y_train.loc[train_indices, target]
+            if y_train_target.nunique() <= 1:
+                continue
+            warm_start_params = _warm_start_candidates(wl, target, cached_params_dict, {})[0] if OPTUNA_WARM_START else None
+            study, objective = _create_tuning_study(X_train_wl_scaled_df, y_train_target, warm_start_params)
+            studies[(wl, target)] = {'study': study, 'objective': objective, 'trials': 0,
+                                     'best': None, 'improvement': np.inf, 'stalled': 0, 'active': True}
+
+    if TUNING_BUDGET_TRIALS is not None and TUNING_BUDGET_TRIALS < len(studies) * SCHEDULER_INITIAL_TRIALS:
+        print(f"    Warning: Budget does not cover the initial round ({len(studies)} studies x {SCHEDULER_INITIAL_TRIALS} trials). "
+              "Studies left untuned keep their cached parameters.")
+
+    # Initial round: every study gets a few trials (covers warm-start trials)
+    for key in studies:
+        if not budget_left():
+            break
+        run_batch(key, SCHEDULER_INITIAL_TRIALS, 'initial')
+
+    # Adaptive rounds: next batch goes to the study still improving the most
+    while budget_left():
+        active = [key for key, entry in studies.items() if entry['active'] and entry['best'] is not None]
+        if not active:
+            print("    All studies converged. Stopping early.")
+            break
+        key = max(active, key=lambda k: (studies[k]['improvement'], -studies[k]['trials']))
+        run_batch(key, SCHEDULER_BATCH_TRIALS, 'improving')
+
+    local_best_params_dict = defaultdict(dict)
+    study_summary = {}
+    for (wl, target), entry in studies.items():
+        best_trial = _study_best_trial(entry['study'])
+        if best_trial is not None:
+            local_best_params_dict[wl][target] = _params_from_trial(best_trial)
+        elif cached_params_dict.get(wl, {}).get(target):
+            local_best_params_dict[wl][target] = cached_params_dict[wl][target]
+        study_summary.setdefault(f"{wl}ml", {})[target] = {
+            'trials': entry['trials'], 'bestScore': entry['best'], 'converged': not entry['active'],
+        }
+
+    schedule_log = {
+        'budgetTrials': TUNING_BUDGET_TRIALS, 'budgetSeconds': TUNING_BUDGET_SECONDS,
+        'trialsUsed': trials_used, 'elapsedSeconds': round(time.time() - start_time, 2),
+        'studies': study_summary, 'decisions': decisions,
+    }
+    print(f"Tuning scheduler finished: {trials_used} trials in {schedule_log['elapsedSeconds']} seconds.")
+    try:
+        with open(TUNING_SCHEDULE_FILE, 'w') as f:
+            json.dump(schedule_log, f, indent=4)
+        print(f"Saved tuning schedule to {TUNING_SCHEDULE_FILE}")
+    except Exception as e:
+        print(f"Error saving tuning schedule: {e}")
+    return local_best_params_dict, schedule_log
+
+# --- Feature Importance / Ranking Index ---
+def _permutation_importance(model, X_test_scaled, y_test_target, n_repeats=PERMUTATION_REPEATS):
+    """
+    Permutation importance (increase in test RMSE) for every feature.
+    All (feature, repeat) shuffles are stacked into one matrix and scored with a single predict call.
+    """
+    X = np.asarray(X_test_scaled, dtype=np.float64)
+    y = np.asarray(y_test_target, dtype=np.float64)
+    n_samples, n_features = X.shape
+    rng = np.random.default_rng(RANDOM_STATE)
+
+    # Row permutations shared by all features: shape (n_repeats, n_samples)
+    perm_idx = rng.permuted(np.tile(np.arange(n_samples), (n_repeats, 1)), axis=1)
+
+    # X_perm[j, r] is X with column j shuffled by perm_idx[r]
+    X_perm = np.broadcast_to(X, (n_features, n_repeats, n_samples, n_features)).copy()
+    feat_idx = np.arange(n_features)[:, None, None]
+    X_perm[feat_idx, np.arange(n_repeats)[None, :, None], np.arange(n_samples)[None, None, :], feat_idx] = \
+        X[perm_idx[None, :, :], feat_idx]
+
+    booster = model.booster_
+    baseline_rmse = np.sqrt(np.mean((booster.predict(X) - y) ** 2))
+    preds = booster.predict(X_perm.reshape(-1, n_features)).reshape(n_features, n_repeats, n_samples)
+    perm_rmse = np.sqrt(np.mean((preds - y) ** 2, axis=2)) # (n_features, n_repeats)
+    return (perm_rmse - baseline_rmse).mean(axis=1)
+
+def _model_importances(model, X_test_scaled=None, y_test_target=None):
+    """Returns a (len(IMPORTANCE_TYPES), len(SPECTRAL_COLS)) array of importances for one trained model."""
+    importances = np.full((len(IMPORTANCE_TYPES), len(SPECTRAL_COLS)), np.nan)
+    booster = model.booster_
+    importances[IMPORTANCE_TYPES.index('split')] = booster.feature_importance(importance_type='split')
+    importances[IMPORTANCE_TYPES.index('gain')] = booster.feature_importance(importance_type='gain')
+    if (COMPUTE_PERMUTATION_IMPORTANCE and X_test_scaled is not None and y_test_target is not None
+            and len(y_test_target) >= MIN_TEST_SAMPLES):
+        importances[IMPORTANCE_TYPES.index('permutation')] = _permutation_importance(model, X_test_scaled, y_test_target)
+    return importances
+
+def _compute_importance_array(models, X_test, y_test, scalers):
+    """Builds the raw importance array from already trained/loaded models (used when the index file is missing)."""
+    importance_array = np.full((len(IMPORTANCE_TYPES), len(TARGET_COLS), len(WATER_LEVELS_TO_PROCESS), len(SPECTRAL_COLS)), np.nan)
+    for wl_idx, wl in enumerate(WATER_LEVELS_TO_PROCESS):
+        test_indices = X_test[CONTEXT_COL] == wl
+        X_test_wl_orig = X_test.loc[test_indices, SPECTRAL_COLS]
+        scaler = scalers.get(wl)
+        X_test_wl_scaled = scaler.transform(X_test_wl_orig) if (scaler is not None and not X_test_wl_orig.empty) else None
+        for target_idx, target in enumerate(TARGET_COLS):
+            model = models.get(wl, {}).get(target)
+            if model is None:
+                continue
+            y_test_target = y_test.loc[test_indices, target] if X_test_wl_scaled is not None else None
+            importance_array[:, target_idx, wl_idx, :] = _model_importances(model, X_test_wl_scaled, y_test_target)
+    return importance_array
+
+def _build_ranking_index(importance_array):
+    """
+    Compact ranking index built from a raw importance array of shape (type, target, wl, feature).
+    The water-level axis gets one extra trailing slot holding the mean across water levels.
+    'order' holds the feature indices sorted by descending importance (NaN last).
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # All-NaN slices (no models) stay NaN
+        aggregate = np.nanmean(importance_array, axis=2, keepdims=True)
+    importances = np.concatenate([importance_array, aggregate], axis=2)
+    order = np.argsort(-np.where(np.isnan(importances), -np.inf, importances), axis=-1, kind='stable').astype(np.int16)
+    return {
+        'importance_types': list(IMPORTANCE_TYPES),
+        'targets': list(TARGET_COLS),
+        'water_levels': list(WATER_LEVELS_TO_PROCESS),
+        'features': list(SPECTRAL_COLS),
+        'importances': importances,
+        'order': order,
+    }
+
+def _save_ranking_index(ranking_index):
+    try:
+        np.savez_compressed(
+            FEATURE_RANKING_INDEX_FILE,
+            importance_types=np.array(ranking_index['importance_types']),
+            targets=np.array(ranking_index['targets']),
+            water_levels=np.array(ranking_index['water_levels']),
+            features=np.array(ranking_index['features']),
+            importances=ranking_index['importances'],
+            order=ranking_index['order'],
+        )
+        print(f"Saved feature ranking index to {FEATURE_RANKING_INDEX_FILE}")
+    except Exception as e:
+        print(f"Error saving feature ranking index: {e}")
+
+def _load_ranking_index():
+    """Loads the ranking index file. Returns an empty dict if missing or stale."""
+    if not os.path.exists(FEATURE_RANKING_INDEX_FILE):
+        print(f"  Feature ranking index file missing: {FEATURE_RANKING_INDEX_FILE}")
+        return {}
+    try:
+        with np.load(FEATURE_RANKING_INDEX_FILE) as data:
+            ranking_index = {
+                'importance_types': data['importance_types'].tolist(),
+                'targets': data['targets'].tolist(),
+                'water_levels': data['water_levels'].tolist(),
+                'features': data['features'].tolist(),
+                'importances': data['importances'],
+                'order': data['order'],
+            }
+        if (ranking_index['targets'] != TARGET_COLS or ranking_index['water_levels'] != WATER_LEVELS_TO_PROCESS
+                or ranking_index['features'] != SPECTRAL_COLS or ranking_index['importance_types'] != IMPORTANCE_TYPES):
+            raise ValueError("Ranking index does not match current configuration.")
+        return ranking_index
+    except Exception as e:
+        print(f"  Error loading feature ranking index: {e}")
+        return {}
+
+def _rankings_from_index(ranking_index, target, water_level=None, importance_type='split', count=None):
+    """
+    Ranking list [{rank, wavelength, importanceScore}, ...] for one target.
+    water_level=None selects the mean across water levels. Returns [] if no scores exist.
+    """
+    type_idx = ranking_index['importance_types'].index(importance_type)
+    target_idx = ranking_index['targets'].index(target)
+    wl_idx = len(ranking_index['water_levels']) if water_level is None else ranking_index['water_levels'].index(water_level)
+
+    scores = ranking_index['importances'][type_idx, target_idx, wl_idx]
+    order = ranking_index['order'][type_idx, target_idx, wl_idx]
+    order = order[~np.isnan(scores[order])][:count]
+    features = ranking_index['features']
+    return [
+        {'rank': i + 1, 'wavelength': features[feat_idx], 'importanceScore': float(scores[feat_idx])}
+        for i, feat_idx in enumerate(order)
+    ]
+
+# --- Drift Reference ---
+def _build_drift_reference(df):
+    """Reference input sketches per water level from the raw spectra in the dataset."""
+    print("Building drift reference sketches from the dataset...")
+    return {wl: drift_monitor.build_reference(df.loc[df[CONTEXT_COL] == wl, SPECTRAL_COLS].to_numpy(dtype=np.float64))
+            for wl in WATER_LEVELS_TO_PROCESS if (df[CONTEXT_COL] == wl).any()}
+
+def _save_drift_reference(drift_reference):
+    try:
+        water_levels = sorted(drift_reference)
+        np.savez_compressed(
+            DRIFT_REFERENCE_FILE,
+            water_levels=np.array(water_levels),
+            features=np.array(SPECTRAL_COLS),
+            **{name: np.stack([drift_reference[wl][name] for wl in water_levels]) for name in ('edges', 'counts', 'median', 'iqr')}
+        )
+        print(f"Saved drift reference to {DRIFT_REFERENCE_FILE}")
+    except Exception as e:
+        print(f"Error saving drift reference: {e}")
+
+def _load_drift_reference():
+    """Loads the drift reference file. Returns an empty dict if missing or stale."""
+    if not os.path.exists(DRIFT_REFERENCE_FILE):
+        print(f"  Drift reference file missing: {DRIFT_REFERENCE_FILE}")
+        return {}
+    try:
+        with np.load(DRIFT_REFERENCE_FILE) as data:
+            if data['features'].tolist() != SPECTRAL_COLS:
+                raise ValueError("Drift reference does not match current configuration.")
+            return {int(wl): {name: data[name][i] for name in ('edges', 'counts', 'median', 'iqr')}
+                    for i, wl in enumerate(data['water_levels'].tolist())}
+    except Exception as e:
+        print(f"  Error loading drift reference: {e}")
+        return {}
+
+
+# --- Bootstrap Confidence Intervals ---
+def _bootstrap_metrics(y_true, y_pred, n_resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, seed=RANDOM_STATE):
+    """
+    Percentile bootstrap intervals {'R2': [lo, hi], 'MAE': [...], 'RMSE': [...]} for one test split.
+    All resamples are drawn as one (n_resamples, n) index matrix and evaluated row-wise.
+    """
+    idx = np.random.default_rng(seed).integers(0, len(y_true), size=(n_resamples, len(y_true)))
+    y_true_b, y_pred_b = y_true[idx], y_pred[idx]
+    sq_err = (y_pred_b - y_true_b) ** 2
+    ss_tot = ((y_true_b - y_true_b.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'): # Constant resamples have no R2
+        r2 = np.where(ss_tot > 0, 1.0 - sq_err.sum(axis=1) / ss_tot, np.nan)
+    samples = {'R2': r2, 'MAE': np.abs(y_pred_b - y_true_b).mean(axis=1), 'RMSE': np.sqrt(sq_err.mean(axis=1))}
+    tail = (1.0 - confidence) / 2 * 100
+    intervals = {}
+    for metric_key, values in samples.items():
+        values = values[~np.isnan(values)]
+        intervals[metric_key] = [float(v) for v in np.percentile(values, [tail, 100 - tail])] if len(values) else None
+    return intervals
+
+def _bootstrap_intervals(eval_predictions):
+    """
+    Bootstrap intervals for every {(wl, target): (y_true, y_pred)} in parallel (joblib threads; the
+    NumPy work releases the GIL). Returns {'confidence', 'resamples', metric: {wl_key: {target: [lo, hi]}}}.
+    """
+    from joblib import Parallel, delayed
+    keys = [(wl, target) for wl in WATER_LEVELS_TO_PROCESS for target in TARGET_COLS
+            if (wl, target) in eval_predictions and len(eval_predictions[(wl, target)][0]) >= 2]
+    print(f"Computing bootstrap confidence intervals ({BOOTSTRAP_RESAMPLES} resamples, {len(keys)} models)...")
+    results = Parallel(n_jobs=BOOTSTRAP_N_JOBS, prefer='threads')(
+        delayed(_bootstrap_metrics)(*eval_predictions[key], seed=RANDOM_STATE + i) for i, key in enumerate(keys)
+    )
+    intervals = {'confidence': BOOTSTRAP_CONFIDENCE, 'resamples': BOOTSTRAP_RESAMPLES}
+    for metric_key in ['R2', 'MAE', 'RMSE']:
+        intervals[metric_key] = {f"{wl}ml": {target: None for target in TARGET_COLS} for wl in WATER_LEVELS_TO_PROCESS}
+    for (wl, target), result in zip(keys, results):
+        for metric_key, interval in result.items():
+            intervals[metric_key][f"{wl}ml"][target] = interval
+    return intervals
+
+def _collect_eval_predictions(models, X_test, y_test, scalers):
+    """Test-split (y_true, y_pred) per (wl, target) from already trained/loaded models (used when intervals are missing)."""
+    eval_predictions = {}
+    for wl in WATER_LEVELS_TO_PROCESS:
+        test_indices = X_test[CONTEXT_COL] == wl
+        scaler = scalers.get(wl)
+        if scaler is None or not test_indices.any():
+            continue
+        X_test_wl_scaled = _scale_bands(scaler, X_test.loc[test_indices, SPECTRAL_COLS].to_numpy(dtype=np.float64), slice(None))
+        for target in TARGET_COLS:
+            model = models.get(wl, {}).get(target)
+            if model is not None:
+                eval_predictions[(wl, target)] = (y_test.loc[test_indices, target].to_numpy(dtype=np.float64),
+                                                  model.booster_.predict(X_test_wl_scaled))
+    return eval_predictions
+
+# --- Final Fit and Evaluation ---
+def _fit_final_model(params, X_train_scaled_df, y_train_target, X_test_scaled=None, y_test_target=None, n_threads=None):
+    """Process-pool task: fits one final model and computes its importances. Returns (model, importances)."""
+    model = lgb.LGBMRegressor(
+        objective='regression_l1', metric=OPTUNA_METRIC_LGBM, verbosity=-1, boosting_type='gbdt',
+        **params # Unpack best hyperparameters
+    )
+    limit_threads = n_threads is not None and 'n_jobs' not in params
+    if limit_threads:
+        model.set_params(n_jobs=n_threads) # Workers share the CPU quota
+    model.fit(X_train_scaled_df, y_train_target)
+    if limit_threads:
+        model.set_params(n_jobs=None) # Saved estimator is the same as a sequential fit
+    return model, _model_importances(model, X_test_scaled, y_test_target)
+
+def _submit_inline(fn, *args):
+    """Executor.submit stand-in that runs fn immediately (FINAL_FIT_N_JOBS=1)."""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _regression_metrics(Y_true, Y_pred):
+    """
+    Column-wise R2/MAE/RMSE for (n_samples, n_targets) matrices, with r2_score's conventions
+    (NaN below 2 samples; 1.0/0.0 for a constant column with perfect/imperfect predictions).
+    """
+    err = Y_pred - Y_true
+    ss_res = (err ** 2).sum(axis=0)
+    ss_tot = ((Y_true - Y_true.mean(axis=0)) ** 2).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(ss_tot > 0, 1.0 - ss_res / ss_tot, np.where(ss_res == 0, 1.0, 0.0))
+    if Y_true.shape[0] < 2:
+        r2[:] = np.nan
+    return r2, np.abs(err).mean(axis=0), np.sqrt((err ** 2).mean(axis=0))
+
+def _evaluate_water_level(wl, models_wl, targets, X_test_wl_scaled_df, y_test_wl, metrics_wl, eval_predictions):
+    """Evaluates the fitted models of one water level in one pass: a (n_test, n_targets) prediction matrix and column-wise metrics."""
+    if X_test_wl_scaled_df.empty:
+        print("    Skipping evaluation: No test data.")
+        for target in targets:
+            metrics_wl[target].update({'Status': 'Success_TrainOnly_No_Test', 'R2': np.nan, 'MAE': np.nan, 'RMSE': np.nan})
+        return
+    if X_test_wl_scaled_df.shape[0] < MIN_TEST_SAMPLES:
+        print(f"    Warning: Evaluating on small test set ({X_test_wl_scaled_df.shape[0]} samples). Metrics may be unstable.")
+
+    X_test_wl = X_test_wl_scaled_df.to_numpy(dtype=np.float64)
+    Y_true = y_test_wl[targets].to_numpy(dtype=np.float64)
+    Y_pred = np.full_like(Y_true, np.nan)
+    for j, target in enumerate(targets):
+        try:
+            Y_pred[:, j] = models_wl[target].booster_.predict(X_test_wl)
+        except Exception as e:
+            print(f"    Error during evaluation for {target} WL {wl}: {e}")
+    r2, mae, rmse = _regression_metrics(Y_true, Y_pred)
+
+    for j, target in enumerate(targets):
+        if not (np.isfinite(Y_true[:, j]).all() and np.isfinite(Y_pred[:, j]).all()):
+            print(f"    Error during evaluation for {target} WL {wl}: missing test targets or predictions.")
+            metrics_wl[target].update({'Status': 'Error_Eval_Final', 'R2': np.nan, 'MAE': np.nan, 'RMSE': np.nan})
+            continue
+        print(f"    {target:<18} Test Metrics: R2={r2[j]:.3f}, MAE={mae[j]:.3f}, RMSE={rmse[j]:.3f}")
+        metrics_wl[target].update({'Status': 'Success', 'R2': float(r2[j]), 'MAE': float(mae[j]), 'RMSE': float(rmse[j])})
+        eval_predictions[(wl, target)] = (Y_true[:, j].copy(), Y_pred[:, j].copy())
+
+
 def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
     print("Training models and evaluating...")
     local_tuned_models = defaultdict(dict)
     local_performance_metrics = defaultdict(lambda: defaultdict(dict))
+    eval_predictions = {} # {(wl, target): (y_true, y_pred)} on the test split, for bootstrap intervals
     local_best_params_dict = defaultdict(dict)
-    local_feature_importances = defaultdict(lambda: defaultdict(list)) # Store importances per model
+    cached_params_dict = {} # Previous best params, used to warm-start tuning
+    tuned_results = {} # {(wl, target): (params, normalized CV score)} for studies run in this call
+    # Raw importances per (type, target, wl, feature); NaN where no model was trained
+    importance_array = np.full((len(IMPORTANCE_TYPES), len(TARGET_COLS), len(WATER_LEVELS_TO_PROCESS), len(SPECTRAL_COLS)), np.nan)
 
     # --- Load or Run Optuna ---
     if os.path.exists(PARAMS_CACHE_FILE):
@@ -233,7 +831,11 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
             # Convert keys back to int if needed (JSON saves keys as strings)
             local_best_params_dict = {int(k) if k.isdigit() else k: v for k, v in local_best_params_dict.items()}
             print("Cached parameters loaded.")
-            run_tuning = False
+            run_tuning = RETUNE_WITH_CACHE
+            if run_tuning:
+                print("RETUNE_WITH_CACHE set: re-tuning with cached parameters as warm start.")
+                cached_params_dict = local_best_params_dict
+                local_best_params_dict = defaultdict(dict)
         except Exception as e:
             print(f"Warning: Failed to load cached parameters: {e}. Re-running tuning.")
             local_best_params_dict = defaultdict(dict) # Reset if loading failed
@@ -246,7 +848,27 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
 
     start_time_total = time.time()
 
-    for wl in WATER_LEVELS_TO_PROCESS:
+    # Final fits run on a process pool (spawn: forking after LightGBM/OpenMP has run is unsafe);
+    # model saves overlap with compute on a single I/O thread.
+    n_fit_workers = FINAL_FIT_N_JOBS or _cpu_quota()
+    if n_fit_workers > 1:
+        fit_executor = ProcessPoolExecutor(max_workers=n_fit_workers, mp_context=multiprocessing.get_context('spawn'))
+        submit_fit = fit_executor.submit
+        fit_threads = max(1, _cpu_quota() // n_fit_workers)
+    else:
+        fit_executor = None
+        submit_fit = _submit_inline
+        fit_threads = None # LightGBM default
+    io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-io")
+    fit_futures = {} # {(wl, target): Future -> (model, importances)}
+    save_futures = []
+    test_sets = {} # {wl: (X_test_wl_scaled_df, y_test_wl)}
+
+    if run_tuning and TUNING_SCHEDULER:
+        # Tune the whole grid up front under one global budget; the loop below only uses the results
+        local_best_params_dict, _ = _run_tuning_scheduler(X_train, y_train, local_scalers, cached_params_dict)
+
+    for wl_idx, wl in enumerate(WATER_LEVELS_TO_PROCESS):
         print(f"\n--- Processing Models: Water Level = {wl} ml ---")
         start_time_wl = time.time()
 
@@ -284,7 +906,7 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
             continue
 
         # Loop through targets
-        for target in TARGET_COLS:
+        for target_idx, target in enumerate(TARGET_COLS):
             print(f"\n  --- Target: {target} (WL: {wl}ml) ---")
             y_train_target = y_train_wl[target]
             y_test_target = y_test_wl[target]
@@ -296,11 +918,17 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
 
             best_params = None
             # --- Optuna Tuning (if needed) ---
-            if run_tuning:
+            if run_tuning and TUNING_SCHEDULER and target not in local_best_params_dict.get(wl, {}):
+                print(f"    Tuning scheduler produced no parameters for {target} WL {wl}.")
+                local_performance_metrics[wl][target]['Status'] = 'Error_Optuna'
+                continue
+            elif run_tuning and not TUNING_SCHEDULER:
                 try:
                     # Optuna expects dict[str, dict], handle potential int key from loading
-                    best_params = _run_optuna_tuning(X_train_wl_scaled_df, y_train_target)
+                    warm_start_params, informed = _warm_start_candidates(wl, target, cached_params_dict, tuned_results) if OPTUNA_WARM_START else (None, False)
+                    best_params, best_score = _run_optuna_tuning(X_train_wl_scaled_df, y_train_target, warm_start_params, informed)
                     local_best_params_dict[wl][target] = best_params # Store params found
+                    tuned_results[(wl, target)] = (best_params, best_score / max(y_train_target.std(), 1e-12))
                 except Exception as e:
                     print(f"    Error during Optuna for {target} WL {wl}: {e}")
                     local_performance_metrics[wl][target]['Status'] = 'Error_Optuna'
@@ -319,65 +947,56 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
                      print(f"    Using cached parameters for {target} WL {wl}.")
 
 
-            # --- Train Final Model ---
-            print(f"    Training final model...")
-            final_model = lgb.LGBMRegressor(
-                objective='regression_l1', metric=OPTUNA_METRIC_LGBM, verbosity=-1, boosting_type='gbdt',
-                **best_params # Unpack best hyperparameters
+            # --- Queue Final Model Fit (runs on the process pool while tuning continues) ---
+            print("    Queued final model fit.")
+            fit_futures[(wl, target)] = submit_fit(
+                _fit_final_model, best_params, X_train_wl_scaled_df, y_train_target,
+                X_test_wl_scaled_df.to_numpy() if not X_test_wl_scaled_df.empty else None,
+                y_test_target if not y_test_target.empty else None,
+                fit_threads
             )
-            try:
-                final_model.fit(X_train_wl_scaled_df, y_train_target)
-                local_tuned_models[wl][target] = final_model
-                print(f"    Final model trained.")
-
-                # Save model
-                model_filename = os.path.join(MODEL_SAVE_DIR, f"model_tuned_{target.replace(' ', '_')}_WL{wl}ml.joblib")
-                joblib.dump(final_model, model_filename)
-                # print(f"    Saved tuned model: {model_filename}") # Less verbose
-
-                # Store feature importances
-                importances = final_model.feature_importances_
-                feature_importance_map = {feature: imp for feature, imp in zip(SPECTRAL_COLS, importances)}
-                local_feature_importances[target][wl] = feature_importance_map
 
+        test_sets[wl] = (X_test_wl_scaled_df, y_test_wl)
+        wl_elapsed = time.time() - start_time_wl
+        print(f"--- Water Level {wl}ml tuning/queueing time: {wl_elapsed:.2f} seconds ---")
 
-            except Exception as e:
-                 print(f"    Error training final model for {target} WL {wl}: {e}")
-                 local_performance_metrics[wl][target]['Status'] = 'Error_Train_Final'
-                 continue # Skip evaluation if final training failed
-
-            # --- Evaluate ---
-            if X_test_wl_scaled_df.empty or y_test_target.empty:
-                 print("    Skipping evaluation: No test data.")
-                 local_performance_metrics[wl][target].update({'Status': 'Success_TrainOnly_No_Test', 'R2': np.nan, 'MAE': np.nan, 'RMSE': np.nan})
-            elif X_test_wl_scaled_df.shape[0] < MIN_TEST_SAMPLES:
-                 print(f"    Warning: Evaluating on small test set ({X_test_wl_scaled_df.shape[0]} samples). Metrics may be unstable.")
-                 # Proceed with evaluation but be aware
-                 try:
-                    y_pred = final_model.predict(X_test_wl_scaled_df)
-                    r2 = r2_score(y_test_target, y_pred)
-                    mae = mean_absolute_error(y_test_target, y_pred)
-                    rmse = np.sqrt(mean_squared_error(y_test_target, y_pred))
-                    print(f"    Test Metrics: R2={r2:.3f}, MAE={mae:.3f}, RMSE={rmse:.3f}")
-                    local_performance_metrics[wl][target].update({'Status': 'Success', 'R2': r2, 'MAE': mae, 'RMSE': rmse})
-                 except Exception as e:
-                    print(f"    Error during evaluation for {target} WL {wl}: {e}")
-                    local_performance_metrics[wl][target].update({'Status': 'Error_Eval_Final', 'R2': np.nan, 'MAE': np.nan, 'RMSE': np.nan})
-            else:
-                print(f"    Evaluating final model on test set ({X_test_wl_scaled_df.shape[0]} samples)...")
+    # --- Collect Final Fits: save on the I/O thread, evaluate once per water level ---
+    try:
+        for wl_idx, wl in enumerate(WATER_LEVELS_TO_PROCESS):
+            fitted_targets = []
+            for target_idx, target in enumerate(TARGET_COLS):
+                future = fit_futures.get((wl, target))
+                if future is None:
+                    continue
                 try:
-                    y_pred = final_model.predict(X_test_wl_scaled_df)
-                    r2 = r2_score(y_test_target, y_pred)
-                    mae = mean_absolute_error(y_test_target, y_pred)
-                    rmse = np.sqrt(mean_squared_error(y_test_target, y_pred))
-                    print(f"    Test Metrics: R2={r2:.3f}, MAE={mae:.3f}, RMSE={rmse:.3f}")
-                    local_performance_metrics[wl][target].update({'Status': 'Success', 'R2': r2, 'MAE': mae, 'RMSE': rmse})
+                    final_model, importances = future.result()
                 except Exception as e:
-                    print(f"    Error during evaluation for {target} WL {wl}: {e}")
-                    local_performance_metrics[wl][target].update({'Status': 'Error_Eval_Final', 'R2': np.nan, 'MAE': np.nan, 'RMSE': np.nan})
+                    print(f"    Error training final model for {target} WL {wl}: {e}")
+                    local_performance_metrics[wl][target]['Status'] = 'Error_Train_Final'
+                    continue
+                local_tuned_models[wl][target] = final_model
+                # Feature importances (split, gain and optionally permutation on the test split)
+                importance_array[:, target_idx, wl_idx, :] = importances
+                model_filename = os.path.join(MODEL_SAVE_DIR, f"model_tuned_{target.replace(' ', '_')}_WL{wl}ml.joblib")
+                save_futures.append((target, wl, io_executor.submit(joblib.dump, final_model, model_filename)))
+                fitted_targets.append(target)
+
+            if fitted_targets:
+                X_test_wl_scaled_df, y_test_wl = test_sets[wl]
+                print(f"\n  Evaluating {len(fitted_targets)} final models for WL {wl} on test set ({X_test_wl_scaled_df.shape[0]} samples)...")
+                _evaluate_water_level(
+                    wl, local_tuned_models[wl], fitted_targets, X_test_wl_scaled_df, y_test_wl, local_performance_metrics[wl], eval_predictions
+                )
 
-        wl_elapsed = time.time() - start_time_wl
-        print(f"--- Water Level {wl}ml processing time: {wl_elapsed:.2f} seconds ---")
+        for target, wl, future in save_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"    Error saving final model for {target} WL {wl}: {e}")
+    finally:
+        io_executor.shutdown(wait=True)
+        if fit_executor is not None:
+            fit_executor.shutdown(wait=True)
 
     # Save cached parameters if tuning was run
     if run_tuning:
@@ -412,6 +1031,7 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
                  metric_value = local_performance_metrics[wl].get(target, {}).get(metric_key)
                  # Store None if NaN or missing, JSON handles null
                  final_performance_metrics[metric_key][wl_key][target] = None if (metric_value is None or np.isnan(metric_value)) else float(metric_value)
+    final_performance_metrics['Confidence_Intervals'] = _bootstrap_intervals(eval_predictions)
 
     # Save metrics
     try:
@@ -422,40 +1042,20 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
         print(f"Error saving performance metrics: {e}")
 
 
-    # --- Calculate Aggregated Feature Rankings ---
-    print("\nCalculating aggregated feature importance rankings...")
+    # --- Calculate Feature Rankings ---
+    print("\nCalculating feature importance rankings...")
+    ranking_index = _build_ranking_index(importance_array)
+    _save_ranking_index(ranking_index)
+
+    # Aggregated rankings (split importance averaged across water levels) keep the original file format
     final_rankings = {}
     for target in TARGET_COLS:
-        target_importances = local_feature_importances.get(target, {})
-        if not target_importances:
-            print(f"  Skipping ranking for {target}: No importance scores found.")
-            final_rankings[target] = []
-            continue
-
-        # Average importance across water levels for this target
-        aggregated_importance = defaultdict(float)
-        count = 0
-        for wl, importance_map in target_importances.items():
-            if importance_map: # Check if importance map is not empty
-                for feature, imp in importance_map.items():
-                    aggregated_importance[feature] += imp
-                count += 1
-
-        if count > 0:
-            avg_importance = {feat: total_imp / count for feat, total_imp in aggregated_importance.items()}
-            # Sort features by average importance (descending)
-            sorted_features = sorted(avg_importance.items(), key=lambda item: item[1], reverse=True)
-
-            # Create ranking list [{rank, wavelength, importanceScore}, ...]
-            target_ranking = [
-                {'rank': i + 1, 'wavelength': feat, 'importanceScore': float(score)}
-                for i, (feat, score) in enumerate(sorted_features)
-            ]
-            final_rankings[target] = target_ranking
+        target_ranking = _rankings_from_index(ranking_index, target)
+        final_rankings[target] = target_ranking
+        if target_ranking:
             print(f"  Ranked features for {target} (Top 3): {target_ranking[:3]}")
         else:
-             print(f"  Skipping ranking for {target}: No valid importance scores to aggregate.")
-             final_rankings[target] = []
+            print(f"  Skipping ranking for {target}: No importance scores found.")
 
     # Save rankings
     try:
@@ -466,136 +1066,937 @@ def _train_and_evaluate(X_train, y_train, X_test, y_test, local_scalers):
         print(f"Error saving feature rankings: {e}")
 
 
-    return local_tuned_models, final_performance_metrics, final_rankings
+    return local_tuned_models, final_performance_metrics, final_rankings, ranking_index
+
+
+# --- Reduced-Band Model Variants ---
+def _load_params_cache():
+    """Loads the Optuna params cache as {str(wl): {target: params}}. Returns {} if missing or invalid."""
+    if not os.path.exists(PARAMS_CACHE_FILE):
+        return {}
+    try:
+        with open(PARAMS_CACHE_FILE, 'r') as f:
+            return {str(k): v for k, v in json.load(f).items()}
+    except Exception as e:
+        print(f"Warning: Failed to load cached parameters: {e}")
+        return {}
+
+def _reduced_model_filename(target, wl, k):
+    return os.path.join(REDUCED_MODEL_SAVE_DIR, f"model_tuned_{target.replace(' ', '_')}_WL{wl}ml_top{k}.joblib")
+
+def _scale_bands(scaler, X_bands, col_idx):
+    """Applies a fitted full-spectrum StandardScaler to a subset of its columns."""
+    return (X_bands - scaler.mean_[col_idx]) / scaler.scale_[col_idx]
+
+def _time_call_us(fn, repeats=LATENCY_BENCH_REPEATS):
+    """Median wall time (microseconds) of fn()."""
+    fn() # Warm-up call
+    timings = np.empty(repeats)
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        timings[i] = time.perf_counter() - t0
+    return float(np.median(timings) * 1e6)
+
+def _time_single_row_predict(model, x_row, repeats=LATENCY_BENCH_REPEATS):
+    """Median wall time (microseconds) of a single-row booster predict."""
+    booster = model.booster_
+    return _time_call_us(lambda: booster.predict(x_row), repeats)
+
+def _variant_summary(model, X_test_scaled, y_test_target, bands):
+    """Accuracy and latency record for one model evaluated on the test split (NaN metrics if too few samples)."""
+    summary = {'bands': list(bands), 'nTrees': int(model.booster_.num_trees()), 'R2': None, 'MAE': None, 'RMSE': None}
+    if len(y_test_target) >= MIN_TEST_SAMPLES:
+        y_pred = model.booster_.predict(X_test_scaled)
+        summary.update({
+            'R2': float(r2_score(y_test_target, y_pred)),
+            'MAE': float(mean_absolute_error(y_test_target, y_pred)),
+            'RMSE': float(np.sqrt(mean_squared_error(y_test_target, y_pred))),
+        })
+    summary['predictLatencyUs'] = _time_single_row_predict(model, X_test_scaled[:1] if len(X_test_scaled) else np.zeros((1, len(bands))))
+    return summary
+
+def _train_reduced_variants(X_train, y_train, X_test, y_test, local_scalers, local_models, rankings, best_params_dict):
+    """
+    Trains top-K band variants per (wl, target), taking bands in the order of the aggregated feature rankings.
+    Returns (variants, summary); summary[wl_key][target] holds the 'full' model record plus one record per K.
+    """
+    print("Training reduced-band model variants...")
+    os.makedirs(REDUCED_MODEL_SAVE_DIR, exist_ok=True)
+    local_variants = defaultdict(dict)
+    summary = {}
+
+    for wl in WATER_LEVELS_TO_PROCESS:
+        wl_key = f"{wl}ml"
+        summary[wl_key] = {}
+        scaler = local_scalers.get(wl)
+        train_indices = X_train[CONTEXT_COL] == wl
+        test_indices = X_test[CONTEXT_COL] == wl
+        if scaler is None or train_indices.sum() < MIN_TRAIN_SAMPLES:
+            print(f"  Skipping WL {wl}: Scaler missing or insufficient training data.")
+            continue
+
+        all_idx = np.arange(len(SPECTRAL_COLS))
+        X_train_wl_scaled = _scale_bands(scaler, X_train.loc[train_indices, SPECTRAL_COLS].to_numpy(dtype=np.float64), all_idx)
+        X_test_wl_scaled = _scale_bands(scaler, X_test.loc[test_indices, SPECTRAL_COLS].to_numpy(dtype=np.float64), all_idx)
+
+        for target in TARGET_COLS:
+            full_model = local_models.get(wl, {}).get(target)
+            ranking = rankings.get(target) or []
+            y_train_target = y_train.loc[train_indices, target]
+            y_test_target = y_test.loc[test_indices, target].to_numpy()
+            if full_model is None or not ranking or y_train_target.nunique() <= 1:
+                continue
+
+            params = best_params_dict.get(str(wl), {}).get(target) or {'random_state': RANDOM_STATE}
+            target_summary = {'full': _variant_summary(full_model, X_test_wl_scaled, y_test_target, SPECTRAL_COLS)}
+            target_variants = []
+            for k in REDUCED_BAND_KS:
+                if k >= len(SPECTRAL_COLS) or k > len(ranking):
+                    continue
+                bands = [entry['wavelength'] for entry in ranking[:k]]
+                col_idx = np.array([SPECTRAL_COLS.index(band) for band in bands])
+                model = lgb.LGBMRegressor(
+                    objective='regression_l1', metric=OPTUNA_METRIC_LGBM, verbosity=-1, boosting_type='gbdt', **params
+                )
+                try:
+                    model.fit(pd.DataFrame(X_train_wl_scaled[:, col_idx], columns=bands), y_train_target)
+                    joblib.dump(model, _reduced_model_filename(target, wl, k))
+                except Exception as e:
+                    print(f"    Error training top-{k} variant for {target} WL {wl}: {e}")
+                    continue
+                target_summary[str(k)] = _variant_summary(model, X_test_wl_scaled[:, col_idx], y_test_target, bands)
+                target_variants.append((k, bands, col_idx, model))
+
+            local_variants[wl][target] = target_variants
+            summary[wl_key][target] = target_summary
+            print(f"  {target} WL {wl}: trained {len(target_variants)} variants " +
+                  ", ".join(f"top{k} RMSE={rec['RMSE']}" for k, rec in target_summary.items() if k != 'full'))
+
+    return local_variants, summary
+
+def _save_reduced_variants(summary):
+    """Writes the variant manifest and records the accuracy/latency tradeoff in the performance metrics."""
+    global _performance_metrics
+    try:
+        with open(REDUCED_VARIANTS_FILE, 'w') as f:
+            json.dump({**summary, 'teacherVersion': _teacher_version}, f, indent=4)
+        print(f"Saved reduced-band variant manifest to {REDUCED_VARIANTS_FILE}")
+    except Exception as e:
+        print(f"Error saving reduced-band variant manifest: {e}")
+
+    _performance_metrics = dict(_performance_metrics)
+    _performance_metrics['Reduced_Band_Variants'] = summary
+    try:
+        with open(PERFORMANCE_METRICS_FILE, 'w') as f:
+            json.dump(_performance_metrics, f, indent=4)
+    except Exception as e:
+        print(f"Error saving performance metrics: {e}")
+
+def _load_derived_manifest(path, metrics_key, description):
+    """
+    Manifest of artifacts derived from the tuned models (reduced variants, students), or None if it
+    is missing or was built from other models/scalers than the current ones (_teacher_version).
+    Keeps metrics_key in the performance metrics in step: the manifest's summary while it is served, absent otherwise.
+    """
+    global _performance_metrics
+    summary = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                summary = json.load(f)
+        except Exception as e:
+            print(f"  Error loading {description} manifest: {e}")
+    if summary is not None and summary.pop('teacherVersion', None) != _teacher_version:
+        print(f"  Warning: {description} manifest does not match the current models/scalers; ignoring it (retrain to serve them).")
+        summary = None
+    if summary is None and metrics_key in _performance_metrics:
+        _performance_metrics = {k: v for k, v in _performance_metrics.items() if k != metrics_key} # No longer served
+    elif summary is not None and metrics_key not in _performance_metrics:
+        _performance_metrics = {**_performance_metrics, metrics_key: summary} # Metrics rewritten since the manifest was saved
+    return summary
+
+def _load_reduced_variants():
+    """Loads variant models listed in the manifest. Missing or stale variants are simply not served."""
+    local_variants = defaultdict(dict)
+    summary = _load_derived_manifest(REDUCED_VARIANTS_FILE, 'Reduced_Band_Variants', "reduced-band variant")
+    if summary is None:
+        return local_variants
+
+    for wl in WATER_LEVELS_TO_PROCESS:
+        for target, target_summary in summary.get(f"{wl}ml", {}).items():
+            target_variants = []
+            for k_str, record in target_summary.items():
+                if k_str == 'full':
+                    continue
+                k = int(k_str)
+                try:
+                    model = joblib.load(_reduced_model_filename(target, wl, k))
+                except Exception as e:
+                    print(f"  Error loading top-{k} variant for {target} WL {wl}: {e}")
+                    continue
+                bands = record['bands']
+                target_variants.append((k, bands, np.array([SPECTRAL_COLS.index(band) for band in bands]), model))
+            local_variants[wl][target] = sorted(target_variants, key=lambda variant: variant[0])
+    print(f"  Loaded reduced-band variants: {sum(len(v) for wl_v in local_variants.values() for v in wl_v.values())}")
+    return local_variants
+
+def _select_reduced_variant(target_variants, provided_features):
+    """Largest trained variant whose bands were all provided (no imputation needed), or None."""
+    for variant in reversed(target_variants or []):
+        if all(band in provided_features for band in variant[1]):
+            return variant
+    return None
+
+
+# --- Distilled Multi-Output Students ---
+def _student_filename(wl):
+    return os.path.join(DISTILLED_MODEL_SAVE_DIR, f"student_WL{wl}ml.npz")
+
+def _student_predict(student, X_scaled):
+    """NumPy forward pass of a ReLU MLP; returns (n_rows, len(student['targets'])) in target units."""
+    hidden = X_scaled
+    for W, b in zip(student['weights'][:-1], student['biases'][:-1]):
+        hidden = np.maximum(hidden @ W + b, 0.0)
+    return (hidden @ student['weights'][-1] + student['biases'][-1]) * student['y_scale'] + student['y_mean']
+
+def _synthetic_spectra(X_scaled, impute_scaled, rng):
+    """Samples spectra around the given (scaled) rows: Gaussian jitter plus random mean-imputed bands."""
+    base = X_scaled[rng.integers(0, len(X_scaled), size=len(X_scaled) * DISTILL_SYNTHETIC_PER_ROW)]
+    synthetic = base + rng.normal(0.0, DISTILL_NOISE_SCALE, size=base.shape)
+    imputed = rng.random(base.shape) < DISTILL_IMPUTE_PROB
+    return np.where(imputed, impute_scaled, synthetic)
+
+def _train_distilled_students(X_train, y_train, X_test, y_test, local_scalers, local_models, local_imputation_values):
+    """
+    Distills the tuned models of each water level into one multi-output MLP student.
+    Returns (students, summary); summary[wl_key] holds per-target teacher/student test metrics and latencies.
+    """
+    from sklearn.neural_network import MLPRegressor
+    print("Training distilled multi-output students...")
+    os.makedirs(DISTILLED_MODEL_SAVE_DIR, exist_ok=True)
+    rng = np.random.default_rng(RANDOM_STATE)
+    students = {}
+    summary = {}
+
+    for wl in WATER_LEVELS_TO_PROCESS:
+        wl_key = f"{wl}ml"
+        scaler = local_scalers.get(wl)
+        train_indices = X_train[CONTEXT_COL] == wl
+        test_indices = X_test[CONTEXT_COL] == wl
+        targets = [target for target in TARGET_COLS if local_models.get(wl, {}).get(target) is not None]
+        if scaler is None or train_indices.sum() < MIN_TRAIN_SAMPLES or not targets:
+            print(f"  Skipping WL {wl}: Scaler/teachers missing or insufficient training data.")
+            continue
+
+        all_idx = np.arange(len(SPECTRAL_COLS))
+        X_train_wl_scaled = _scale_bands(scaler, X_train.loc[train_indices, SPECTRAL_COLS].to_numpy(dtype=np.float64), all_idx)
+        X_test_wl_scaled = _scale_bands(scaler, X_test.loc[test_indices, SPECTRAL_COLS].to_numpy(dtype=np.float64), all_idx)
+        impute_raw = np.array([local_imputation_values[wl][col] for col in SPECTRAL_COLS], dtype=np.float64)
+        X_distill = np.vstack([X_train_wl_scaled, _synthetic_spectra(X_train_wl_scaled, _scale_bands(scaler, impute_raw, all_idx), rng)])
+
+        # Teacher labels, standardized per target so large-valued targets do not dominate the loss
+        Y_teacher = np.column_stack([local_models[wl][target].booster_.predict(X_distill) for target in targets])
+        y_mean, y_scale = Y_teacher.mean(axis=0), Y_teacher.std(axis=0)
+        y_scale[y_scale == 0] = 1.0
+        mlp = MLPRegressor(hidden_layer_sizes=DISTILL_HIDDEN_LAYERS, activation='relu', early_stopping=True,
+                           max_iter=DISTILL_MAX_ITER, random_state=RANDOM_STATE)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # ConvergenceWarning; early stopping decides
+                mlp.fit(X_distill, (Y_teacher - y_mean) / y_scale)
+        except Exception as e:
+            print(f"  Error training student for WL {wl}: {e}")
+            continue
+        student = {'weights': mlp.coefs_, 'biases': mlp.intercepts_, 'y_mean': y_mean, 'y_scale': y_scale, 'targets': targets}
+        try:
+            arrays = {f"W{i}": W for i, W in enumerate(mlp.coefs_)}
+            arrays.update({f"b{i}": b for i, b in enumerate(mlp.intercepts_)})
+            np.savez(_student_filename(wl), y_mean=y_mean, y_scale=y_scale, targets=np.array(targets), **arrays)
+        except Exception as e:
+            print(f"  Error saving student for WL {wl}: {e}")
+            continue
+        students[wl] = student
+
+        # Accuracy gap vs the teachers on the held-out test split, plus fidelity to the teachers
+        student_test = _student_predict(student, X_test_wl_scaled)
+        target_summary = {}
+        for j, target in enumerate(targets):
+            y_true = y_test.loc[test_indices, target].to_numpy()
+            teacher_test = local_models[wl][target].booster_.predict(X_test_wl_scaled)
+            record = {'Teacher_R2': None, 'Student_R2': None, 'R2_Gap': None, 'Teacher_RMSE': None, 'Student_RMSE': None, 'Fidelity_R2': None}
+            if len(y_true) >= MIN_TEST_SAMPLES:
+                teacher_rmse = float(np.sqrt(mean_squared_error(y_true, teacher_test)))
+                student_rmse = float(np.sqrt(mean_squared_error(y_true, student_test[:, j])))
+                record.update({
+                    'Teacher_R2': float(r2_score(y_true, teacher_test)),
+                    'Student_R2': float(r2_score(y_true, student_test[:, j])),
+                    'Teacher_RMSE': teacher_rmse,
+                    'Student_RMSE': student_rmse,
+                    'Fidelity_R2': float(r2_score(teacher_test, student_test[:, j])),
+                })
+                record['R2_Gap'] = record['Teacher_R2'] - record['Student_R2']
+            target_summary[target] = record
+
+        x_row = X_test_wl_scaled[:1] if len(X_test_wl_scaled) else X_train_wl_scaled[:1]
+        summary[wl_key] = {
+            'targets': target_summary,
+            'hiddenLayers': list(DISTILL_HIDDEN_LAYERS),
+            'nDistillRows': int(len(X_distill)),
+            'teacherTrees': int(sum(local_models[wl][target].booster_.num_trees() for target in targets)),
+            'teacherLatencyUs': float(sum(_time_single_row_predict(local_models[wl][target], x_row) for target in targets)),
+            'studentLatencyUs': _time_call_us(lambda: _student_predict(student, x_row)),
+        }
+        gaps = [rec['R2_Gap'] for rec in target_summary.values() if rec['R2_Gap'] is not None]
+        print(f"  WL {wl}: student for {len(targets)} targets, mean R2 gap {np.mean(gaps) if gaps else float('nan'):.4f}, "
+              f"latency {summary[wl_key]['teacherLatencyUs']:.0f}us -> {summary[wl_key]['studentLatencyUs']:.0f}us")
+
+    return students, summary
+
+def _save_distilled_students(summary):
+    """Writes the student manifest and records the accuracy gap in the performance metrics."""
+    global _performance_metrics
+    try:
+        with open(DISTILLED_STUDENTS_FILE, 'w') as f:
+            json.dump({**summary, 'teacherVersion': _teacher_version}, f, indent=4)
+        print(f"Saved distilled student manifest to {DISTILLED_STUDENTS_FILE}")
+    except Exception as e:
+        print(f"Error saving distilled student manifest: {e}")
+
+    _performance_metrics = dict(_performance_metrics)
+    _performance_metrics['Distilled_Student'] = summary
+    try:
+        with open(PERFORMANCE_METRICS_FILE, 'w') as f:
+            json.dump(_performance_metrics, f, indent=4)
+    except Exception as e:
+        print(f"Error saving performance metrics: {e}")
+
+def _load_distilled_students():
+    """
+    Loads the students listed in the manifest if they were distilled from the current models.
+    Water levels without a student serve 'fast' requests with the full models.
+    """
+    students = {}
+    summary = _load_derived_manifest(DISTILLED_STUDENTS_FILE, 'Distilled_Student', "distilled student")
+    if summary is None:
+        return students
+    for wl in WATER_LEVELS_TO_PROCESS:
+        if f"{wl}ml" not in summary:
+            continue
+        try:
+            with np.load(_student_filename(wl), allow_pickle=False) as arrays:
+                n_layers = sum(1 for name in arrays.files if name.startswith('W'))
+                students[wl] = {
+                    'weights': [arrays[f"W{i}"] for i in range(n_layers)],
+                    'biases': [arrays[f"b{i}"] for i in range(n_layers)],
+                    'y_mean': arrays['y_mean'],
+                    'y_scale': arrays['y_scale'],
+                    'targets': [str(target) for target in arrays['targets']],
+                }
+        except Exception as e:
+            print(f"  Error loading student for WL {wl}: {e}")
+    print(f"  Loaded distilled students for WL: {sorted(students)}")
+    return students
+
+
+# --- Inference Threading ---
+def _cpu_quota():
+    """Cores available to this process: INFERENCE_CPU_QUOTA, else the cgroup CPU limit / CPU affinity."""
+    if INFERENCE_CPU_QUOTA:
+        return INFERENCE_CPU_QUOTA
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError: # Not available on macOS/Windows
+        cores = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f: # cgroup v2, e.g. "200000 100000" or "max 100000"
+            quota, period = f.read().split()
+        if quota != 'max':
+            cores = min(cores, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+def _inference_threads(n_rows, pooled=False):
+    """num_threads for one booster predict call on n_rows rows."""
+    if pooled or n_rows < INFERENCE_BATCH_MIN_ROWS:
+        return INFERENCE_THREADS_SINGLE # The pool supplies the parallelism for pooled calls
+    return INFERENCE_THREADS_BATCH or _cpu_quota()
+
+def _get_target_pool():
+    """Shared pool for per-target batch prediction, sized to the CPU quota."""
+    global _target_pool
+    with _target_pool_lock:
+        if _target_pool is None:
+            _target_pool = ThreadPoolExecutor(max_workers=min(len(TARGET_COLS), _cpu_quota()), thread_name_prefix="predict")
+        return _target_pool
+
+def _booster_predict(model, X, pooled=False):
+    """Booster predict under the inference threading policy."""
+    return model.booster_.predict(X, num_threads=_inference_threads(len(X), pooled))
+
+def get_inference_policy():
+    """Returns the effective inference threading settings."""
+    return {
+        'cpuQuota': _cpu_quota(),
+        'threadsSingle': INFERENCE_THREADS_SINGLE,
+        'threadsBatch': INFERENCE_THREADS_BATCH or _cpu_quota(),
+        'batchMinRows': INFERENCE_BATCH_MIN_ROWS,
+        'targetPoolMinRows': INFERENCE_TARGET_POOL_MIN_ROWS or None
+    }
 
 
 # --- Prediction Function (Adapted for Flask context) ---
+def _prediction_decimals(target):
+    """Output precision per target."""
+    if target in ['Ph', 'Temp']:
+        return 2
+    elif target in ['Nitro', 'Posh Nitro', 'Pota Nitro', 'EC']:
+        return 3
+    else: # Moist, Cap Moist
+        return 1
+
+def _round_prediction(target, pred):
+    """
+    Rounding for cleaner output (optional, frontend can also format); precision depends on the target.
+    NumPy rounding (what round() already did on the np.float64 predictions), so arrays rounded with
+    np.round(preds, _prediction_decimals(target)) get exactly the same values. Python's round() on a
+    float can differ in the last digit near half-way values (372.85 -> 372.9 vs NumPy's 372.8).
+    """
+    return np.round(np.float64(pred), _prediction_decimals(target))
+
+def _predict_targets(input_raw, input_scaled, present, imputed, water_level, scaler, loaded_models,
+                     loaded_reduced_variants=None, loaded_students=None, mode='full', loaded_forests=None):
+    """
+    Predicts every target for imputed rows of one water level (input_raw / input_scaled:
+    (n_rows, len(SPECTRAL_COLS))), one predict call per target (or one forest/student pass).
+    Returns [(preds array or None, variant label or None, error or None)] in TARGET_COLS order.
+    """
+    n_rows = len(input_raw)
+    models_for_wl = loaded_models.get(water_level, {})
+    variants_for_wl = (loaded_reduced_variants or {}).get(water_level, {})
+    provided_features = {SPECTRAL_COLS[i] for i in np.flatnonzero(present)}
+
+    def predict_target(target, pooled=False, forest_preds=None):
+        """Returns (preds or None, variant label or None, error or None) for one target."""
+        model = models_for_wl.get(target)
+        # Prefer a reduced-band variant over the full model when bands were imputed
+        variant = _select_reduced_variant(variants_for_wl.get(target), provided_features) if imputed else None
+        if model is None and variant is None:
+            return None, None, None
+        try:
+            if variant is not None:
+                k, _, col_idx, variant_model = variant
+                x_bands = _scale_bands(scaler, input_raw[:, col_idx], col_idx)
+                return _booster_predict(variant_model, x_bands, pooled), f"top{k}", None
+            if forest_preds is not None and target in forest_preds:
+                return forest_preds[target], 'full', None
+            return _booster_predict(model, input_scaled, pooled), 'full', None
+        except Exception as e:
+            return None, None, e
+
+    # 'fast' mode: one multi-output student pass for all targets (full models if no student for this WL)
+    student = (loaded_students or {}).get(water_level) if mode == 'fast' else None
+    forest = (loaded_forests or {}).get(water_level)
+    if student is not None:
+        try:
+            student_preds = _student_predict(student, input_scaled)
+            return [
+                (student_preds[:, student['targets'].index(target)], 'student', None) if target in student['targets'] else (None, None, None)
+                for target in TARGET_COLS
+            ]
+        except Exception as e:
+            return [(None, None, e)] * len(TARGET_COLS)
+    if forest is not None and (not BUNDLE_NATIVE_MIN_ROWS or n_rows < BUNDLE_NATIVE_MIN_ROWS):
+        # Bundle-served models: one traversal of the water level's forest covers every target
+        try:
+            forest_preds = dict(zip(forest.targets, forest.predict(input_scaled).T))
+            return [predict_target(target, forest_preds=forest_preds) for target in TARGET_COLS]
+        except Exception as e:
+            return [(None, None, e)] * len(TARGET_COLS)
+    if INFERENCE_TARGET_POOL_MIN_ROWS and n_rows >= INFERENCE_TARGET_POOL_MIN_ROWS:
+        return list(_get_target_pool().map(lambda target: predict_target(target, pooled=True), TARGET_COLS))
+    return [predict_target(target) for target in TARGET_COLS]
+
 def predict_soil_properties_flexible_internal(
     input_spectral_data,
     water_level,
     loaded_models, # Pass loaded models
     loaded_scalers, # Pass loaded scalers
-    loaded_imputation_values # Pass loaded imputation values
+    loaded_imputation_values, # Pass loaded imputation values
+    loaded_reduced_variants=None, # Optional top-K band variants, used when bands had to be imputed
+    loaded_forests=None # Optional bundle forests {wl: artifact_bundle.Forest} (all targets in one traversal)
+):
+    """Internal prediction logic, assumes artifacts are loaded. Input is a {wavelength: value} dict."""
+    values = np.full(len(SPECTRAL_COLS), np.nan)
+    present = np.zeros(len(SPECTRAL_COLS), dtype=bool)
+    for i, col in enumerate(SPECTRAL_COLS):
+        if col in input_spectral_data:
+            value = input_spectral_data[col]
+            # Basic check if value seems numeric (more robust checks can be added)
+            if not isinstance(value, (int, float)) or np.isnan(value):
+                predictions = {
+                    'Prediction_Status': f"Error: Invalid numeric value provided for feature '{col}' ({value}).",
+                    'Input_Water_Level': water_level,
+                    'Provided_Features': list(input_spectral_data.keys()),
+                    'Imputed_Features': [],
+                    'Model_Variants': {}
+                }
+                print(f"  {predictions['Prediction_Status']}")
+                return predictions, {target: None for target in TARGET_COLS}
+            values[i] = value
+            present[i] = True
+    return predict_soil_properties_array_internal(
+        values, present, list(input_spectral_data.keys()), water_level,
+        loaded_models, loaded_scalers, loaded_imputation_values, loaded_reduced_variants, loaded_forests=loaded_forests
+    )
+
+def predict_soil_properties_array_internal(
+    values, # float64 array in SPECTRAL_COLS order (ignored where not present)
+    present, # bool mask of provided bands
+    provided, # Provided feature names as sent by the client
+    water_level,
+    loaded_models,
+    loaded_scalers,
+    loaded_imputation_values,
+    loaded_reduced_variants=None,
+    loaded_students=None, # Distilled multi-output students, used when mode == 'fast'
+    mode='full',
+    loaded_forests=None # Bundle forests, see predict_soil_properties_flexible_internal
+):
+    """Internal prediction logic on a fixed-order array plus presence mask (no per-request DataFrames)."""
+    return predict_soil_properties_batch_internal(
+        np.asarray(values, dtype=np.float64).reshape(1, -1), present, provided, water_level,
+        loaded_models, loaded_scalers, loaded_imputation_values, loaded_reduced_variants, loaded_students, mode, loaded_forests
+    )[0]
+
+def predict_soil_properties_batch_internal(
+    values, # float64 array (n_rows, len(SPECTRAL_COLS)), ignored where not present
+    present, # bool mask of provided bands, shared by every row
+    provided, # Provided feature names as sent by the client
+    water_level,
+    loaded_models,
+    loaded_scalers,
+    loaded_imputation_values,
+    loaded_reduced_variants=None,
+    loaded_students=None,
+    mode='full',
+    loaded_forests=None
 ):
-    """Internal prediction logic, assumes artifacts are loaded."""
-    predictions = {
+    """
+    Batched prediction for rows that share a water level and band subset (e.g. a streaming
+    connection). Imputes, scales and predicts each target once for the whole batch.
+    Returns a list of (status_info, target_predictions) tuples, one per row.
+    """
+    n_rows = len(values)
+    results = [({
         'Prediction_Status': 'Pending',
         'Input_Water_Level': water_level,
-        'Provided_Features': list(input_spectral_data.keys()),
-        'Imputed_Features': []
-    }
-    target_predictions = {target: None for target in TARGET_COLS} # Initialize target predictions
+        'Provided_Features': provided,
+        'Imputed_Features': [],
+        'Model_Variants': {}
+    }, {target: None for target in TARGET_COLS}) for _ in range(n_rows)] # Initialize target predictions
+
+    def fail_rows(message, rows=range(n_rows)):
+        for row in rows:
+            results[row][0]['Prediction_Status'] = message
+        print(f"  {message}")
+        return results
 
     # --- Validation (Basic - more in Flask route) ---
     if water_level not in WATER_LEVELS_TO_PROCESS:
-        predictions['Prediction_Status'] = f"Error: Invalid water_level '{water_level}'."
-        return predictions, target_predictions
+        for status, _ in results:
+            status['Prediction_Status'] = f"Error: Invalid water_level '{water_level}'."
+        return results
 
-    print(f"\n--- Predicting for Water Level: {water_level} ml ---")
-    num_provided = len(input_spectral_data)
-    print(f"  Provided {num_provided} spectral features.")
+    print(f"\n--- Predicting for Water Level: {water_level} ml ---" + (f" ({n_rows} rows)" if n_rows != 1 else ""))
+    print(f"  Provided {len(provided)} spectral features.")
 
     # --- Get Imputation Values for WL ---
     wl_impute_means = loaded_imputation_values.get(water_level)
     if wl_impute_means is None or not isinstance(wl_impute_means, dict) or any(v is None or np.isnan(v) for v in wl_impute_means.values()):
-        predictions['Prediction_Status'] = f"Error: Imputation values missing or invalid for WL {water_level}."
-        print(f"  {predictions['Prediction_Status']}")
-        return predictions, target_predictions
+        return fail_rows(f"Error: Imputation values missing or invalid for WL {water_level}.")
 
     # --- Prepare Full Feature Set (Impute Missing) ---
-    input_full = {}
-    imputed_features_list = []
-    all_features_valid = True
-    for col in SPECTRAL_COLS:
-        if col in input_spectral_data:
-            value = input_spectral_data[col]
-            # Basic check if value seems numeric (more robust checks can be added)
-            if not isinstance(value, (int, float)) or np.isnan(value):
-                 predictions['Prediction_Status'] = f"Error: Invalid numeric value provided for feature '{col}' ({value})."
-                 print(f"  {predictions['Prediction_Status']}")
-                 all_features_valid = False
-                 break # Stop processing if one value is bad
-            input_full[col] = value
-        else:
-            impute_val = wl_impute_means.get(col)
-            if impute_val is None or np.isnan(impute_val):
-                 predictions['Prediction_Status'] = f"Error: Missing imputation value for feature '{col}' at WL {water_level}."
-                 print(f"  {predictions['Prediction_Status']}")
-                 all_features_valid = False
-                 break
-            input_full[col] = impute_val
-            imputed_features_list.append(col)
-
-    if not all_features_valid:
-        return predictions, target_predictions # Return early if imputation or input values failed
-
-    predictions['Imputed_Features'] = imputed_features_list
+    invalid = present & np.isnan(values)
+    bad_rows = np.flatnonzero(invalid.any(axis=1))
+    for row in bad_rows:
+        i = np.flatnonzero(invalid[row])[0]
+        fail_rows(f"Error: Invalid numeric value provided for feature '{SPECTRAL_COLS[i]}' ({values[row, i]}).", [row])
+    good_rows = np.flatnonzero(~invalid.any(axis=1))
+    if len(good_rows) == 0:
+        return results
+    impute_array = np.array([wl_impute_means.get(col, np.nan) for col in SPECTRAL_COLS], dtype=np.float64)
+    for i in np.flatnonzero(~present & np.isnan(impute_array)):
+        return fail_rows(f"Error: Missing imputation value for feature '{SPECTRAL_COLS[i]}' at WL {water_level}.", good_rows)
+
+    input_raw = np.where(present, values[good_rows], impute_array)
+    imputed_features_list = [SPECTRAL_COLS[i] for i in np.flatnonzero(~present)]
+    for row in good_rows:
+        results[row][0]['Imputed_Features'] = imputed_features_list
     if imputed_features_list:
         print(f"  Imputed values for: {imputed_features_list}")
 
-    # Create DataFrame in correct order
-    try:
-        input_df = pd.DataFrame([input_full])[SPECTRAL_COLS]
-    except Exception as e:
-         predictions['Prediction_Status'] = f"Error creating input DataFrame: {e}"
-         print(f"  {predictions['Prediction_Status']}")
-         return predictions, target_predictions
-
     # --- Load and Apply Scaler ---
     scaler = loaded_scalers.get(water_level)
     if scaler is None:
-         predictions['Prediction_Status'] = f"Error: Scaler not found for WL {water_level}."
-         print(f"  {predictions['Prediction_Status']}")
-         return predictions, target_predictions
+        return fail_rows(f"Error: Scaler not found for WL {water_level}.", good_rows)
     try:
-        input_scaled = scaler.transform(input_df)
+        # Same arithmetic as StandardScaler.transform, without per-request DataFrame validation
+        input_scaled = _scale_bands(scaler, input_raw, slice(None))
         print(f"  Applied scaler for WL {water_level}.")
     except Exception as e:
-         predictions['Prediction_Status'] = f"Error applying scaler for WL {water_level}: {e}"
-         print(f"  {predictions['Prediction_Status']}")
-         return predictions, target_predictions
+        return fail_rows(f"Error applying scaler for WL {water_level}: {e}", good_rows)
 
     # --- Load Models and Predict ---
     all_preds_successful = True
-    models_for_wl = loaded_models.get(water_level, {})
+    model_variants = {}
+    target_results = _predict_targets(
+        input_raw, input_scaled, present, bool(imputed_features_list), water_level, scaler,
+        loaded_models, loaded_reduced_variants, loaded_students, mode, loaded_forests
+    )
+
+    for target, (preds, variant_label, error) in zip(TARGET_COLS, target_results):
+        target_preds = None # None for missing/error
+        if error is not None:
+            print(f"  Error predicting '{target}' for WL {water_level}: {error}")
+            all_preds_successful = False
+        elif preds is None:
+            print(f"  Warning: Model not found/loaded for '{target}' at WL {water_level}. Skipping.")
+            all_preds_successful = False # Mark as partial if any model is missing
+        else:
+            model_variants[target] = variant_label
+            target_preds = [_round_prediction(target, pred) for pred in preds]
+            if len(good_rows) == 1:
+                print(f"  Predicted {target:<18}: {target_preds[0]}")
+            else:
+                print(f"  Predicted {target:<18}: {len(good_rows)} rows")
+
+        if target_preds is not None:
+            for row, pred in zip(good_rows, target_preds):
+                results[row][1][target] = pred
+
+    # Final status update (models and variants are shared, so every valid row gets the same status)
+    for row in good_rows:
+        status, target_predictions = results[row]
+        status['Model_Variants'] = dict(model_variants)
+        if all_preds_successful and all(v is not None for v in target_predictions.values()):
+             status['Prediction_Status'] = 'Success'
+        elif any(v is not None for v in target_predictions.values()):
+             status['Prediction_Status'] = 'Partial Success (Some models/predictions failed or missing)'
+        else:
+             status['Prediction_Status'] = 'Failed (All predictions failed or critical error)'
 
-    for target in TARGET_COLS:
-        target_pred_val = None # Use None for missing/error
-        model = models_for_wl.get(target)
+    return results
+
+def predict_soil_properties_sweep_internal(
+    values, # float64 array (len(SPECTRAL_COLS),): the base sample, ignored where not present
+    present, # bool mask of bands provided in the base sample
+    provided, # Provided feature names (base sample and swept bands) as sent by the client
+    water_level,
+    axes, # [(band index, 1-D array of grid values)], one or two distinct bands
+    loaded_models,
+    loaded_scalers,
+    loaded_imputation_values,
+    loaded_reduced_variants=None,
+    loaded_students=None,
+    mode='full',
+    loaded_forests=None
+):
+    """
+    What-if sweep: the base sample with the swept bands set to every point of the grid spanned
+    by the axes. The grid (plus the unmodified base sample as a last row) is one matrix, imputed
+    and scaled once, with one predict call per target.
+    Returns (status_info, surfaces {target: array shaped like the grid or None}, baseline {target: value or None}).
+    """
+    status_info = {
+        'Prediction_Status': 'Pending',
+        'Input_Water_Level': water_level,
+        'Provided_Features': provided,
+        'Imputed_Features': [],
+        'Model_Variants': {}
+    }
+    surfaces = {target: None for target in TARGET_COLS}
+    baseline = {target: None for target in TARGET_COLS}
+
+    # --- Validation (Basic - more in Flask route) ---
+    if water_level not in WATER_LEVELS_TO_PROCESS:
+        status_info['Prediction_Status'] = f"Error: Invalid water_level '{water_level}'."
+        return status_info, surfaces, baseline
+    wl_impute_means = loaded_imputation_values.get(water_level)
+    if wl_impute_means is None or not isinstance(wl_impute_means, dict) or any(v is None or np.isnan(v) for v in wl_impute_means.values()):
+        status_info['Prediction_Status'] = f"Error: Imputation values missing or invalid for WL {water_level}."
+        return status_info, surfaces, baseline
+    invalid = np.flatnonzero(present & np.isnan(values))
+    if len(invalid):
+        status_info['Prediction_Status'] = f"Error: Invalid numeric value provided for feature '{SPECTRAL_COLS[invalid[0]]}' ({values[invalid[0]]})."
+        return status_info, surfaces, baseline
+    impute_array = np.array([wl_impute_means.get(col, np.nan) for col in SPECTRAL_COLS], dtype=np.float64)
+    swept = np.zeros(len(SPECTRAL_COLS), dtype=bool)
+    swept[[band for band, _ in axes]] = True
+    missing = np.flatnonzero(~(present | swept) & np.isnan(impute_array))
+    if len(missing):
+        status_info['Prediction_Status'] = f"Error: Missing imputation value for feature '{SPECTRAL_COLS[missing[0]]}' at WL {water_level}."
+        return status_info, surfaces, baseline
+    scaler = loaded_scalers.get(water_level)
+    if scaler is None:
+        status_info['Prediction_Status'] = f"Error: Scaler not found for WL {water_level}."
+        return status_info, surfaces, baseline
+
+    # --- Build the Grid (base sample repeated, swept bands from the meshgrid) ---
+    shape = tuple(len(grid) for _, grid in axes)
+    n_points = int(np.prod(shape))
+    base_raw = np.where(present, values, impute_array)
+    input_raw = np.tile(base_raw, (n_points + 1, 1)) # Last row: the unmodified base sample
+    for (band, _), mesh in zip(axes, np.meshgrid(*(grid for _, grid in axes), indexing='ij')):
+        input_raw[:n_points, band] = mesh.ravel()
+    imputed_features_list = [SPECTRAL_COLS[i] for i in np.flatnonzero(~(present | swept))]
+    status_info['Imputed_Features'] = imputed_features_list
+    print(f"\n--- Sweeping {[SPECTRAL_COLS[band] for band, _ in axes]} over {'x'.join(map(str, shape))} points for Water Level: {water_level} ml ---")
+
+    try:
+        input_scaled = _scale_bands(scaler, input_raw, slice(None))
+    except Exception as e:
+        status_info['Prediction_Status'] = f"Error applying scaler for WL {water_level}: {e}"
+        return status_info, surfaces, baseline
 
-        if model is None:
+    # --- Predict (one call per target over the whole grid) ---
+    all_preds_successful = True
+    target_results = _predict_targets(
+        input_raw, input_scaled, present | swept, bool(imputed_features_list), water_level, scaler,
+        loaded_models, loaded_reduced_variants, loaded_students, mode, loaded_forests
+    )
+    for target, (preds, variant_label, error) in zip(TARGET_COLS, target_results):
+        if error is not None:
+            print(f"  Error predicting '{target}' for WL {water_level}: {error}")
+            all_preds_successful = False
+        elif preds is None:
             print(f"  Warning: Model not found/loaded for '{target}' at WL {water_level}. Skipping.")
-            target_pred_val = None # Indicate model missing
-            all_preds_successful = False # Mark as partial if any model is missing
+            all_preds_successful = False
         else:
+            status_info['Model_Variants'][target] = variant_label
+            # Same NumPy rounding as _round_prediction (/api/analyze), in one call for the grid
+            preds = np.round(np.asarray(preds, dtype=np.float64), _prediction_decimals(target))
+            surfaces[target] = preds[:n_points].reshape(shape)
+            baseline[target] = preds[n_points]
+
+    if all_preds_successful:
+        status_info['Prediction_Status'] = 'Success'
+    elif status_info['Model_Variants']:
+        status_info['Prediction_Status'] = 'Partial Success (Some models/predictions failed or missing)'
+    else:
+        status_info['Prediction_Status'] = 'Failed (All predictions failed or critical error)'
+    return status_info, surfaces, baseline
+
+
+def _compute_artifact_version(directories=TEACHER_VERSION_DIRS, base_version=None):
+    """
+    Short SHA-1 over the artifact files in directories (file names and contents, so it survives
+    checkouts and copies), chained onto base_version if given.
+    """
+    digest = hashlib.sha1((base_version or '').encode('utf-8'))
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                digest.update(filename.encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def _artifact_file_stats(directories):
+    """{path: [size, mtime_ns]} for the files _compute_artifact_version hashes (cheap change check)."""
+    stats = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                stats[path.replace(os.sep, '/')] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def _compute_teacher_version():
+    """
+    Content hash of TEACHER_VERSION_DIRS. Reuses TEACHER_VERSION_FILE while the files' sizes and
+    mtimes are unchanged, so a boot only stats them; otherwise (fresh checkout, retrain) rehashes
+    and rewrites it. build.sh's --export-bundle step writes it before the workers start.
+    """
+    stats = _artifact_file_stats(TEACHER_VERSION_DIRS) # Taken before hashing: a file changed meanwhile fails the next check
+    try:
+        with open(TEACHER_VERSION_FILE, 'r') as f:
+            cached = json.load(f)
+        if cached.get('files') == stats:
+            return cached['version']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    version = _compute_artifact_version(TEACHER_VERSION_DIRS)
+    tmp_path = f"{TEACHER_VERSION_FILE}.{os.getpid()}.{threading.get_ident()}.tmp" # Workers may rewrite it concurrently
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': version, 'files': stats}, f, indent=4)
+        os.replace(tmp_path, TEACHER_VERSION_FILE)
+    except Exception as e:
+        print(f"Warning: Could not save {TEACHER_VERSION_FILE}: {e}")
+    return version
+
+
+# --- Serving Bundle ---
+def _bundle_check_rows(X):
+    """Scaled spectra per water level, used to verify an exported bundle against the boosters."""
+    rows = {}
+    for wl in WATER_LEVELS_TO_PROCESS:
+        scaler = _scalers.get(wl)
+        wl_rows = X.loc[X[CONTEXT_COL] == wl, SPECTRAL_COLS].to_numpy(dtype=np.float64)
+        if scaler is not None and len(wl_rows):
+            rows[wl] = _scale_bands(scaler, wl_rows, slice(None))
+    return rows
+
+def _export_artifact_bundle(check_rows=None, leaf_dtype=BUNDLE_LEAF_DTYPE):
+    """Writes ARTIFACT_BUNDLE_FILE from the loaded (pickled) models, scalers and imputation means."""
+    models = {wl: {target: model for target, model in _tuned_models[wl].items() if model is not None} for wl in WATER_LEVELS_TO_PROCESS}
+    model_files = {
+        wl: {target: os.path.relpath(os.path.join(MODEL_SAVE_DIR, f"model_tuned_{target.replace(' ', '_')}_WL{wl}ml.joblib"), BASE_ARTIFACTS_DIR)
+             for target in wl_models}
+        for wl, wl_models in models.items()
+    }
+    artifact_bundle.export_bundle(
+        ARTIFACT_BUNDLE_FILE, models, _scalers, _imputation_values, SPECTRAL_COLS, model_files,
+        _teacher_version, leaf_dtype, BUNDLE_MAX_LEAF_ERROR, check_rows
+    )
+
+def _start_bundle_export(check_rows):
+    """Exports the bundle on a background thread (used on the next start)."""
+    def run():
+        try:
+            _export_artifact_bundle(check_rows)
+        except Exception as e:
+            print(f"Warning: Could not export the serving bundle: {e}")
+    threading.Thread(target=run, name="bundle-export", daemon=True).start()
+
+def _bundle_forests():
+    return _artifact_bundle.forests if _artifact_bundle is not None else None
+
+def _load_artifact_bundle():
+    """Memory-maps ARTIFACT_BUNDLE_FILE into the serving globals. Returns False if it is missing, stale or incomplete."""
+    global _artifact_bundle, _scalers, _imputation_values, _tuned_models
+    try:
+        bundle = artifact_bundle.load_bundle(
+            ARTIFACT_BUNDLE_FILE,
+            expected_version=_teacher_version,
+            native_min_rows=BUNDLE_NATIVE_MIN_ROWS
+        )
+    except artifact_bundle.BundleError as e:
+        print(f"Serving bundle not used: {e}")
+        return False
+    missing = [wl for wl in WATER_LEVELS_TO_PROCESS if wl not in bundle.scalers or wl not in bundle.imputation_values]
+    if missing or not bundle.models:
+        print(f"Serving bundle not used: scalers/imputation/models missing for WL {missing}.")
+        return False
+    _artifact_bundle = bundle
+    _scalers = dict(bundle.scalers)
+    _imputation_values = dict(bundle.imputation_values)
+    _tuned_models = defaultdict(dict)
+    for wl in WATER_LEVELS_TO_PROCESS:
+        for target in TARGET_COLS:
+            _tuned_models[wl][target] = bundle.models.get(wl, {}).get(target)
+    print(f"Memory-mapped serving bundle {ARTIFACT_BUNDLE_FILE} (artifact version {bundle.artifact_version}).")
+    return True
+
+
+# --- Startup Warm-up ---
+def _ms_since(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+def _warm_up_model(model, x_row, x_batch):
+    """Cold single-row call, mean warm single-row call, and one batch call (ms)."""
+    start = time.perf_counter()
+    _booster_predict(model, x_row)
+    cold_ms = _ms_since(start)
+    start = time.perf_counter()
+    for _ in range(WARMUP_ROUNDS):
+        _booster_predict(model, x_row)
+    warm_ms = round(_ms_since(start) / max(1, WARMUP_ROUNDS), 3)
+    if x_batch is None:
+        return {'coldMs': cold_ms, 'warmMs': warm_ms}
+    start = time.perf_counter()
+    _booster_predict(model, x_batch) # Batch-sized calls spin up the batch thread budget
+    return {'coldMs': cold_ms, 'warmMs': warm_ms, 'batchMs': _ms_since(start)}
+
+def _warm_up():
+    """
+    Runs representative predictions (imputation means as the synthetic input) through every
+    loaded model and reduced variant, plus one end-to-end prediction per water level, so lazy
+    allocations and thread pools are paid before traffic arrives. Records timings in _warmup_report.
+    """
+    global _is_ready, _warmup_report
+    report = {'status': 'running', 'models': {}, 'endToEndMs': {}, 'errors': []}
+    _warmup_report = report
+    print("Warming up models...")
+    start_warmup = time.perf_counter()
+    for wl in WATER_LEVELS_TO_PROCESS:
+        scaler = _scalers.get(wl)
+        wl_means = _imputation_values.get(wl) or {}
+        synthetic = np.array([wl_means.get(col, np.nan) for col in SPECTRAL_COLS], dtype=np.float64)
+        if scaler is None or np.isnan(synthetic).any():
+            report['errors'].append(f"WL {wl}: scaler or imputation values missing; skipped.")
+            continue
+        x_batch = np.repeat(_scale_bands(scaler, synthetic, slice(None)).reshape(1, -1), max(1, INFERENCE_BATCH_MIN_ROWS), axis=0)
+        wl_report = report['models'][str(wl)] = {}
+        for target in TARGET_COLS:
+            model = _tuned_models[wl].get(target)
+            if model is None:
+                continue
             try:
-                pred = model.predict(input_scaled)[0]
-                # Rounding for cleaner output (optional, frontend can also format)
-                # Adjust precision based on target variable nature
-                if target in ['Ph', 'Temp']:
-                    target_pred_val = round(pred, 2)
-                elif target in ['Nitro', 'Posh Nitro', 'Pota Nitro', 'EC']:
-                     target_pred_val = round(pred, 3)
-                else: # Moist, Cap Moist
-                     target_pred_val = round(pred, 1)
-
-                print(f"  Predicted {target:<18}: {target_pred_val}")
+                # Bundle models skip the batch call: it would load the model pickle the bundle replaces
+                wl_report[target] = _warm_up_model(model, x_batch[:1], None if _artifact_bundle is not None else x_batch)
+                for k, _, col_idx, variant_model in _reduced_variants.get(wl, {}).get(target, []):
+                    wl_report[target][f"top{k}"] = _warm_up_model(variant_model, x_batch[:1, col_idx], x_batch[:, col_idx])
             except Exception as e:
-                print(f"  Error predicting '{target}' for WL {water_level}: {e}")
-                target_pred_val = None # Indicate prediction error
-                all_preds_successful = False
-
-        target_predictions[target] = target_pred_val
+                report['errors'].append(f"WL {wl}, {target}: {e}")
+        student = _distilled_students.get(wl)
+        if student is not None:
+            start = time.perf_counter()
+            _student_predict(student, x_batch[:1])
+            wl_report['student'] = {'coldMs': _ms_since(start)}
+        # End-to-end pass (validation, imputation, scaling, rounding) with the same synthetic input
+        present = np.ones(len(SPECTRAL_COLS), dtype=bool)
+        start = time.perf_counter()
+        predict_soil_properties_array_internal(
+            synthetic, present, list(SPECTRAL_COLS), wl, _tuned_models, _scalers, _imputation_values, _reduced_variants,
+            loaded_forests=_bundle_forests()
+        )
+        report['endToEndMs'][str(wl)] = _ms_since(start)
+    report['durationSeconds'] = round(time.perf_counter() - start_warmup, 3)
+    report['status'] = 'done'
+    _is_ready = _is_initialized
+    print(f"Warm-up complete in {report['durationSeconds']:.2f} seconds ({len(report['errors'])} errors).")
+
+def _start_warm_up():
+    """Starts the warm-up (in the background if WARMUP_IN_BACKGROUND); marks the app ready when done."""
+    global _is_ready, _warmup_report
+    if not WARMUP_ON_INIT:
+        _warmup_report = {'status': 'disabled'}
+        _is_ready = True
+        return
+
+    def run():
+        global _is_ready
+        try:
+            _warm_up()
+        except Exception as e:
+            # A failed warm-up only costs first-request latency; do not keep the worker out of rotation
+            print(f"Warning: Warm-up failed: {e}")
+            _warmup_report.update({'status': 'failed', 'error': str(e)})
+            _is_ready = _is_initialized
 
-    # Final status update
-    if all_preds_successful and all(v is not None for v in target_predictions.values()):
-         predictions['Prediction_Status'] = 'Success'
-    elif any(v is not None for v in target_predictions.values()):
-         predictions['Prediction_Status'] = 'Partial Success (Some models/predictions failed or missing)'
+    if WARMUP_IN_BACKGROUND:
+        threading.Thread(target=run, name="warmup", daemon=True).start()
     else:
-         predictions['Prediction_Status'] = 'Failed (All predictions failed or critical error)'
-
-    return predictions, target_predictions
+        run()
 
 
 # --- Main Initialization Function (Called by Flask app) ---
@@ -604,7 +2005,7 @@ def initialize_application():
     Loads data, trains/loads models & artifacts.
     This should run only once.
     """
-    global _is_initialized, _scalers, _imputation_values, _tuned_models, _performance_metrics, _feature_rankings
+    global _is_initialized, _scalers, _imputation_values, _tuned_models, _performance_metrics, _feature_rankings, _ranking_index, _reduced_variants, _distilled_students, _artifact_version, _teacher_version, _artifact_bundle, _drift_reference
     with _init_lock: # Ensure thread safety during init
         if _is_initialized:
             print("Application already initialized.")
@@ -617,27 +2018,75 @@ def initialize_application():
             df = _load_data()
             X_train, X_test, y_train, y_test = _split_data(df)
 
-            # Try loading artifacts first
-            artifacts_loaded = _load_artifacts()
+            # Try loading artifacts first (models/scalers/imputation from the memory-mapped bundle when it is current)
+            _artifact_bundle = None
+            _teacher_version = _compute_teacher_version() # Content hash: the bundle's stale check and derived manifests
+            bundle_loaded = SERVE_FROM_BUNDLE and not FORCE_RETRAIN and _load_artifact_bundle()
+            artifacts_loaded = _load_artifacts(load_serving_artifacts=not bundle_loaded) if not FORCE_RETRAIN else False
 
             if not artifacts_loaded:
                 print("Artifacts not found or incomplete. Running training and evaluation...")
+                _artifact_bundle = None # Retrained models are served from memory; the bundle is re-exported below
                 # Prepare scalers and imputation (always based on current train split)
                 _scalers, _imputation_values = _prepare_scalers_imputation(X_train)
 
                 # Train/Evaluate (loads/runs Optuna, trains models, evaluates, calculates rankings)
-                _tuned_models, _performance_metrics, _feature_rankings = _train_and_evaluate(
+                _tuned_models, _performance_metrics, _feature_rankings, _ranking_index = _train_and_evaluate(
                     X_train, y_train, X_test, y_test, _scalers
                 )
+                _teacher_version = _compute_teacher_version()
                 # Ensure models are loaded into the global state correctly
                 # (The return value _tuned_models should be assigned globally)
 
             else:
                 print("Successfully loaded all required artifacts.")
+                _ranking_index = _load_ranking_index()
+                if not _ranking_index:
+                    # Older artifact sets: derive the index from the loaded boosters and the test split
+                    print("Building feature ranking index from loaded models...")
+                    _ranking_index = _build_ranking_index(_compute_importance_array(_tuned_models, X_test, y_test, _scalers))
+                    _save_ranking_index(_ranking_index)
+                if 'Confidence_Intervals' not in _performance_metrics:
+                    # Older artifact sets: bootstrap the test split with the loaded models
+                    _performance_metrics = dict(_performance_metrics)
+                    _performance_metrics['Confidence_Intervals'] = _bootstrap_intervals(
+                        _collect_eval_predictions(_tuned_models, X_test, y_test, _scalers)
+                    )
+                    try:
+                        with open(PERFORMANCE_METRICS_FILE, 'w') as f:
+                            json.dump(_performance_metrics, f, indent=4)
+                    except Exception as e:
+                        print(f"Error saving performance metrics: {e}")
+
+            # Reference input sketches for the drift monitor (rebuilt with the models)
+            _drift_reference = _load_drift_reference() if artifacts_loaded else {}
+            if not _drift_reference:
+                _drift_reference = _build_drift_reference(df)
+                _save_drift_reference(_drift_reference)
+
+            # Optional reduced-band variants (served only if present and derived from these models)
+            _reduced_variants = _load_reduced_variants()
+            if not _reduced_variants and TRAIN_REDUCED_VARIANTS:
+                _reduced_variants, variant_summary = _train_reduced_variants(
+                    X_train, y_train, X_test, y_test, _scalers, _tuned_models, _feature_rankings, _load_params_cache()
+                )
+                _save_reduced_variants(variant_summary)
+
+            # Optional distilled students for the 'fast' serving mode (served only if present and distilled from these models)
+            _distilled_students = _load_distilled_students()
+            if not _distilled_students and TRAIN_DISTILLED_STUDENTS:
+                _distilled_students, student_summary = _train_distilled_students(
+                    X_train, y_train, X_test, y_test, _scalers, _tuned_models, _imputation_values
+                )
+                _save_distilled_students(student_summary)
 
+            _artifact_version = _compute_artifact_version(DERIVED_VERSION_DIRS, _teacher_version)
+            if _artifact_bundle is None and SERVE_FROM_BUNDLE and BUNDLE_AUTO_EXPORT:
+                _start_bundle_export(_bundle_check_rows(X_test))
             _is_initialized = True
             init_duration = time.time() - start_init_time
             print(f"Application Initialization Complete. Duration: {init_duration:.2f} seconds.")
+            _start_warm_up()
             return True
 
         except Exception as e:
@@ -646,11 +2095,71 @@ def initialize_application():
             # Consider raising the exception or returning False to signal failure
             return False
 
-def _load_artifacts():
-    """Attempts to load all necessary artifacts from disk."""
-    global _scalers, _imputation_values, _tuned_models, _performance_metrics, _feature_rankings
+def train_reduced_band_variants():
+    """
+    Training mode: builds top-K band variants for every (target, water level) from the
+    current artifacts and records their accuracy/latency tradeoff in the performance metrics.
+    """
+    global _reduced_variants
+    if not initialize_application():
+        return False
+    X_train, X_test, y_train, y_test = _split_data(_load_data())
+    _reduced_variants, variant_summary = _train_reduced_variants(
+        X_train, y_train, X_test, y_test, _scalers, _tuned_models, _feature_rankings, _load_params_cache()
+    )
+    _save_reduced_variants(variant_summary)
+    return True
+
+def train_distilled_students():
+    """
+    Training mode: distills each water level's tuned models into a multi-output student and
+    records the accuracy gap versus the teachers in the performance metrics.
+    """
+    global _distilled_students
+    if not initialize_application():
+        return False
+    X_train, X_test, y_train, y_test = _split_data(_load_data())
+    _distilled_students, student_summary = _train_distilled_students(
+        X_train, y_train, X_test, y_test, _scalers, _tuned_models, _imputation_values
+    )
+    _save_distilled_students(student_summary)
+    return True
+
+def export_artifact_bundle(leaf_dtype=BUNDLE_LEAF_DTYPE):
+    """
+    Export mode: writes the single-file serving bundle from the pickled artifacts and checks it
+    against the boosters on the test split. Requires SERVE_FROM_BUNDLE = False before initialization.
+    """
+    if not initialize_application():
+        return False
+    if _artifact_bundle is not None:
+        print("Error: Artifacts were loaded from the bundle; disable SERVE_FROM_BUNDLE to export from the pickles.")
+        return False
+    X_train, X_test, y_train, y_test = _split_data(_load_data())
+    try:
+        _export_artifact_bundle(_bundle_check_rows(X_test), leaf_dtype)
+    except Exception as e:
+        print(f"Error exporting the serving bundle: {e}")
+        return False
+    return True
+
+def _load_artifacts(load_serving_artifacts=True):
+    """
+    Attempts to load all necessary artifacts from disk. load_serving_artifacts=False skips the
+    scalers, imputation values and models (already loaded from the serving bundle).
+    """
     print("Attempting to load pre-existing artifacts...")
     all_loaded = True
+    if load_serving_artifacts:
+        all_loaded = _load_serving_artifacts()
+    all_loaded = _load_metadata_artifacts() and all_loaded
+    print(f"Artifact loading attempt finished. Overall success: {all_loaded}")
+    return all_loaded
+
+def _load_serving_artifacts():
+    """Loads the scalers, imputation values and models from their joblib/JSON files."""
+    global _scalers, _imputation_values, _tuned_models
+    all_loaded = True
 
     # 1. Scalers
     _scalers = {}
@@ -710,6 +2219,12 @@ def _load_artifacts():
     if not any(_tuned_models[wl].get(target) for wl in WATER_LEVELS_TO_PROCESS for target in TARGET_COLS):
          print("  Warning: No trained models were loaded successfully.")
          all_loaded = False # Consider this a failure if *no* models are available
+    return all_loaded
+
+def _load_metadata_artifacts():
+    """Loads the performance metrics and feature rankings."""
+    global _performance_metrics, _feature_rankings
+    all_loaded = True
 
     # 4. Performance Metrics
     if os.path.exists(PERFORMANCE_METRICS_FILE):
@@ -744,8 +2259,6 @@ def _load_artifacts():
         print(f"  Feature ranking file missing: {FEATURE_RANKING_FILE}")
         all_loaded = False
         _feature_rankings = {}
-
-    print(f"Artifact loading attempt finished. Overall success: {all_loaded}")
     return all_loaded
 
 
@@ -754,6 +2267,27 @@ def get_status():
     """Returns the initialization status."""
     return _is_initialized
 
+def get_readiness():
+    """Returns (ready, warm-up report); ready once initialized and warmed up."""
+    return _is_ready, _warmup_report
+
+def get_artifact_bundle_info():
+    """Summary of the memory-mapped serving bundle, or None when serving from the pickles."""
+    return _artifact_bundle.info() if _artifact_bundle is not None else None
+
+def get_drift_reference():
+    """Returns the drift reference sketches {water level: sketch} (empty before initialization)."""
+    return _drift_reference
+
+def get_artifact_version():
+    """Returns the artifact version hash (None before initialization)."""
+    return _artifact_version
+
+def get_imputation_means(water_level):
+    """Returns the imputation means {wavelength: value} for a water level (a representative input)."""
+    if not _is_initialized: return {}
+    return dict(_imputation_values.get(water_level) or {})
+
 def get_performance_metrics():
     """Returns the loaded performance metrics."""
     if not _is_initialized: return {"error": "Application not initialized"}
@@ -764,6 +2298,78 @@ def get_feature_rankings():
     if not _is_initialized: return {"error": "Application not initialized"}
     return _feature_rankings
 
+def get_ranking(target, water_level=None, importance_type='split', count=None):
+    """
+    Returns the ranking list for a target from the ranking index, filtered by water level
+    (None = mean across water levels) and importance type. Returns None if the index is unavailable.
+    """
+    if not _is_initialized or not _ranking_index: return None
+    return _rankings_from_index(_ranking_index, target, water_level, importance_type, count)
+
+def run_prediction_array(values, present, provided, water_level, mode='full'):
+    """
+    Runs prediction on a parsed request (fixed-order array + presence mask) using loaded artifacts.
+    mode='fast' uses the distilled multi-output student for the water level when available.
+    """
+    if not _is_initialized:
+        return {"Prediction_Status": "Error: Application not initialized"}, {}
+    return predict_soil_properties_array_internal(
+        values,
+        present,
+        provided,
+        water_level,
+        _tuned_models,
+        _scalers,
+        _imputation_values,
+        _reduced_variants,
+        _distilled_students,
+        mode,
+        _bundle_forests()
+    )
+
+def run_prediction_batch(values, present, provided, water_level, mode='full'):
+    """
+    Runs prediction for a batch of rows sharing a water level and band subset (values is
+    (n_rows, len(SPECTRAL_COLS))). Returns a list of (status_info, predictions) per row.
+    """
+    if not _is_initialized:
+        return [({"Prediction_Status": "Error: Application not initialized"}, {}) for _ in range(len(values))]
+    return predict_soil_properties_batch_internal(
+        values,
+        present,
+        provided,
+        water_level,
+        _tuned_models,
+        _scalers,
+        _imputation_values,
+        _reduced_variants,
+        _distilled_students,
+        mode,
+        _bundle_forests()
+    )
+
+def run_prediction_sweep(values, present, provided, water_level, axes, mode='full'):
+    """
+    Runs a what-if sweep of one or two bands around a base sample (see
+    predict_soil_properties_sweep_internal). Returns (status_info, surfaces, baseline).
+    """
+    if not _is_initialized:
+        return {"Prediction_Status": "Error: Application not initialized"}, {}, {}
+    return predict_soil_properties_sweep_internal(
+        values,
+        present,
+        provided,
+        water_level,
+        axes,
+        _tuned_models,
+        _scalers,
+        _imputation_values,
+        _reduced_variants,
+        _distilled_students,
+        mode,
+        _bundle_forests()
+    )
+
 def run_prediction(input_spectral_data, water_level):
     """Runs prediction using loaded artifacts."""
     if not _is_initialized:
@@ -774,5 +2380,45 @@ def run_prediction(input_spectral_data, water_level):
         water_level,
         _tuned_models,
         _scalers,
-        _imputation_values
-    )
\ No newline at end of file
+        _imputation_values,
+        _reduced_variants,
+        _bundle_forests()
+    )
+
+
+# --- Command Line Training Modes ---
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Train or load soil models and run optional training modes.")
+    parser.add_argument('--reduced-variants', action='store_true', help="Train top-K band model variants from feature_rankings.json.")
+    parser.add_argument('--distill', action='store_true', help="Train distilled multi-output students for the 'fast' serving mode.")
+    parser.add_argument('--export-bundle', action='store_true', help="Write the single-file memory-mapped serving bundle from the current artifacts.")
+    parser.add_argument('--bundle-leaf-dtype', choices=artifact_bundle.LEAF_DTYPES, default=BUNDLE_LEAF_DTYPE,
+                        help="Leaf value storage for --export-bundle (int16/float16 within BUNDLE_MAX_LEAF_ERROR).")
+    parser.add_argument('--retrain', action='store_true', help="Retrain all models even if artifacts exist.")
+    parser.add_argument('--retune', action='store_true', help="Retrain with Optuna re-tuning, warm-started from best_params.json.")
+    parser.add_argument('--tuning-budget', type=int, default=None, metavar='TRIALS',
+                        help="Retune with the global scheduler under this total trial budget.")
+    parser.add_argument('--fit-jobs', type=int, default=None, metavar='N',
+                        help="Worker processes for the final fits (default: CPU quota; 1 = fit inline).")
+    args = parser.parse_args()
+
+    FINAL_FIT_N_JOBS = args.fit_jobs # Safe here: spawned workers import this script without initializing
+
+    FORCE_RETRAIN = args.retrain or args.retune or args.tuning_budget is not None
+    RETUNE_WITH_CACHE = args.retune or args.tuning_budget is not None
+    if args.tuning_budget is not None:
+        TUNING_SCHEDULER = True
+        TUNING_BUDGET_TRIALS = args.tuning_budget
+
+    if args.reduced_variants or args.distill or args.export_bundle:
+        SERVE_FROM_BUNDLE = False # These modes work on the pickled LightGBM models
+    if args.reduced_variants:
+        success = train_reduced_band_variants()
+    elif args.distill:
+        success = train_distilled_students()
+    elif args.export_bundle:
+        success = export_artifact_bundle(args.bundle_leaf_dtype)
+    else:
+        success = initialize_application()
+    raise SystemExit(0 if success else 1)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+prediction_log.py: Optional write-behind audit log of predictions (SQLite via SQLAlchemy).
+Request threads only enqueue a record (inputs, imputed bands, outputs, artifact version,
+latency); a background writer drains the bounded queue and bulk-inserts batches of up to
+PREDICTION_LOG_BATCH_SIZE rows every PREDICTION_LOG_FLUSH_SECONDS, so no request waits on
+the database.
+
+Drop/backpressure policy: when the queue is full (the writer cannot keep up or the database
+is unavailable), a request waits at most PREDICTION_LOG_PUT_TIMEOUT_SECONDS (default 0, i.e.
+not at all) and the new record is then dropped and counted in get_stats()['dropped'].
+Prediction latency always takes priority over audit completeness. A batch that fails to
+insert is dropped as well (counted in 'writeErrors' / 'droppedOnError'). Records still
+queued when the process exits are flushed on a best-effort basis (atexit).
+Records become visible to query_recent() once their batch is written.
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import (Column, DateTime, Float, Index, Integer, JSON, MetaData, String, Table,
+                        create_engine, event, select)
+
+import mymodel_utils
+
+# --- Configuration (environment overridable) ---
+PREDICTION_LOG_ENABLED = os.environ.get("PREDICTION_LOG_ENABLED", "false").lower() in ("1", "true", "yes")
+PREDICTION_LOG_DB = os.environ.get("PREDICTION_LOG_DB", "prediction_log.db") # SQLite file (relative to backend/)
+PREDICTION_LOG_QUEUE_SIZE = int(os.environ.get("PREDICTION_LOG_QUEUE_SIZE", 10000)) # Records buffered in memory
+PREDICTION_LOG_BATCH_SIZE = int(os.environ.get("PREDICTION_LOG_BATCH_SIZE", 500)) # Rows per INSERT batch
+PREDICTION_LOG_FLUSH_SECONDS = float(os.environ.get("PREDICTION_LOG_FLUSH_SECONDS", 1.0)) # Max delay before a partial batch is written
+PREDICTION_LOG_PUT_TIMEOUT_SECONDS = float(os.environ.get("PREDICTION_LOG_PUT_TIMEOUT_SECONDS", 0)) # Wait for queue space before dropping
+PREDICTION_LOG_QUERY_MAX = 500 # Max rows returned by query_recent
+
+# --- Schema ---
+_metadata = MetaData()
+predictions_table = Table(
+    "predictions", _metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("created_at", DateTime, nullable=False), # UTC
+    Column("source", String(16), nullable=False), # 'analyze' or 'stream'
+    Column("water_level", Integer),
+    Column("status", String(16), nullable=False), # success / partial / failed / error
+    Column("status_message", String(255)),
+    Column("inputs", JSON), # {wavelength: value} as provided
+    Column("imputed_features", JSON),
+    Column("outputs", JSON), # {target: value}
+    Column("model_variants", JSON),
+    Column("artifact_version", String(16)),
+    Column("latency_ms", Float), # Request latency (whole micro-batch for stream readings)
+    Index("ix_predictions_created_at", "created_at"),
+    Index("ix_predictions_water_level", "water_level"),
+    Index("ix_predictions_status", "status"),
+)
+STATUS_VALUES = ["success", "partial", "failed", "error"]
+
+# --- State ---
+_engine = None
+_queue = queue.Queue(maxsize=PREDICTION_LOG_QUEUE_SIZE)
+_writer = None
+_start_lock = threading.Lock()
+_STOP = object()
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "dropped": 0, "written": 0, "batches": 0, "writeErrors": 0, "droppedOnError": 0}
+_last_drop_warning = 0.0
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def _status_category(message):
+    if message == 'Success':
+        return "success"
+    if message.startswith('Partial Success'):
+        return "partial"
+    if message.startswith('Failed'):
+        return "failed"
+    return "error"
+
+
+def _set_sqlite_pragmas(dbapi_connection, _record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL") # Readers (query endpoint, other workers) do not block the writer
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def is_enabled():
+    return _writer is not None
+
+
+def start(db_path=PREDICTION_LOG_DB):
+    """Creates the database/indexes if needed and starts the background writer. Returns True on success."""
+    global _engine, _writer
+    with _start_lock:
+        if _writer is not None:
+            return True
+        try:
+            _engine = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": 30})
+            event.listen(_engine, "connect", _set_sqlite_pragmas)
+            _metadata.create_all(_engine)
+        except Exception as e:
+            print(f"ERROR: Prediction log disabled, could not open '{db_path}': {e}")
+            _engine = None
+            return False
+        _writer = threading.Thread(target=_write_loop, name="prediction-log", daemon=True)
+        _writer.start()
+        atexit.register(stop)
+        print(f"Prediction log writing to '{db_path}' (queue {PREDICTION_LOG_QUEUE_SIZE}, batch {PREDICTION_LOG_BATCH_SIZE}).")
+        return True
+
+
+def stop(timeout=5.0):
+    """Flushes queued records and stops the writer (best effort within timeout)."""
+    global _writer
+    if _writer is None:
+        return
+    try:
+        _queue.put(_STOP, timeout=timeout)
+    except queue.Full:
+        pass
+    _writer.join(timeout)
+    _writer = None
+
+
+def record(source, water_level, values, present, status_info, predictions, latency_ms):
+    """
+    Enqueues one prediction (values/present as parsed by api_schemas, status_info/predictions
+    as returned by mymodel_utils). Never raises; drops the record if the queue stays full.
+    """
+    global _last_drop_warning
+    if _writer is None:
+        return False
+    item = (datetime.now(timezone.utc).replace(tzinfo=None), source, water_level, values, present,
+            status_info, predictions, latency_ms)
+    try:
+        if PREDICTION_LOG_PUT_TIMEOUT_SECONDS > 0:
+            _queue.put(item, timeout=PREDICTION_LOG_PUT_TIMEOUT_SECONDS)
+        else:
+            _queue.put_nowait(item)
+    except queue.Full:
+        _count("dropped")
+        now = time.monotonic()
+        if now - _last_drop_warning > 10: # Rate-limited so a stalled writer does not flood the log
+            _last_drop_warning = now
+            print(f"Warning: Prediction log queue full ({PREDICTION_LOG_QUEUE_SIZE}); dropping records.")
+        return False
+    _count("enqueued")
+    return True
+
+
+def _to_row(item, artifact_version):
+    created_at, source, water_level, values, present, status_info, predictions, latency_ms = item
+    message = status_info.get('Prediction_Status', 'Unknown Error')
+    return {
+        "created_at": created_at,
+        "source": source,
+        "water_level": water_level,
+        "status": _status_category(message),
+        "status_message": message[:255],
+        "inputs": {mymodel_utils.SPECTRAL_COLS[i]: float(values[i]) for i in np.flatnonzero(present)},
+        "imputed_features": status_info.get('Imputed_Features', []),
+        "outputs": {target: (None if value is None else float(value)) for target, value in predictions.items()},
+        "model_variants": status_info.get('Model_Variants', {}),
+        "artifact_version": artifact_version,
+        "latency_ms": round(latency_ms, 3),
+    }
+
+
+def _write_loop():
+    stopping = False
+    while not stopping:
+        try:
+            item = _queue.get(timeout=PREDICTION_LOG_FLUSH_SECONDS)
+        except queue.Empty:
+            continue
+        batch = []
+        deadline = time.monotonic() + PREDICTION_LOG_FLUSH_SECONDS
+        while True:
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+            if len(batch) >= PREDICTION_LOG_BATCH_SIZE:
+                break
+            try:
+                item = _queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        if batch:
+            _write_batch(batch)
+
+
+def _write_batch(batch):
+    artifact_version = mymodel_utils.get_artifact_version()
+    try:
+        rows = [_to_row(item, artifact_version) for item in batch]
+        with _engine.begin() as conn:
+            conn.execute(predictions_table.insert(), rows) # executemany: one transaction per batch
+        _count("written", len(rows))
+        _count("batches")
+    except Exception as e:
+        print(f"ERROR: Prediction log batch of {len(batch)} records dropped: {e}")
+        _count("writeErrors")
+        _count("droppedOnError", len(batch))
+
+
+def query_recent(limit=50, water_level=None, status=None, since=None):
+    """Most recent logged predictions (newest first), optionally filtered. since is a UTC datetime."""
+    query = select(predictions_table).order_by(predictions_table.c.created_at.desc(), predictions_table.c.id.desc())
+    if water_level is not None:
+        query = query.where(predictions_table.c.water_level == water_level)
+    if status is not None:
+        query = query.where(predictions_table.c.status == status)
+    if since is not None:
+        query = query.where(predictions_table.c.created_at >= since)
+    query = query.limit(max(1, min(limit, PREDICTION_LOG_QUERY_MAX)))
+    with _engine.connect() as conn:
+        rows = conn.execute(query).mappings().all()
+    return [{**row, "created_at": row["created_at"].isoformat() + "Z"} for row in rows]
+
+
+def get_stats():
+    """Snapshot of log counters (for /api/health/v2)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["enabled"] = is_enabled()
+    stats["queued"] = _queue.qsize()
+    stats["queueSize"] = PREDICTION_LOG_QUEUE_SIZE
+    return stats
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+stream_utils.py: Persistent prediction streams for continuous spectrometer feeds.
+A client declares its water level and band subset once, then pushes readings over the
+same connection. Readings that arrive while a batch is being predicted are drained
+into the next micro-batch, which goes through mymodel_utils.run_prediction_batch
+(the same imputation/scaling/model logic as run_prediction, one predict per target).
+
+Protocol (JSON text messages):
+  -> {"type": "config", "waterLevel": 25, "bands": ["410", "435", ...], "mode": "fast"}   (mode optional)
+  <- {"type": "ready", "waterLevel": 25, "bands": [...], "mode": "fast", "maxBatch": 32}
+  -> {"type": "reading", "id": 1, "values": [120.5, 88.0, ...]}   (values in declared band order,
+                                                                   or {"410": 120.5, ...})
+  <- {"type": "prediction", "id": 1, "Prediction_Status": "Success", "pH": 6.8, ...}
+  <- {"type": "error", "id": 1, "error": "..."}                   (connection stays open)
+A new "config" message may be sent at any time; readings after it use the new settings.
+serve() runs a stream on a worker thread (flask-sock); serve_async() on the ASGI event loop.
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+
+import numpy as np
+
+import mymodel_utils
+import api_schemas
+import prediction_log
+import drift_monitor
+
+# --- Configuration (environment overridable) ---
+STREAM_MAX_CONNECTIONS = int(os.environ.get("STREAM_MAX_CONNECTIONS", 8)) # Each open stream holds a worker thread
+STREAM_MAX_BATCH = int(os.environ.get("STREAM_MAX_BATCH", 32)) # Readings predicted together
+# Extra wait for more readings after the first. 0 batches only what is already queued (no added
+# latency for one-at-a-time clients); a few ms trades latency for larger batches on bursty feeds.
+STREAM_BATCH_WINDOW_MS = float(os.environ.get("STREAM_BATCH_WINDOW_MS", 0))
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.environ.get("STREAM_IDLE_TIMEOUT_SECONDS", 300)) # Close silent connections
+
+
+class StreamRejected(Exception):
+    """Raised when STREAM_MAX_CONNECTIONS streams are already open."""
+
+
+_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+_stats_lock = threading.Lock()
+_stats = {"open": 0, "opened": 0, "rejected": 0, "readings": 0, "batches": 0, "errors": 0}
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def get_stats():
+    """Snapshot of stream counters (for /api/health/v2)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["meanBatchSize"] = round(stats["readings"] / stats["batches"], 2) if stats["batches"] else None
+    stats["maxConnections"] = STREAM_MAX_CONNECTIONS
+    return stats
+
+
+class StreamSession:
+    """Per-connection state: declared configuration plus pending readings."""
+
+    def __init__(self):
+        self.water_level = None
+        self.bands = None # Declared band keys, in the order readings send them
+        self.band_idx = None # Their positions in SPECTRAL_COLS
+        self.present = None
+        self.mode = 'full'
+        self.pending = [] # (id, values row) waiting for the next batch
+
+    @property
+    def configured(self):
+        return self.water_level is not None
+
+    def configure(self, message):
+        """Applies a config message and returns the 'ready' reply. Raises RequestValidationError."""
+        water_level = api_schemas.parse_water_level(message.get('waterLevel'))
+        mode = api_schemas.parse_mode(message.get('mode'))
+        bands = message.get('bands')
+        if not isinstance(bands, list) or not all(isinstance(band, str) for band in bands):
+            raise api_schemas.RequestValidationError("Invalid config: 'bands' must be a list of wavelength keys.")
+        if len(set(bands)) != len(bands):
+            raise api_schemas.RequestValidationError("Invalid config: 'bands' contains duplicates.")
+        # Same key/count rules as /api/analyze (values are checked per reading)
+        api_schemas.parse_wavelengths({band: 0.0 for band in bands})
+        self.water_level = water_level
+        self.bands = bands
+        self.band_idx = np.array([api_schemas.SPECTRAL_INDEX[band] for band in bands])
+        self.present = np.zeros(api_schemas.MAX_INPUTS, dtype=bool)
+        self.present[self.band_idx] = True
+        self.mode = mode
+        return {"type": "ready", "waterLevel": water_level, "bands": bands, "mode": mode, "maxBatch": STREAM_MAX_BATCH}
+
+    def parse_reading(self, message):
+        """Returns a float64 row in SPECTRAL_COLS order. Raises RequestValidationError."""
+        if not self.configured:
+            raise api_schemas.RequestValidationError("Stream not configured: send a 'config' message first.")
+        values = message.get('values')
+        if isinstance(values, dict):
+            if set(values) != set(self.bands):
+                raise api_schemas.RequestValidationError(f"Reading keys must match the configured bands: {self.bands}")
+            values = [values[band] for band in self.bands]
+        if not isinstance(values, list) or len(values) != len(self.bands):
+            raise api_schemas.RequestValidationError(f"Reading must have {len(self.bands)} values in configured band order: {self.bands}")
+        row = np.full(api_schemas.MAX_INPUTS, np.nan)
+        for band, i, value in zip(self.bands, self.band_idx, values):
+            # bool/str are rejected here (unlike /api/analyze) so a stream cannot silently coerce
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise api_schemas.RequestValidationError(f"Invalid numeric value for wavelength '{band}': {value}")
+            row[i] = value
+        return row
+
+    def predict_pending(self):
+        """Predicts every pending reading in one batch and returns the reply messages."""
+        if not self.pending:
+            return []
+        ids = [reading_id for reading_id, _ in self.pending]
+        values = np.vstack([row for _, row in self.pending])
+        self.pending = []
+        start_time = time.perf_counter()
+        results = mymodel_utils.run_prediction_batch(values, self.present, self.bands, self.water_level, self.mode)
+        batch_ms = (time.perf_counter() - start_time) * 1000
+        _count("batches")
+        _count("readings", len(ids))
+        drift_monitor.observe(self.water_level, values, self.present)
+        replies = []
+        for row, reading_id, (status_info, predictions) in zip(values, ids, results):
+            prediction_log.record('stream', self.water_level, row, self.present, status_info, predictions, batch_ms)
+            reply = {"type": "prediction", "id": reading_id}
+            reply.update(api_schemas.format_analyze_response(status_info, predictions, self.water_level, self.bands))
+            replies.append(reply)
+        return replies
+
+
+def _error(message, reading_id=None):
+    _count("errors")
+    return {"type": "error", "id": reading_id, "error": message}
+
+
+def handle_message(session, raw):
+    """
+    Processes one raw text message. Readings are queued on the session (the caller flushes
+    them with session.predict_pending()); config/error replies are returned immediately.
+    """
+    try:
+        message = json.loads(raw)
+    except (TypeError, ValueError):
+        return [_error("Invalid message: not JSON.")]
+    if not isinstance(message, dict):
+        return [_error("Invalid message: expected a JSON object.")]
+
+    message_type = message.get('type')
+    if message_type == 'reading':
+        try:
+            session.pending.append((message.get('id'), session.parse_reading(message)))
+        except api_schemas.RequestValidationError as e:
+            return [_error(str(e), message.get('id'))]
+        return []
+    if message_type == 'config':
+        replies = session.predict_pending() # Readings sent before the new config keep the old one
+        try:
+            replies.append(session.configure(message))
+        except api_schemas.RequestValidationError as e:
+            replies.append(_error(str(e)))
+        return replies
+    return [_error(f"Invalid message type: {message_type!r}. Expected 'config' or 'reading'.")]
+
+
+def serve(ws):
+    """
+    Runs a stream on a connected WebSocket until the client disconnects or goes idle.
+    ws needs receive(timeout) -> str/None and send(str) (flask-sock / simple-websocket).
+    """
+    if not _slots.acquire(blocking=False):
+        _count("rejected")
+        raise StreamRejected(f"Too many open streams (max {STREAM_MAX_CONNECTIONS}).")
+    _count("open")
+    _count("opened")
+    session = StreamSession()
+    try:
+        while True:
+            raw = ws.receive(timeout=STREAM_IDLE_TIMEOUT_SECONDS)
+            if raw is None:
+                print(f"Stream idle for {STREAM_IDLE_TIMEOUT_SECONDS}s; closing.")
+                break
+            replies = handle_message(session, raw)
+            # Micro-batch: keep draining readings until the batch is full or the window closes.
+            # Anything that queued up while the previous batch was predicted is picked up here.
+            deadline = time.perf_counter() + STREAM_BATCH_WINDOW_MS / 1000.0
+            while session.pending and len(session.pending) < STREAM_MAX_BATCH:
+                raw = ws.receive(timeout=max(0.0, deadline - time.perf_counter()))
+                if raw is None:
+                    break
+                replies.extend(handle_message(session, raw))
+            replies.extend(session.predict_pending())
+            for reply in replies:
+                ws.send(api_schemas.dumps_bytes(reply).decode('utf-8'))
+    finally:
+        _count("open", -1)
+        _slots.release()
+
+
+async def serve_async(ws, run_blocking):
+    """
+    asyncio counterpart of serve() for the ASGI app. ws needs async receive_text() (raises on
+    disconnect) and send_text(str) (Starlette WebSocket); run_blocking(fn) -> awaitable runs the
+    micro-batch prediction off the event loop. A reader task queues messages meanwhile, so the
+    next batch drains whatever arrived during the previous one.
+    """
+    if not _slots.acquire(blocking=False):
+        _count("rejected")
+        raise StreamRejected(f"Too many open streams (max {STREAM_MAX_CONNECTIONS}).")
+    _count("open")
+    _count("opened")
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    async def read():
+        try:
+            while True:
+                inbox.put_nowait(await ws.receive_text())
+        except Exception: # Disconnect (or a non-text frame) ends the stream
+            inbox.put_nowait(None)
+
+    reader = asyncio.create_task(read())
+    session = StreamSession()
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(inbox.get(), STREAM_IDLE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                print(f"Stream idle for {STREAM_IDLE_TIMEOUT_SECONDS}s; closing.")
+                break
+            if raw is None:
+                break
+            replies = handle_message(session, raw)
+            # Micro-batch, as in serve(): drain queued readings until the batch is full or the window closes
+            deadline = loop.time() + STREAM_BATCH_WINDOW_MS / 1000.0
+            while session.pending and len(session.pending) < STREAM_MAX_BATCH:
+                if inbox.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        raw = await asyncio.wait_for(inbox.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    raw = inbox.get_nowait()
+                if raw is None:
+                    return # Client gone; nobody to answer
+                replies.extend(handle_message(session, raw))
+            if session.pending:
+                replies.extend(await run_blocking(session.predict_pending))
+            for reply in replies:
+                await ws.send_text(api_schemas.dumps_bytes(reply).decode('utf-8'))
+    finally:
+        reader.cancel()
+        _count("open", -1)
+        _slots.release()